@@ -0,0 +1,441 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+import threading
+import http.client
+from typing import Callable, Dict, List, Optional
+
+import fitz
+import numpy as np
+
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from src.dataset.preprocess import extract_page_blocks, get_split_rects, iter_blocks_and_png
+from src.model.bm25 import SparseBM25Retriever, build_bm25_index
+from src.model.hybrid import FUSION_METHODS, hybrid_search_batch
+from src.model.retriever import create_retriever
+from src.model.service import RetrievalService
+from src.tools.batch_extract import aextract_pages
+from src.tools.create_docs import iter_markdown_chunks, save_vector_store
+from src.tools.embedding import embed_texts
+from src.tools.faiss_index import build_faiss_index
+from src.tools.image_encode import MODEL_MAX_LONG_SIDE, MODEL_MAX_SHORT_SIDE
+from src.tools.tokenizer import preprocess_func
+
+from .stub_server import HashingEmbeddings, StubModelServer
+from .synthetic import generate_corpus
+
+
+# 比較時に「大きいほど良い」とみなす指標と「小さいほど良い」とみなす指標
+HIGHER_IS_BETTER = ("pages_per_sec", "chunks_per_sec", "vectors_per_sec", "queries_per_sec", "requests_per_sec", "recall")
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "mean_ms", "seconds")
+
+
+def _throughput(count: int, seconds: float, unit: str) -> Dict:
+    return {unit: count, "seconds": seconds, f"{unit}_per_sec": count / seconds if seconds else 0.0}
+
+def _latency(latencies: List[float]) -> Dict:
+    values = np.asarray(latencies) * 1000
+    return {
+        "queries": len(latencies),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+    }
+
+def bench_split(pdf_paths: List[str], thumb_dpi: int = 72) -> Dict:
+    """
+    分割判定 (サムネイルの描画とエッジ検出) のページあたりの処理速度
+    """
+    pages = 0
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as document:
+            for page in document:
+                get_split_rects(page, thumb_dpi)
+                pages += 1
+    return _throughput(pages, time.perf_counter() - start, "pages")
+
+def bench_blocks(pdf_paths: List[str]) -> Dict:
+    """
+    テキストブロック情報と表の抽出のページあたりの処理速度
+    """
+    pages = 0
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as document:
+            for page in document:
+                extract_page_blocks(page)
+                pages += 1
+    return _throughput(pages, time.perf_counter() - start, "pages")
+
+def bench_render(pdf_paths: List[str], dpi: int = 300, image_format: str = "jpeg") -> Dict:
+    """
+    分割判定・描画・ブロック抽出・画像のエンコードを合わせた前処理のページあたりの処理速度
+    返り値の"images"は後続の抽出のベンチマークに用いる
+    """
+    pages_blocks = []
+    images = []
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        for _, blocks, image in iter_blocks_and_png(
+                pdf_path, None, dpi=dpi, split=True, image_format=image_format,
+                max_long_side=MODEL_MAX_LONG_SIDE, max_short_side=MODEL_MAX_SHORT_SIDE, save_images=False
+                ):
+            pages_blocks.append(blocks)
+            images.append(image)
+    result = _throughput(len(images), time.perf_counter() - start, "pages")
+    result["mean_image_bytes"] = sum(image.nbytes for image in images) / len(images) if images else 0.0
+    return result, pages_blocks, images
+
+def bench_extract(server: StubModelServer, pages_blocks: List[list], images: list, concurrency: int) -> Dict:
+    """
+    スタブサーバに対するページ単位のMarkdown生成 (API呼び出し) の処理速度
+    """
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(base_url=server.base_url, api_key="stub", max_retries=0)
+    requests, errors = server.requests, server.errors
+    start = time.perf_counter()
+    asyncio.run(aextract_pages(client, images, pages_blocks, "stub", max_concurrency=concurrency))
+    result = _throughput(len(images), time.perf_counter() - start, "pages")
+    result.update({"requests": server.requests - requests, "errors": server.errors - errors, "concurrency": concurrency})
+    return result
+
+def bench_chunk(
+        markdown_paths: List[str],
+        chunk_size: int,
+        chunk_overlap: int,
+        pretokenize: bool,
+        processes: int = 1
+        ) -> Dict:
+    """
+    Markdownの読み込み・チャンク分割・クリーニング (・分かち書き) のチャンクあたりの処理速度
+    """
+    chunks = []
+    start = time.perf_counter()
+    for _, doc_chunks in iter_markdown_chunks(markdown_paths, chunk_size, chunk_overlap, pretokenize, processes):
+        chunks.extend(doc_chunks)
+    result = _throughput(len(chunks), time.perf_counter() - start, "chunks")
+    result["processes"] = processes
+    return result, chunks
+
+def bench_embed(server: StubModelServer, texts: List[str], workers: int, batch_size: int) -> Dict:
+    """
+    スタブサーバに対する埋め込みのチャンクあたりの処理速度 (キャッシュなし)
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    embeddings = OpenAIEmbeddings(
+        model="stub", base_url=server.base_url, api_key="stub", check_embedding_ctx_length=False, max_retries=0
+        )
+    start = time.perf_counter()
+    vectors = embed_texts(embeddings, texts, max_items_per_batch=batch_size, max_workers=workers)
+    result = _throughput(len(texts), time.perf_counter() - start, "chunks")
+    result.update({"workers": workers, "batch_size": batch_size})
+    return result, vectors
+
+def bench_index(vectors: np.ndarray, specs: Dict[str, Dict]) -> Dict:
+    """
+    インデックスの種類ごとの構築 (学習と追加) 時間
+    """
+    results = {}
+    for name, spec in specs.items():
+        start = time.perf_counter()
+        try:
+            index = build_faiss_index(vectors, spec)
+            index.add(vectors)
+        except ValueError as e:
+            # 学習データが足りない場合など
+            results[name] = {"error": str(e)}
+            continue
+        results[name] = _throughput(len(vectors), time.perf_counter() - start, "vectors")
+    return results
+
+def bench_retrieval(retriever_factories: Dict[str, Callable], queries: List[Dict], warmup: int = 1) -> Dict:
+    """
+    構成ごとのクエリ1件あたりの検索レイテンシ (p50/p99) と、回答を含むチャンクを取得できた割合 (recall)
+    """
+    results = {}
+    for name, factory in retriever_factories.items():
+        try:
+            start = time.perf_counter()
+            retriever = factory()
+            build_seconds = time.perf_counter() - start
+            for query in queries[:warmup]:
+                retriever.invoke(query["question"])
+        except Exception as e:
+            # リランクモデルが取得できない環境など
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+            continue
+
+        latencies = []
+        hits = 0
+        for query in queries:
+            start = time.perf_counter()
+            docs = retriever.invoke(query["question"])
+            latencies.append(time.perf_counter() - start)
+            hits += any(query["answer"] in doc.page_content for doc in docs)
+        results[name] = _latency(latencies)
+        results[name].update({"recall": hits / len(queries), "build_seconds": build_seconds})
+    return results
+
+def bench_retrieval_batch(vector_store, bm25_index, queries: List[Dict], topk: int) -> Dict:
+    """
+    全クエリをまとめたハイブリッド検索 (一括の密ベクトル・BM25検索と1回の統合) の処理時間と段階ごとの内訳
+    """
+    questions = [query["question"] for query in queries]
+    results = {}
+    for fusion in FUSION_METHODS:
+        start = time.perf_counter()
+        fused, timings = hybrid_search_batch(
+            questions, vector_store, topk=topk, bm25_index=bm25_index, hybrid_topk=topk, fusion=fusion
+            )
+        seconds = time.perf_counter() - start
+        docstore = vector_store.docstore
+        hits = sum(
+            any(query["answer"] in docstore.search(doc_id).page_content for doc_id, _ in result[:topk])
+            for query, result in zip(queries, fused)
+        )
+        results[fusion] = {
+            "seconds": seconds,
+            "queries_per_sec": len(questions) / seconds,
+            "recall": hits / len(questions),
+            "stages": timings,
+        }
+    return results
+
+def bench_service(
+        server: StubModelServer,
+        vector_store,
+        queries: List[Dict],
+        topk: int,
+        index_dir: str,
+        concurrency: int = 16,
+        rounds: int = 4
+        ) -> Dict:
+    """
+    検索サービス (model.service) に同時にリクエストを送り、スループット・レイテンシ・バッチサイズを計測する
+    埋め込みはスタブサーバへのHTTPリクエストとし、マイクロバッチなし (max_batch_size=1) とありの構成を比べる
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    save_vector_store(vector_store, index_dir, {"benchmark": True}, keep_versions=1)
+    embeddings = OpenAIEmbeddings(
+        model="stub", base_url=server.base_url, api_key="stub", check_embedding_ctx_length=False, max_retries=5
+        )
+    requests = [query for _ in range(rounds) for query in queries]
+    results = {}
+    for name, max_batch_size in (("unbatched", 1), ("batched", concurrency)):
+        config = {"topk": topk, "hybrid_topk": topk, "max_batch_size": max_batch_size, "reload_interval": 0}
+        with RetrievalService(index_dir, embeddings, config=config) as service:
+            lock = threading.Lock()
+            pending = iter(requests)
+            latencies, hits, errors = [], [], []
+
+            def client():
+                conn = http.client.HTTPConnection(service.host, service.port)
+                while True:
+                    with lock:
+                        query = next(pending, None)
+                    if query is None:
+                        break
+                    start = time.perf_counter()
+                    conn.request("POST", "/search", body=json.dumps({"query": query["question"]}))
+                    response = conn.getresponse()
+                    body = json.loads(response.read())
+                    latencies.append(time.perf_counter() - start)
+                    if response.status != 200:
+                        errors.append(body.get("error"))
+                        continue
+                    hits.append(any(query["answer"] in doc["page_content"] for doc in body["documents"][:topk]))
+                conn.close()
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=client) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+            queue = service.batcher.stats()
+        results[name] = _latency(latencies)
+        results[name].update({
+            "requests_per_sec": len(latencies) / seconds,
+            "recall": sum(hits) / len(hits) if hits else 0.0,
+            "errors": len(errors),
+            "mean_batch_size": queue["mean_batch_size"],
+        })
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+def compare_results(current: Dict, baseline: Dict, tolerance: float = 0.1) -> List[Dict]:
+    """
+    2回分の結果を比較し、指標ごとの変化率と、tolerance (割合) を超えて悪化した指標を返す
+    """
+    current_flat = _flatten(current["results"])
+    baseline_flat = _flatten(baseline["results"])
+    rows = []
+    for name, value in current_flat.items():
+        metric = name.rsplit(".", 1)[-1]
+        if name not in baseline_flat or metric not in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            continue
+        base = baseline_flat[name]
+        change = (value - base) / base if base else 0.0
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        rows.append({"metric": name, "baseline": base, "current": value, "change": change, "regression": worse > tolerance})
+    return rows
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="合成データとスタブサーバによるオフラインのベンチマーク")
+    parser.add_argument("--output", default=None, help="結果のJSONの出力先 (省略時は benchmarks/results/<日時>.json)")
+    parser.add_argument("--data-dir", default="benchmarks/data", help="合成データの出力先")
+    parser.add_argument("--reports", type=int, default=4, help="合成する報告書の数")
+    parser.add_argument("--pages", type=int, default=8, help="報告書あたりのページ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="スタブサーバの応答の待機秒数")
+    parser.add_argument("--jitter", type=float, default=0.02, help="スタブサーバの待機秒数の揺らぎ")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="スタブサーバが429を返す確率")
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--extract-concurrency", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument("--no-pretokenize", action="store_true", help="チャンク分割時の分かち書きを省略する")
+    parser.add_argument("--chunk-workers", type=int, default=1, help="チャンク分割のプロセス数")
+    parser.add_argument("--embed-workers", type=int, default=4)
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--service-concurrency", type=int, default=16, help="検索サービスへの同時リクエスト数")
+    parser.add_argument("--rerank", action="store_true", help="リランクの構成も計測する (リランクモデルの取得が必要)")
+    parser.add_argument("--baseline", default=None, help="比較対象の結果のJSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="悪化とみなす変化率")
+    parser.add_argument("--fail-on-regression", action="store_true", help="悪化した指標がある場合に終了コード1を返す")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    pretokenize = not args.no_pretokenize
+
+    corpus = generate_corpus(args.data_dir, n_reports=args.reports, pages_per_report=args.pages, seed=args.seed)
+    results = {}
+
+    print("PDF前処理...", flush=True)
+    results["split"] = bench_split(corpus["pdfs"])
+    results["blocks"] = bench_blocks(corpus["pdfs"])
+    results["render"], pages_blocks, images = bench_render(corpus["pdfs"], dpi=args.dpi)
+
+    with StubModelServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed) as server:
+        print("Markdown生成 (スタブ)...", flush=True)
+        results["extract"] = bench_extract(server, pages_blocks, images, args.extract_concurrency)
+
+        print("チャンク分割...", flush=True)
+        results["chunk"], chunks = bench_chunk(
+            corpus["markdowns"], args.chunk_size, args.chunk_overlap, pretokenize, args.chunk_workers
+            )
+
+        print("埋め込み (スタブ)...", flush=True)
+        texts = [chunk.page_content for chunk in chunks]
+        results["embed"], vectors = bench_embed(server, texts, args.embed_workers, args.embed_batch_size)
+
+    print("インデックス構築...", flush=True)
+    results["index"] = bench_index(vectors, {
+        "flat": {"type": "flat"},
+        "hnsw": {"type": "hnsw"},
+        "ivfpq": {"type": "ivfpq", "nlist": 64, "pq_m": 32},
+    })
+    embeddings = HashingEmbeddings(dim=vectors.shape[1])
+    start = time.perf_counter()
+    vector_store = FAISS(embeddings, build_faiss_index(vectors, {"type": "flat"}), InMemoryDocstore(), {})
+    vector_store.add_embeddings(list(zip(texts, vectors.tolist())), metadatas=[chunk.metadata for chunk in chunks])
+    results["index"]["vector_store"] = {"seconds": time.perf_counter() - start}
+    start = time.perf_counter()
+    bm25_index = build_bm25_index(vector_store)
+    results["index"]["bm25"] = {"seconds": time.perf_counter() - start}
+
+    print("検索...", flush=True)
+    retriever_kwargs = {
+        "topk": args.topk, "hybrid_topk": args.topk, "hybrid_weights": [0.5, 0.5], "rerank_topk": args.topk,
+    }
+    factories = {
+        "dense": lambda: create_retriever(vector_store, hybrid=False, rerank=False, **retriever_kwargs),
+        "bm25": lambda: SparseBM25Retriever(
+            index=bm25_index, docstore=vector_store.docstore, k=args.topk, preprocess_func=preprocess_func
+            ),
+        "hybrid": lambda: create_retriever(vector_store, hybrid=True, rerank=False, **retriever_kwargs),
+        "hybrid_weighted": lambda: create_retriever(
+            vector_store, hybrid=True, rerank=False, fusion="weighted", **retriever_kwargs
+            ),
+        "hybrid_convex": lambda: create_retriever(
+            vector_store, hybrid=True, rerank=False, fusion="convex", **retriever_kwargs
+            ),
+    }
+    if args.rerank:
+        factories["rerank"] = lambda: create_retriever(vector_store, hybrid=True, rerank=True, **retriever_kwargs)
+    results["retrieval"] = bench_retrieval(factories, corpus["queries"])
+    results["retrieval_batch"] = bench_retrieval_batch(vector_store, bm25_index, corpus["queries"], args.topk)
+
+    print("検索サービス...", flush=True)
+    with StubModelServer(latency=args.latency, jitter=args.jitter, error_rate=0.0, seed=args.seed) as server:
+        results["service"] = bench_service(
+            server, vector_store, corpus["queries"], args.topk, os.path.join(args.data_dir, "service_index"),
+            concurrency=args.service_concurrency
+            )
+
+    output = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output_path = args.output or os.path.join("benchmarks", "results", f"{time.strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"結果を保存しました: {output_path}")
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = compare_results(output, baseline, args.tolerance)
+    for row in rows:
+        mark = "  <- 悪化" if row["regression"] else ""
+        print(f"{row['metric']:<45} {row['baseline']:>12.4g} -> {row['current']:>12.4g} ({row['change']:+.1%}){mark}")
+    regressions = [row for row in rows if row["regression"]]
+    print(f"悪化した指標: {len(regressions)}/{len(rows)}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
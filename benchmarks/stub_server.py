@@ -0,0 +1,177 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def hashing_embedding(text: str, dim: int = 256) -> List[float]:
+    """
+    文字bigramの特徴ハッシングによる決定的な埋め込みベクトル (L2正規化済み)
+    表記が近いテキストほど内積が大きくなるため、検索のベンチマークにも用いる
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for i in range(len(text) - 1):
+        digest = hashlib.blake2b(text[i:i + 2].encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dim] += 1.0 if (value >> 32) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector.tolist()
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    hashing_embeddingをプロセス内で計算するEmbeddings (検索のレイテンシからネットワークの待ち時間を除くために用いる)
+    StubModelServerのEmbeddingsと同じベクトルを返す
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [hashing_embedding(text, self.dim) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return hashing_embedding(text, self.dim)
+
+
+class StubModelServer:
+    """
+    OpenAI互換のChat Completions / Embeddings APIを模したローカルサーバ
+
+    ・応答までの待機時間 (latency ± jitter秒) とエラー率 (429 Too Many Requests) を指定できる
+    ・Chat Completionsはプロンプトの末尾を含む固定形式のテキストを返す
+    ・Embeddingsはhashing_embeddingによる決定的なベクトルを返す
+    ・Azure OpenAIのパス (/openai/deployments/<デプロイ名>/...) にも応答する
+
+    Args:
+        latency (float): 1リクエストあたりの待機秒数
+        jitter (float): 待機秒数の揺らぎの幅 (一様分布)
+        error_rate (float): 429を返す確率
+        dim (int): 埋め込みベクトルの次元数
+        seed (int): 待機時間とエラーの乱数のシード
+    """
+
+    def __init__(
+            self,
+            latency: float = 0.05,
+            jitter: float = 0.0,
+            error_rate: float = 0.0,
+            dim: int = 256,
+            seed: int = 0,
+            host: str = "127.0.0.1",
+            port: int = 0
+            ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.dim = dim
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubModelServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubModelServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _draw(self):
+        """
+        1リクエスト分の待機秒数とエラーにするかどうかを決める
+        """
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                delay, failed = server._draw()
+                time.sleep(delay)
+                if failed:
+                    self._send(
+                        429, {"error": {"message": "Rate limit exceeded (stub)", "type": "rate_limit"}},
+                        {"retry-after-ms": "50"}
+                        )
+                    return
+
+                path = self.path.split("?", 1)[0]
+                if path.endswith("/embeddings"):
+                    inputs = body.get("input", [])
+                    if isinstance(inputs, str):
+                        inputs = [inputs]
+                    data = [
+                        {"object": "embedding", "index": i, "embedding": hashing_embedding(str(text), server.dim)}
+                        for i, text in enumerate(inputs)
+                    ]
+                    self._send(200, {
+                        "object": "list", "data": data, "model": body.get("model", "stub"),
+                        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                    })
+                elif path.endswith("/chat/completions"):
+                    content = body["messages"][-1]["content"]
+                    if isinstance(content, list):
+                        content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+                    text = "## スタブ応答\n\n" + content.strip()[-200:]
+                    self._send(200, {
+                        "id": "stub", "object": "chat.completion", "created": int(time.time()),
+                        "model": body.get("model", "stub"),
+                        "choices": [{
+                            "index": 0, "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": text},
+                        }],
+                        "usage": {"prompt_tokens": len(content), "completion_tokens": len(text), "total_tokens": len(content) + len(text)},
+                    })
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path: {self.path}"}})
+
+        return Handler
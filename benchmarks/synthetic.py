@@ -0,0 +1,206 @@
+import os
+import random
+from typing import Dict, List
+
+import fitz
+
+
+# 架空の会社名 (実在の企業とは関係ない)
+COMPANIES = [
+    "あおば精機株式会社", "株式会社みなと商事", "ひかり化学工業株式会社", "株式会社さくら物流",
+    "つばさ電子株式会社", "株式会社はるか不動産", "こだま製薬株式会社", "株式会社いずみ食品",
+    "しらかば建設株式会社", "株式会社かなで通信", "ときわ繊維株式会社", "株式会社あさひ金融ホールディングス",
+]
+SEGMENTS = ["電子部品", "産業機械", "物流", "不動産", "金融サービス", "化学品", "医薬品", "食品"]
+TOPICS = ["人的資本", "脱炭素", "デジタル化", "サプライチェーン", "ガバナンス", "研究開発", "海外展開", "資本効率"]
+FILLERS = [
+    "当社グループは、持続的な成長と中長期的な企業価値の向上を目指しています。",
+    "事業環境の変化を踏まえ、経営資源の配分を継続的に見直しています。",
+    "ステークホルダーの皆様との対話を重視し、情報開示の充実に努めています。",
+    "中期経営計画の達成に向けて、全社一丸となって取り組みを進めています。",
+    "リスク管理体制を強化し、事業継続性の確保に取り組んでいます。",
+    "多様な人材が活躍できる職場環境の整備を推進しています。",
+    "環境負荷の低減に向けて、省エネルギー設備への投資を拡大しています。",
+    "取締役会の実効性評価を毎年実施し、課題の改善に取り組んでいます。",
+]
+YEARS = [2019, 2020, 2021, 2022, 2023]
+
+A4 = (595, 842)
+
+
+def generate_report(company: str, n_sections: int, rng: random.Random) -> Dict:
+    """
+    1社分の統合報告書の内容 (セクション、表、質問と回答) を生成する
+    """
+    sections = []
+    queries = []
+    for i in range(n_sections):
+        segment = rng.choice(SEGMENTS)
+        topic = rng.choice(TOPICS)
+        year = rng.choice(YEARS)
+        sales = rng.randint(1_000, 500_000)
+        ratio = rng.uniform(1, 25)
+        employees = rng.randint(100, 50_000)
+        facts = [
+            f"{company}の{year}年度の{segment}事業の売上高は{sales:,}百万円でした。",
+            f"{segment}事業では{topic}に注力し、営業利益率は{ratio:.1f}%となりました。",
+            f"{year}年度末の{segment}事業の従業員数は{employees:,}名です。",
+        ]
+        paragraphs = [
+            "".join(rng.sample(FILLERS, 3)) + facts[0],
+            facts[1] + "".join(rng.sample(FILLERS, 2)),
+            "".join(rng.sample(FILLERS, 2)) + facts[2],
+        ]
+        table = [["年度", "売上高 (百万円)", "営業利益率 (%)", "従業員数 (名)"]]
+        for table_year in YEARS:
+            table.append([
+                f"{table_year}年度", f"{rng.randint(1_000, 500_000):,}", f"{rng.uniform(1, 25):.1f}",
+                f"{rng.randint(100, 50_000):,}",
+            ])
+        sections.append({"title": f"{segment}事業と{topic}への取り組み ({i + 1})", "paragraphs": paragraphs, "table": table})
+        queries.extend([
+            {"company": company, "question": f"{company}の{year}年度の{segment}事業の売上高は何百万円ですか？", "answer": f"{sales:,}百万円"},
+            {"company": company, "question": f"{company}の{year}年度末の{segment}事業の従業員数は何名ですか？", "answer": f"{employees:,}名"},
+        ])
+    return {"company": company, "sections": sections, "queries": queries}
+
+def report_to_markdown(report: Dict) -> str:
+    """
+    報告書の内容をMarkdownに変換する (チャンク分割・検索のベンチマーク用)
+    """
+    lines = [f"# {report['company']} 統合報告書", ""]
+    for section in report["sections"]:
+        lines.extend([f"## {section['title']}", ""])
+        for paragraph in section["paragraphs"]:
+            lines.extend([paragraph, ""])
+        header, *rows = section["table"]
+        lines.append("| " + " | ".join(header) + " |")
+        lines.append("|" + " --- |" * len(header))
+        lines.extend("| " + " | ".join(row) + " |" for row in rows)
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _insert_text(page, rect, text, fontsize=9.5):
+    page.insert_textbox(fitz.Rect(rect), text, fontname="japan", fontsize=fontsize)
+
+def _draw_table(page, x0, y0, table, col_width, row_height=16, fontsize=8):
+    """
+    罫線付きの表を描画し、表の下端のy座標を返す
+    """
+    n_cols = len(table[0])
+    x1 = x0 + col_width * n_cols
+    for r, row in enumerate(table):
+        y = y0 + r * row_height
+        page.draw_line((x0, y), (x1, y), color=(0.3, 0.3, 0.3), width=0.5)
+        for c, cell in enumerate(row):
+            page.insert_text((x0 + c * col_width + 3, y + row_height - 4), cell, fontname="japan", fontsize=fontsize)
+    y1 = y0 + len(table) * row_height
+    page.draw_line((x0, y1), (x1, y1), color=(0.3, 0.3, 0.3), width=0.5)
+    for c in range(n_cols + 1):
+        page.draw_line((x0 + c * col_width, y0), (x0 + c * col_width, y1), color=(0.3, 0.3, 0.3), width=0.5)
+    return y1
+
+def _draw_bar_chart(page, rect, values, labels):
+    """
+    棒グラフ (ベクター描画) と軸ラベルを描画する
+    """
+    x0, y0, x1, y1 = rect
+    bar_width = (x1 - x0) / (len(values) * 1.5)
+    peak = max(values)
+    for i, (value, label) in enumerate(zip(values, labels)):
+        left = x0 + i * bar_width * 1.5
+        height = (y1 - y0 - 30) * value / peak
+        page.draw_rect(fitz.Rect(left, y1 - 15 - height, left + bar_width, y1 - 15), color=None, fill=(0.2, 0.4, 0.8))
+        page.insert_text((left, y1 - 3), label, fontname="japan", fontsize=7)
+        page.insert_text((left, y1 - 18 - height), f"{value:,}", fontname="helv", fontsize=7)
+
+def _column_page(doc, section, company):
+    page = doc.new_page(width=A4[0], height=A4[1])
+    page.insert_text((40, 50), section["title"], fontname="japan", fontsize=16)
+    paragraphs = section["paragraphs"] * 2
+    half = len(paragraphs) // 2
+    _insert_text(page, (40, 80, 290, 800), "\n\n".join(paragraphs[:half]))
+    _insert_text(page, (305, 80, 555, 800), "\n\n".join(paragraphs[half:]))
+    page.insert_text((40, 825), company, fontname="japan", fontsize=7)
+
+def _table_page(doc, section, company):
+    page = doc.new_page(width=A4[0], height=A4[1])
+    page.insert_text((40, 50), section["title"], fontname="japan", fontsize=16)
+    _insert_text(page, (40, 80, 555, 200), section["paragraphs"][0])
+    y = _draw_table(page, 40, 220, section["table"], col_width=128)
+    _insert_text(page, (40, y + 20, 555, y + 200), "\n\n".join(section["paragraphs"][1:]))
+    page.insert_text((40, 825), company, fontname="japan", fontsize=7)
+
+def _spread_page(doc, section, company):
+    """
+    見開き (A4横並び) のページ。中央に余白を設けて左右に分割できるようにする
+    """
+    page = doc.new_page(width=A4[0] * 2, height=A4[1])
+    page.insert_text((40, 50), section["title"], fontname="japan", fontsize=16)
+    _insert_text(page, (40, 80, 555, 400), "\n\n".join(section["paragraphs"]))
+    _draw_table(page, 40, 420, section["table"], col_width=128)
+    right = A4[0]
+    page.insert_text((right + 40, 50), f"{section['title']} (続き)", fontname="japan", fontsize=16)
+    _insert_text(page, (right + 40, 80, right + 555, 800), "\n\n".join(reversed(section["paragraphs"])))
+    page.insert_text((40, 825), company, fontname="japan", fontsize=7)
+
+def _figure_page(doc, section, company):
+    page = doc.new_page(width=A4[0], height=A4[1])
+    page.insert_text((40, 50), section["title"], fontname="japan", fontsize=16)
+    rows = section["table"][1:]
+    values = [int(row[1].replace(",", "")) for row in rows]
+    _draw_bar_chart(page, (60, 90, 535, 420), values, [row[0] for row in rows])
+    _insert_text(page, (40, 440, 555, 800), "\n\n".join(section["paragraphs"]))
+    page.insert_text((40, 825), company, fontname="japan", fontsize=7)
+
+PAGE_LAYOUTS = (_column_page, _table_page, _spread_page, _figure_page)
+
+
+def report_to_pdf(report: Dict, path: str, n_pages: int) -> None:
+    """
+    報告書の内容から、段組み・罫線付きの表・見開き・グラフのページを順に並べたPDFを生成する
+    """
+    doc = fitz.open()
+    sections = report["sections"]
+    for i in range(n_pages):
+        PAGE_LAYOUTS[i % len(PAGE_LAYOUTS)](doc, sections[i % len(sections)], report["company"])
+    doc.save(path)
+    doc.close()
+
+def generate_corpus(output_dir: str, n_reports: int = 4, pages_per_report: int = 8, seed: int = 0) -> Dict[str, List]:
+    """
+    ベンチマーク用の合成データ (PDF、Markdown、質問と回答) を生成する
+
+    Args:
+        output_dir (str): 出力先のディレクトリ (pdfs/ と markdowns/ を作成する)
+        n_reports (int): 報告書 (会社) の数
+        pages_per_report (int): 報告書あたりのPDFのページ数
+        seed (int): 乱数のシード
+
+    Returns:
+        dict: "pdfs" (PDFのパス), "markdowns" (Markdownのパス), "queries" (質問と回答のdict) のリスト
+    """
+    rng = random.Random(seed)
+    pdf_dir = os.path.join(output_dir, "pdfs")
+    markdown_dir = os.path.join(output_dir, "markdowns")
+    os.makedirs(pdf_dir, exist_ok=True)
+    os.makedirs(markdown_dir, exist_ok=True)
+
+    corpus = {"pdfs": [], "markdowns": [], "queries": []}
+    for i in range(n_reports):
+        company = COMPANIES[i % len(COMPANIES)]
+        if i >= len(COMPANIES):
+            company = f"{company}{i // len(COMPANIES) + 1}"
+        report = generate_report(company, n_sections=max(2, pages_per_report // 2), rng=rng)
+
+        pdf_path = os.path.join(pdf_dir, f"{i + 1}_{seed}.pdf")
+        report_to_pdf(report, pdf_path, pages_per_report)
+        markdown_path = os.path.join(markdown_dir, f"{company}.md")
+        with open(markdown_path, "w", encoding="utf-8") as f:
+            f.write(report_to_markdown(report))
+
+        corpus["pdfs"].append(pdf_path)
+        corpus["markdowns"].append(markdown_path)
+        corpus["queries"].extend(report["queries"])
+    return corpus
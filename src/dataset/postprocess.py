@@ -1,5 +1,16 @@
 import os
-import re
+import json
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from ..tools.cache import hash_parts
+from ..tools.text_clean import filter_markdown_lines
+
+# フィルタの処理内容を変更した場合に更新する (出力済みファイルを処理し直す)
+FILTER_VERSION = "1"
+MANIFEST_NAME = ".postprocess_manifest.json"
+
 
 def process_markdown_file(input_file: str, line_target_words: list, header_keywords: list, output_dir: str) -> None:
     """
@@ -13,87 +24,118 @@ def process_markdown_file(input_file: str, line_target_words: list, header_keywo
     3. ページ数表記削除フィルタ:
         - 行に "P.数字"（例: P.1）の表記が含まれている場合、その行は除外
 
+    ファイルは1行ずつ読み込んで処理し、一時ファイルに書き出してから出力先に差し替える
+    改行形式 (CRLF, LF, CR) は入力ファイルの最初の行の形式に合わせる
+
     Parameters:
         input_file (str): 入力Markdownファイルのパス
-        output_file (str): 出力先Markdownファイルのパス
         line_target_words (list): 行単位で削除対象とするワードのリスト
         header_keywords (list): ヘッダー行に対して削除対象とするキーワードのリスト
                                 ヘッダーにこれらのキーワードが含まれる場合、そのヘッダーから次のヘッダーまでを削除
+        output_dir (str): 出力先のディレクトリ
     """
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, os.path.basename(input_file))
+    tmp_file = f"{output_file}.tmp"
 
-    def clean_text(line):
-        line = re.sub(r'\n{3,}', '\n\n', line)
-        line = re.sub(r' +', ' ', line)
-        line = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', line)
-        return line.strip()
-
-    with open(input_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-
-    # 元の改行形式を検出する（CRLF, LF, CR のいずれか）
-    if '\r\n' in content:
-        newline_char = '\r\n'
-    elif '\r' in content:
-        newline_char = '\r'
-    elif '\n' in content:
-        newline_char = '\n'
-    else:
-        newline_char = os.linesep
-
-    # 改行文字を除いた各行のリストを取得する
-    lines = content.splitlines()
-
-
-    output_lines = []
-    skip_section = False  # ヘッダーにより削除対象セクション内かどうかのフラグ
-
-    for line in lines:
-        # ページ数表記の削除: 例 "P.1", "P.2", … を含む行はスキップ
-        if re.search(r'P\.\d+', line):
-            continue
-
-        line = clean_text(line)
-
-        # Markdown のヘッダー行かどうかをチェック（行頭の空白を除いて '#' で始まるか）
-        if line.lstrip().startswith('#'):
-            if skip_section:
-                # 現在、削除対象のセクション内の場合
-                if any(keyword in line for keyword in header_keywords):
-                    # 新たなヘッダーも削除対象なら、そのヘッダー行自体も出力しない
-                    continue
-                else:
-                    # 新たなヘッダーが削除対象でなければ、削除対象セクションを終了
-                    skip_section = False
-                    # ヘッダー行自体が行削除対象ワードを含むかチェック
-                    if any(word in line for word in line_target_words):
-                        continue
-                    else:
-                        output_lines.append(line)
-            else:
-                # 現在、削除対象セクション外の場合
-                if any(keyword in line for keyword in header_keywords):
-                    # このヘッダー行が削除対象の場合、以降のセクションを除外開始
-                    skip_section = True
-                    continue
-                else:
-                    if any(word in line for word in line_target_words):
-                        continue
-                    else:
-                        output_lines.append(line)
-        else:
-            # ヘッダー行でない通常の行の場合
-            if skip_section:
-                # 現在、削除対象セクション内なら出力しない
-                continue
-            else:
-                if any(word in line for word in line_target_words):
-                    continue
-                else:
-                    output_lines.append(line)
-
-    # 検出した改行形式を使って再度内容を構築する
-    new_content = newline_char.join(output_lines) + newline_char
+    newline_char = None
+
+    def iter_lines(f):
+        nonlocal newline_char
+        for raw_line in f:
+            line = raw_line.rstrip("\r\n")
+            if newline_char is None and len(line) != len(raw_line):
+                newline_char = raw_line[len(line):]
+            yield line
+
+    with open(input_file, "r", encoding="utf-8", newline="") as src, \
+            open(tmp_file, "w", encoding="utf-8", newline="") as dst:
+        written = 0
+        for line in filter_markdown_lines(iter_lines(src), line_target_words, header_keywords):
+            dst.write(line + (newline_char or os.linesep))
+            written += 1
+        if not written:
+            dst.write(newline_char or os.linesep)
+    os.replace(tmp_file, output_file)
+
+def _process_markdown_task(args) -> str:
+    """
+    プロセスプールのワーカーで1ファイルを処理
+    """
+    input_file, line_target_words, header_keywords, output_dir = args
+    process_markdown_file(input_file, line_target_words, header_keywords, output_dir)
+    return os.path.basename(input_file)
+
+def _file_signature(path: str) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def process_markdown_dir(
+        input_dir: str,
+        output_dir: str,
+        line_target_words: list,
+        header_keywords: list,
+        pattern: str = "*.md",
+        num_workers: Optional[int] = None,
+        force: bool = False
+        ) -> Dict[str, int]:
+    """
+    ディレクトリ内のMarkdownファイルにprocess_markdown_fileのフィルタを適用する
+
+    出力済みのファイルは、入力ファイル (サイズと更新時刻) とフィルタの設定が前回から変わっていなければ処理しない
+    処理状況はoutput_dir内のマニフェストに記録する
 
+    Args:
+        input_dir (str): 入力Markdownファイルのディレクトリ
+        output_dir (str): 出力先のディレクトリ
+        line_target_words (list): 行単位で削除対象とするワードのリスト
+        header_keywords (list): ヘッダー行に対して削除対象とするキーワードのリスト
+        pattern (str): 対象ファイルのパターン
+        num_workers (int): 並列処理するプロセス数 (Noneの場合はCPU数、1の場合は逐次処理)
+        force (bool): 出力済みのファイルも処理し直すか
+
+    Returns:
+        dict: 処理したファイル数 ("processed") と処理を省略したファイル数 ("skipped")
+    """
     os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, os.path.basename(input_file)), 'w', encoding='utf-8', newline='') as f:
-        f.writelines(new_content)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    config = hash_parts(
+        FILTER_VERSION,
+        json.dumps([list(line_target_words), list(header_keywords)], ensure_ascii=False)
+        )
+
+    manifest = {"config": config, "files": {}}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("config") == config:
+            manifest["files"] = saved.get("files", {})
+
+    input_files = sorted(glob(os.path.join(input_dir, pattern)))
+    signatures = {os.path.basename(path): _file_signature(path) for path in input_files}
+    tasks = [
+        (path, line_target_words, header_keywords, output_dir)
+        for path in input_files
+        if manifest["files"].get(os.path.basename(path)) != signatures[os.path.basename(path)]
+        or not os.path.exists(os.path.join(output_dir, os.path.basename(path)))
+    ]
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers <= 1 or len(tasks) <= 1:
+        processed = [_process_markdown_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(tasks))) as executor:
+            processed = list(executor.map(_process_markdown_task, tasks, chunksize=4))
+
+    for name in processed:
+        manifest["files"][name] = signatures[name]
+    # 入力ディレクトリから削除されたファイルの記録は残さない
+    manifest["files"] = {name: sig for name, sig in manifest["files"].items() if name in signatures}
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+    return {"processed": len(processed), "skipped": len(input_files) - len(processed)}
@@ -1,12 +1,21 @@
 import os
 import re
-from pdf2image import convert_from_path
+import math
+import bisect
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import cv2
 
 import fitz
 
+from ..tools.image_encode import IMAGE_FORMATS, encode_image_array, fit_scale
+from ..tools.metrics import get_metrics
+
+
+# スパン内で列の区切りとみなす空白 (3文字以上の連続する空白またはタブ)
+_SPAN_COLUMN_GAP = re.compile(r'\S(?:[ \u3000]{3,}|\t)\s*\S')
+
 
 def analyze_page(image):
     """
@@ -36,7 +45,44 @@ def analyze_page(image):
 
     return False
 
-def split_and_save_pdf(pdf_path, output_pdf_path):
+def pixmap_to_rgb(pix):
+    """
+    fitz.Pixmapをnumpy配列 (RGB) に変換
+    """
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape((pix.height, pix.width, pix.n))
+
+    if pix.n - pix.alpha == 3:
+        img = img[:, :, :3]
+    elif pix.n - pix.alpha == 1:
+        img = cv2.cvtColor(img[:, :, :1], cv2.COLOR_GRAY2RGB)
+    else:
+        raise ValueError(f"Unsupported number of color channels: {pix.n - pix.alpha}")
+
+    return img
+
+def get_split_rects(page, thumb_dpi=72):
+    """
+    低解像度のサムネイルで分割判定を行い、ページの切り出し領域を返す
+
+    Args:
+        page (fitz.Page): 対象ページ
+        thumb_dpi (int): 分割判定に用いるサムネイルの解像度
+
+    Returns:
+        list: 切り出し領域 (fitz.Rect) のリスト。分割する場合は左右の2領域、しない場合はページ全体
+    """
+    pix = page.get_pixmap(dpi=thumb_dpi)
+    if not analyze_page(pixmap_to_rgb(pix)):
+        return [page.rect]
+
+    rect = page.rect
+    middle = rect.x0 + rect.width / 2
+    return [
+        fitz.Rect(rect.x0, rect.y0, middle, rect.y1),
+        fitz.Rect(middle, rect.y0, rect.x1, rect.y1),
+    ]
+
+def split_and_save_pdf(pdf_path, output_pdf_path, thumb_dpi=72):
     """
     PDFを左右に分割して保存
     """
@@ -45,39 +91,44 @@ def split_and_save_pdf(pdf_path, output_pdf_path):
 
     for page_num in range(len(doc)):
         page = doc[page_num]
-        pix = page.get_pixmap()
+        for rect in get_split_rects(page, thumb_dpi):
+            new_page = new_pdf.new_page(width=rect.width, height=rect.height)
+            new_page.show_pdf_page(new_page.rect, doc, page_num, clip=rect)
 
-        if pix.alpha:
-            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape((pix.height, pix.width, pix.n))
-        else:
-            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape((pix.height, pix.width, pix.n))
-
-        if pix.n - pix.alpha == 3:
-            pass
-        elif pix.n - pix.alpha == 1:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-        else:
-            raise ValueError(f"Unsupported number of color channels: {pix.n - pix.alpha}")
-
-        if analyze_page(img):
-            # print(f"Page {page_num + 1}: Splitting...")
-            width, height = pix.width, pix.height
-
-            left_rect = fitz.Rect(0, 0, width // 2, height)
-            right_rect = fitz.Rect(width // 2, 0, width, height)
+    new_pdf.save(output_pdf_path)
+    new_pdf.close()
+    doc.close()
 
-            left_page = new_pdf.new_page(width=width // 2, height=height)
-            left_page.show_pdf_page(left_page.rect, doc, page_num, clip=left_rect)
+def _merge_tables(blocks, tables_info):
+    """
+    表情報をブロックの列に挿入する
 
-            right_page = new_pdf.new_page(width=width // 2, height=height)
-            right_page.show_pdf_page(right_page.rect, doc, page_num, clip=right_rect)
-        else:
-            # print(f"Page {page_num + 1}: Keeping as is.")
-            new_page = new_pdf.new_page(width=page.rect.width, height=page.rect.height)
-            new_page.show_pdf_page(new_page.rect, doc, page_num)
+    各表は、上端 (y0) が表の下端より下にある最初のブロックの直前に挿入する (該当するブロックがない場合は末尾)
+    ブロックの上端の累積最大値は単調増加となるため、挿入位置は二分探索で求める
+    同じ位置に挿入する表は検出順に並べる
+    """
+    if not tables_info:
+        return blocks
 
-    new_pdf.save(output_pdf_path)
-    new_pdf.close()
+    prefix_max_y0 = []
+    current = -float('inf')
+    for block in blocks:
+        current = max(current, block["bbox"][1])
+        prefix_max_y0.append(current)
+
+    tables_by_position = {}
+    for table_info in tables_info:
+        position = bisect.bisect_right(prefix_max_y0, table_info["bbox"][3])
+        tables_by_position.setdefault(position, []).append(
+            {"type": "table", "bbox": table_info["bbox"], "data": table_info["data"]}
+        )
+
+    merged = []
+    for i, block in enumerate(blocks):
+        merged.extend(tables_by_position.get(i, ()))
+        merged.append(block)
+    merged.extend(tables_by_position.get(len(blocks), ()))
+    return merged
 
 def combine_text_information(blocks, raw_text, words, tables_info):
     """
@@ -95,26 +146,12 @@ def combine_text_information(blocks, raw_text, words, tables_info):
     """
     # 1. blocksが信頼できる場合は、それをベースにする
     if blocks and len(blocks) > 0 and blocks[0]['type'] == 0:
-        # blocks内にtables_infoを挿入
-        for table_info in reversed(tables_info):
-            table_bbox = table_info["bbox"]
-            inserted = False
-            for i, block in enumerate(blocks):
-                block_bbox = block["bbox"]
-                if block_bbox[1] > table_bbox[3]:
-                    blocks.insert(i, {"type": "table", "bbox": table_bbox, "data": table_info["data"]})
-                    inserted = True
-                    break
-            if not inserted:
-                blocks.append({"type": "table", "bbox": table_bbox, "data": table_info["data"]})
-
-        return blocks
+        return _merge_tables(blocks, tables_info)
 
     # 2. blocksが空または不完全な場合、raw_textをベースにwordsで情報を補完
     if not raw_text:
         return []
 
-    combined_blocks = []
     current_block = {"number": 0, "type": 0, "bbox": None, "lines": []}
     current_line = {"spans": [], "wmode": 0, "dir": (1.0, 0.0), "bbox": None}
     x0, y0, x1, y1 = float('inf'), float('inf'), -float('inf'), -float('inf')
@@ -138,161 +175,295 @@ def combine_text_information(blocks, raw_text, words, tables_info):
     current_line["bbox"] = (x0, y0, x1, y1)
     current_block["lines"].append(current_line)
     current_block["bbox"] = (x0, y0, x1, y1)
-    combined_blocks.append(current_block)
-
-    # blocks内にtables_infoを挿入
-    for table_info in reversed(tables_info):
-        table_bbox = table_info["bbox"]
-        inserted = False
-        for i, block in enumerate(combined_blocks):
-            block_bbox = block["bbox"]
-            if block_bbox[1] > table_bbox[3]:  # ブロックの下端がテーブルの下端より下にある場合
-                combined_blocks.insert(i, {"type": "table", "bbox": table_bbox, "data": table_info["data"]})
-                inserted = True
-                break
-        if not inserted:
-            combined_blocks.append({"type": "table", "bbox": table_bbox, "data": table_info["data"]})
-
-    return combined_blocks
-
-def pdf_to_blocks_and_png(pdf_path, output_folder):
-    """
-    PDFをページごとにPNG画像に変換し、構造化されたテキスト情報（ブロック単位）を抽出
 
-    Args:
-        pdf_path (str): PDFファイルのパス
-        output_folder (str): 出力フォルダのパス
+    return _merge_tables([current_block], tables_info)
 
-    Returns:
-        list: ページごとのテキストブロック情報 (表情報含)
-        list: PNG画像のパスのリスト
+def _translate_blocks(blocks, dx, dy):
     """
-    os.makedirs(output_folder, exist_ok=True)
-    images = convert_from_path(pdf_path, dpi=300)
-    document = fitz.open(pdf_path)
+    ブロック情報の座標を切り出し領域の原点基準に平行移動
+    """
+    def shift(bbox):
+        x0, y0, x1, y1 = bbox
+        return (x0 - dx, y0 - dy, x1 - dx, y1 - dy)
+
+    for block in blocks:
+        block["bbox"] = shift(block["bbox"])
+        for line in block.get("lines", []):
+            line["bbox"] = shift(line["bbox"])
+            for span in line["spans"]:
+                span["bbox"] = shift(span["bbox"])
+                if "origin" in span:
+                    span["origin"] = (span["origin"][0] - dx, span["origin"][1] - dy)
+    return blocks
+
+def has_table_candidate(blocks, min_rows=3):
+    """
+    表が含まれる可能性があるかを、抽出済みのテキストブロックから簡易に判定する (find_tablesの事前判定)
 
-    pages_blocks = []
-    image_paths = []
+    同じ高さ (ベースライン) に、文字サイズ以上の間隔を空けて複数のテキスト片が並ぶ「複数列の行」が
+    min_rows行以上ある場合に表の候補ありとする
+    MuPDFは表の1行を複数のスパンを持つ1つのテキスト行 (または空白で区切られた1つのスパン) にまとめることがあるため、
+    テキスト行単位ではなくスパン単位で間隔を判定し、スパン内の連続する空白・タブも列の区切りとみなす
+    """
+    rows = {}
+    split_rows = set()
+    for block in blocks:
+        if block.get("type") != 0:
+            continue
+        for line in block["lines"]:
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            if not spans:
+                continue
+            size = max(span["size"] for span in spans) or 1.0
+            baseline = spans[0].get("origin", (0, line["bbox"][3]))[1]
+            key = round(baseline / 2)
+            rows.setdefault(key, []).extend((span["bbox"][0], span["bbox"][2], size) for span in spans)
+            if any(_SPAN_COLUMN_GAP.search(span["text"]) for span in spans):
+                split_rows.add(key)
+
+    multi_column_rows = 0
+    for key, segments in rows.items():
+        segments.sort()
+        if key in split_rows or any(
+                next_x0 - x1 >= size for (_, x1, size), (next_x0, _, _) in zip(segments, segments[1:])
+                ):
+            multi_column_rows += 1
+            if multi_column_rows >= min_rows:
+                return True
+    return False
 
-    for i, image in enumerate(images):
-        page = document[i]
+def extract_page_blocks(page, clip=None, table_precheck=True):
+    """
+    1ページ分の構造化されたテキスト情報（ブロック単位）を抽出
 
-        # 複数の方法でテキスト情報を取得
-        blocks = page.get_text("dict")["blocks"]
-        raw_text = page.get_text("text")
-        words = page.get_text("words")
+    テキストの解析 (TextPageの生成) はページごとに1回のみ行い、ブロック・テキスト・単語を同じTextPageから取得する
+    テキストと単語はブロックが取得できない場合の補完にのみ用いるため、その場合にのみ取得する
+
+    Args:
+        page (fitz.Page): 対象ページ
+        clip (fitz.Rect): 抽出対象とする領域 (Noneの場合はページ全体)
+                          座標は切り出し領域の左上を原点として返す
+        table_precheck (bool): 表の候補がないページでは表の検出 (find_tables) を省略するかどうか
 
-        # 表情報を取得
-        tables_info = []
-        tables = page.find_tables(strategy='text')
+    Returns:
+        list: テキストブロック情報 (表情報含)
+    """
+    # get_text("dict")と同じフラグでTextPageを1回だけ生成
+    textpage = page.get_textpage(clip=clip, flags=fitz.TEXTFLAGS_DICT)
+    blocks = textpage.extractDICT()["blocks"]
+    raw_text = ""
+    words = []
+    if not blocks or blocks[0]["type"] != 0:
+        raw_text = textpage.extractText()
+        words = textpage.extractWORDS()
+
+    # 表情報を取得
+    tables_info = []
+    if not table_precheck or has_table_candidate(blocks):
+        tables = page.find_tables(clip=clip, strategy='text')
         if tables.tables:
             for table in tables.tables:
                 table_info = table.extract()
                 tables_info.append({"bbox": table.bbox, "data": table_info})
 
-        # テキスト情報を組み合わせて補完 (表情報も一緒に)
-        combined_text_info = combine_text_information(blocks, raw_text, words, tables_info)
-        pages_blocks.append(combined_text_info)
-
-        image_path = f"{output_folder}/page_{i+1:03}.png"
-        image.save(image_path, "PNG")
-        image_paths.append(image_path)
-
-    return pages_blocks, image_paths
-
-def process_markdown_file(input_file: str, line_target_words: list, header_keywords: list, output_dir: str) -> None:
-    """
-    Markdownファイルを読み込み、フィルタを適用して出力
-
-    1. 行削除フィルタ:
-        - 各行に対し、line_target_words のいずれかのワードが含まれている場合、その行は除外
-    2. セクション削除フィルタ:
-        - 行頭が '#' のヘッダー行に対し、header_keywords のいずれかが含まれる場合、
-        そのヘッダー行から次のヘッダー行が現れるまでのすべての行（ヘッダー行自体も含む）を除外
-    3. ページ数表記削除フィルタ:
-        - 行に "P.数字"（例: P.1）の表記が含まれている場合、その行は除外
-
-    Parameters:
-        input_file (str): 入力Markdownファイルのパス
-        output_file (str): 出力先Markdownファイルのパス
-        line_target_words (list): 行単位で削除対象とするワードのリスト
-        header_keywords (list): ヘッダー行に対して削除対象とするキーワードのリスト
-                                ヘッダーにこれらのキーワードが含まれる場合、そのヘッダーから次のヘッダーまでを削除
+    # 分割ページの場合、座標を分割後のページ基準に揃える
+    if clip is not None and (clip.x0 != 0 or clip.y0 != 0):
+        _translate_blocks(blocks, clip.x0, clip.y0)
+        words = [
+            (x0 - clip.x0, y0 - clip.y0, x1 - clip.x0, y1 - clip.y0, *rest)
+            for x0, y0, x1, y1, *rest in words
+        ]
+        for table_info in tables_info:
+            x0, y0, x1, y1 = table_info["bbox"]
+            table_info["bbox"] = (x0 - clip.x0, y0 - clip.y0, x1 - clip.x0, y1 - clip.y0)
+
+    # テキスト情報を組み合わせて補完 (表情報も一緒に)
+    return combine_text_information(blocks, raw_text, words, tables_info)
+
+def iter_blocks_and_png(
+        pdf_path,
+        output_folder,
+        first_page=1,
+        last_page=None,
+        dpi=300,
+        split=False,
+        thumb_dpi=72,
+        image_format="png",
+        quality=85,
+        max_long_side=None,
+        max_short_side=None,
+        save_images=True
+        ):
     """
+    PDFを1ページずつ画像に変換し、テキスト情報の抽出と画像のエンコードを逐次実施するジェネレータ
+    メモリ上に保持する画像は常に1ページ分のみのため、ページ数によらずメモリ使用量が一定となる
 
-    def clean_text(line):
-        line = re.sub(r'\n{3,}', '\n\n', line)
-        line = re.sub(r' +', ' ', line)
-        line = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', line)
-        return line.strip()
-
-    with open(input_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-
-    # 元の改行形式を検出する（CRLF, LF, CR のいずれか）
-    if '\r\n' in content:
-        newline_char = '\r\n'
-    elif '\r' in content:
-        newline_char = '\r'
-    elif '\n' in content:
-        newline_char = '\n'
-    else:
-        newline_char = os.linesep
-
-    # 改行文字を除いた各行のリストを取得する
-    lines = content.splitlines()
-
+    split=Trueの場合、低解像度のサムネイルで分割判定を行った上で、
+    高解像度で1度だけ描画した画像から左右の領域を切り出して保存する
+    (中間の分割PDFは作成しない)
 
-    output_lines = []
-    skip_section = False  # ヘッダーにより削除対象セクション内かどうかのフラグ
+    max_long_side/max_short_sideを指定した場合、画像 (分割時は切り出し後) がその解像度に収まるよう
+    描画時の解像度を下げる (モデルの実効解像度はtools.image_encode.MODEL_MAX_LONG_SIDE/MODEL_MAX_SHORT_SIDE)
+    save_images=Falseの場合、画像はファイルに保存せず、メモリ上でエンコードしたEncodedImageを返す
+    分割判定 (split)・描画 (draw)・テキスト抽出 (blocks)・エンコード (encode) の時間はページごとにtools.metricsに記録する
 
-    for line in lines:
-        # ページ数表記の削除: 例 "P.1", "P.2", … を含む行はスキップ
-        if re.search(r'P\.\d+', line):
-            continue
-
-        line = clean_text(line)
-
-        # Markdown のヘッダー行かどうかをチェック（行頭の空白を除いて '#' で始まるか）
-        if line.lstrip().startswith('#'):
-            if skip_section:
-                # 現在、削除対象のセクション内の場合
-                if any(keyword in line for keyword in header_keywords):
-                    # 新たなヘッダーも削除対象なら、そのヘッダー行自体も出力しない
-                    continue
-                else:
-                    # 新たなヘッダーが削除対象でなければ、削除対象セクションを終了
-                    skip_section = False
-                    # ヘッダー行自体が行削除対象ワードを含むかチェック
-                    if any(word in line for word in line_target_words):
-                        continue
-                    else:
-                        output_lines.append(line)
+    Args:
+        pdf_path (str): PDFファイルのパス
+        output_folder (str): 出力フォルダのパス (save_images=Falseの場合は不要)
+        first_page (int): 処理を開始するページ番号 (1始まり)
+        last_page (int): 処理を終了するページ番号 (1始まり、Noneの場合は最終ページ)
+        dpi (int): 画像変換時の解像度
+        split (bool): 中心で分割できそうなページを左右に分割するかどうか
+        thumb_dpi (int): 分割判定に用いるサムネイルの解像度
+        image_format (str): 画像の形式 ("png", "jpeg", "webp")
+        quality (int): JPEG/WebPの品質
+        max_long_side (int): 画像の長辺の上限 (Noneの場合は制限しない)
+        max_short_side (int): 画像の短辺の上限 (Noneの場合は制限しない)
+        save_images (bool): 画像をファイルに保存するかどうか
+
+    Yields:
+        tuple: (元PDFのページ番号 (1始まり), テキストブロック情報 (表情報含), 画像のパスまたはEncodedImage)
+               分割したページは左、右の順に2回yieldされる
+    """
+    if save_images:
+        os.makedirs(output_folder, exist_ok=True)
+    extension = IMAGE_FORMATS[image_format][0]
+    metrics = get_metrics()
+    document_name = os.path.basename(pdf_path)
+    document = fitz.open(pdf_path)
+    if last_page is None:
+        last_page = len(document)
+
+    try:
+        for page_num in range(first_page, last_page + 1):
+            page = document[page_num - 1]
+            if split:
+                with metrics.timer("split", document=document_name, page=page_num):
+                    rects = get_split_rects(page, thumb_dpi)
             else:
-                # 現在、削除対象セクション外の場合
-                if any(keyword in line for keyword in header_keywords):
-                    # このヘッダー行が削除対象の場合、以降のセクションを除外開始
-                    skip_section = True
-                    continue  # ヘッダー行自体は出力しない
+                rects = [page.rect]
+
+            # 上限の解像度を超えないよう、最も大きい切り出し領域に合わせて描画時の解像度を下げる
+            zoom = dpi / 72
+            zoom *= min(
+                fit_scale(rect.width * zoom, rect.height * zoom, max_long_side, max_short_side)
+                for rect in rects
+            )
+            with metrics.timer("draw", document=document_name, page=page_num):
+                image = pixmap_to_rgb(page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)))
+            for part, rect in enumerate(rects, start=1):
+                clip = rect if len(rects) > 1 else None
+                with metrics.timer("blocks", document=document_name, page=page_num, part=part):
+                    blocks = extract_page_blocks(page, clip=clip)
+
+                if clip is None:
+                    crop = image
+                    name = f"page_{page_num:03}"
                 else:
-                    if any(word in line for word in line_target_words):
-                        continue
-                    else:
-                        output_lines.append(line)
-        else:
-            # ヘッダー行でない通常の行の場合
-            if skip_section:
-                # 現在、削除対象セクション内なら出力しない
-                continue
-            else:
-                if any(word in line for word in line_target_words):
-                    continue
+                    x0 = round((rect.x0 - page.rect.x0) * zoom)
+                    x1 = round((rect.x1 - page.rect.x0) * zoom)
+                    crop = image[:, x0:x1]
+                    name = f"page_{page_num:03}_{part}"
+                with metrics.timer("encode", document=document_name, page=page_num, part=part) as trace:
+                    encoded = encode_image_array(
+                        crop, image_format, quality, max_long_side, max_short_side
+                        )
+                    trace["bytes"] = encoded.nbytes
+                    if save_images:
+                        image_path = f"{output_folder}/{name}{extension}"
+                        with open(image_path, "wb") as f:
+                            f.write(encoded.data)
+
+                if save_images:
+                    yield page_num, blocks, image_path
                 else:
-                    output_lines.append(line)
+                    yield page_num, blocks, encoded
+            del image
+    finally:
+        document.close()
 
-    # 検出した改行形式を使って再度内容を構築する
-    new_content = newline_char.join(output_lines) + newline_char
+def _process_page_range(args):
+    """
+    プロセスプールのワーカーで指定範囲のページを処理
+    """
+    pdf_path, output_folder, first_page, last_page, kwargs = args
+    return [
+        (blocks, image)
+        for _, blocks, image in iter_blocks_and_png(
+            pdf_path, output_folder, first_page, last_page, **kwargs
+            )
+    ]
+
+def pdf_to_blocks_and_png(
+        pdf_path,
+        output_folder,
+        num_workers=1,
+        pages_per_task=None,
+        dpi=300,
+        split=False,
+        thumb_dpi=72,
+        image_format="png",
+        quality=85,
+        max_long_side=None,
+        max_short_side=None,
+        save_images=True
+        ):
+    """
+    PDFをページごとに画像に変換し、構造化されたテキスト情報（ブロック単位）を抽出
+    ページは1枚ずつ描画・抽出・エンコードされるため、メモリ上に全ページの描画結果を保持しない
+    split=Trueの場合、分割判定と左右の切り出しを同時に行う (split_and_save_pdfによる事前分割は不要)
 
-    os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, os.path.basename(input_file)), 'w', encoding='utf-8', newline='') as f:
-        f.writelines(new_content)
+    Args:
+        pdf_path (str): PDFファイルのパス
+        output_folder (str): 出力フォルダのパス (save_images=Falseの場合は不要)
+        num_workers (int): 並列処理するプロセス数 (1の場合は逐次処理)
+        pages_per_task (int): 1タスクあたりに割り当てるページ数 (Noneの場合は自動で決定)
+        dpi (int): 画像変換時の解像度
+        split (bool): 中心で分割できそうなページを左右に分割するかどうか
+        thumb_dpi (int): 分割判定に用いるサムネイルの解像度
+        image_format (str): 画像の形式 ("png", "jpeg", "webp")
+        quality (int): JPEG/WebPの品質
+        max_long_side (int): 画像の長辺の上限 (Noneの場合は制限しない)
+        max_short_side (int): 画像の短辺の上限 (Noneの場合は制限しない)
+        save_images (bool): 画像をファイルに保存するかどうか (Falseの場合はEncodedImageを返す)
+
+    Returns:
+        list: ページごとのテキストブロック情報 (表情報含)
+        list: 画像のパス (save_images=Falseの場合はEncodedImage) のリスト
+    """
+    pages_blocks = []
+    image_paths = []
+    kwargs = {
+        "dpi": dpi, "split": split, "thumb_dpi": thumb_dpi,
+        "image_format": image_format, "quality": quality,
+        "max_long_side": max_long_side, "max_short_side": max_short_side,
+        "save_images": save_images,
+    }
+
+    if num_workers <= 1:
+        for _, blocks, image in iter_blocks_and_png(pdf_path, output_folder, **kwargs):
+            pages_blocks.append(blocks)
+            image_paths.append(image)
+        return pages_blocks, image_paths
+
+    if save_images:
+        os.makedirs(output_folder, exist_ok=True)
+    with fitz.open(pdf_path) as document:
+        page_count = len(document)
+
+    # ワーカー間の負荷が偏らないよう、ワーカー数より多めのページ範囲に分割する
+    if pages_per_task is None:
+        pages_per_task = max(1, math.ceil(page_count / (num_workers * 4)))
+    tasks = [
+        (pdf_path, output_folder, start, min(start + pages_per_task - 1, page_count), kwargs)
+        for start in range(1, page_count + 1, pages_per_task)
+    ]
+
+    # executor.mapは投入順に結果を返すため、ページ順序は保たれる
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for results in executor.map(_process_page_range, tasks):
+            for blocks, image in results:
+                pages_blocks.append(blocks)
+                image_paths.append(image)
+
+    return pages_blocks, image_paths
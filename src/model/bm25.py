@@ -0,0 +1,310 @@
+import json
+import os
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from ..tools.tokenizer import preprocess_func, tokenize
+
+
+class SparseBM25Index:
+    """
+    CSR形式の単語-文書行列によるBM25 (Okapi) インデックス
+
+    ・単語ごとのBM25の重みを事前計算した (単語数, 文書数) のCSR行列を保持し、
+      クエリのスコアは該当する単語の行の和としてベクトル演算で求める
+    ・上位k件はnp.argpartitionで選択する
+    ・文書の追加/削除は単語頻度行列を更新し、重みは次の検索時に再計算する
+    ・save/loadでディスクに保存でき、読み込み時はnumpyのメモリマップを利用する
+    ・スコアの定義はrank_bm25.BM25Okapiと同一 (負のidfはepsilon * 平均idfに置き換え)
+    """
+
+    _ARRAYS = ("tf_data", "tf_indices", "tf_indptr", "w_data", "w_indices", "w_indptr", "doc_len")
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocab: Dict[str, int] = {}
+        self.doc_ids: List[str] = []
+        # (文書数, 単語数) の単語頻度行列
+        self._tf = sp.csr_matrix((0, 0), dtype=np.float32)
+        self._doc_len = np.zeros(0, dtype=np.float32)
+        # (単語数, 文書数) のBM25重み行列 (文書の追加/削除後は None)
+        self._weights: Optional[sp.csr_matrix] = None
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def from_tokens(cls, doc_ids: Sequence[str], docs_tokens: Iterable[List[str]], **kwargs) -> "SparseBM25Index":
+        index = cls(**kwargs)
+        index.add(doc_ids, docs_tokens)
+        return index
+
+    def add(self, doc_ids: Sequence[str], docs_tokens: Iterable[List[str]]) -> None:
+        """
+        分かち書き済みの文書を追加する
+        """
+        indptr, indices, data, lengths = [0], [], [], []
+        for tokens in docs_tokens:
+            counts = Counter(tokens)
+            for token, count in counts.items():
+                term_id = self.vocab.setdefault(token, len(self.vocab))
+                indices.append(term_id)
+                data.append(count)
+            indptr.append(len(indices))
+            lengths.append(len(tokens))
+        if len(lengths) != len(doc_ids):
+            raise ValueError("doc_ids and docs_tokens must have the same length")
+        if not lengths:
+            return
+
+        new_tf = sp.csr_matrix(
+            (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(lengths), len(self.vocab))
+        )
+        # 語彙の増加に合わせて既存の行列の列数を拡張 (メモリマップの配列も書き換えずに済むよう再構築する)
+        old_tf = sp.csr_matrix(
+            (self._tf.data, self._tf.indices, self._tf.indptr), shape=(self._tf.shape[0], len(self.vocab))
+        )
+        self._tf = sp.vstack([old_tf, new_tf], format="csr")
+        self._doc_len = np.concatenate([self._doc_len, np.asarray(lengths, dtype=np.float32)])
+        self.doc_ids.extend(doc_ids)
+        self._weights = None
+
+    def remove(self, doc_ids: Iterable[str]) -> int:
+        """
+        指定した文書を削除する
+
+        Returns:
+            int: 削除した文書数
+        """
+        targets = set(doc_ids)
+        keep = np.array([doc_id not in targets for doc_id in self.doc_ids], dtype=bool)
+        removed = int((~keep).sum())
+        if removed:
+            self._tf = self._tf[keep]
+            self._doc_len = self._doc_len[keep]
+            self.doc_ids = [doc_id for doc_id, k in zip(self.doc_ids, keep) if k]
+            self._weights = None
+        return removed
+
+    def _compute_weights(self) -> sp.csr_matrix:
+        n_docs = self._tf.shape[0]
+        tf = self._tf.tocoo()
+        doc_freq = np.bincount(tf.col, minlength=len(self.vocab)).astype(np.float64)
+
+        idf = np.log(n_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        # 削除により出現しなくなった単語 (df=0) は語彙に残るが、BM25Okapiと同様に平均idfには含めない
+        present = doc_freq > 0
+        if present.any():
+            average_idf = idf[present].mean()
+            idf[idf < 0] = self.epsilon * average_idf
+
+        avgdl = self._doc_len.mean() if n_docs else 0.0
+        norm = self.k1 * (1 - self.b + self.b * self._doc_len / avgdl) if avgdl else np.full(n_docs, self.k1)
+        values = idf[tf.col] * tf.data * (self.k1 + 1) / (tf.data + norm[tf.row])
+
+        return sp.csr_matrix(
+            (values.astype(np.float32), (tf.col, tf.row)), shape=(len(self.vocab), n_docs)
+        )
+
+    @property
+    def weights(self) -> sp.csr_matrix:
+        if self._weights is None:
+            self._weights = self._compute_weights()
+        return self._weights
+
+    def _query_matrix(self, queries_tokens: Sequence[List[str]]) -> sp.csr_matrix:
+        indptr, indices, data = [0], [], []
+        for tokens in queries_tokens:
+            counts = Counter(token for token in tokens if token in self.vocab)
+            for token, count in counts.items():
+                indices.append(self.vocab[token])
+                data.append(count)
+            indptr.append(len(indices))
+        return sp.csr_matrix(
+            (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(queries_tokens), len(self.vocab))
+        )
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        """
+        クエリに対する全文書のBM25スコアを返す
+        """
+        return self.get_batch_scores([query_tokens])[0]
+
+    def get_batch_scores(self, queries_tokens: Sequence[List[str]]) -> np.ndarray:
+        """
+        複数クエリに対する全文書のBM25スコアを (クエリ数, 文書数) の配列で返す
+        """
+        if not len(self.doc_ids):
+            return np.zeros((len(queries_tokens), 0), dtype=np.float32)
+        scores = self._query_matrix(queries_tokens) @ self.weights
+        return np.asarray(scores.todense(), dtype=np.float32)
+
+    @staticmethod
+    def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        スコアの上位k件のインデックスをスコアの降順で返す
+        """
+        k = min(k, scores.shape[-1])
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def search(self, query_tokens: List[str], k: int) -> Tuple[List[str], np.ndarray]:
+        """
+        クエリに対する上位k件の文書IDとスコアを返す
+        """
+        scores = self.get_scores(query_tokens)
+        top = self.top_k(scores, k)
+        return [self.doc_ids[i] for i in top], scores[top]
+
+    def batch_top_k(self, queries_tokens: Sequence[List[str]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        複数クエリの上位k件の文書の位置 (doc_idsの添字) とスコアを、(クエリ数, k) の配列でまとめて求める (スコアの降順)
+        """
+        scores = self.get_batch_scores(queries_tokens)
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=np.float32)
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+    def batch_search(self, queries_tokens: Sequence[List[str]], k: int) -> List[Tuple[List[str], np.ndarray]]:
+        """
+        複数クエリをまとめて検索する
+        """
+        positions, scores = self.batch_top_k(queries_tokens, k)
+        return [([self.doc_ids[i] for i in row], row_scores) for row, row_scores in zip(positions.tolist(), scores)]
+
+    def save(self, index_dir: str) -> None:
+        """
+        インデックスをディレクトリに保存する
+
+        配列は保存ごとに新しい世代名のファイルに書き込み、最後にその世代名を記録したmeta.jsonを差し替える
+        途中で中断しても読み込み側は前回のmeta.jsonとその世代の配列を参照するため、新旧の配列が混ざることはない
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        weights = self.weights
+        tf = self._tf
+        arrays = {
+            "tf_data": tf.data, "tf_indices": tf.indices, "tf_indptr": tf.indptr,
+            "w_data": weights.data, "w_indices": weights.indices, "w_indptr": weights.indptr,
+            "doc_len": self._doc_len,
+        }
+        generation = uuid.uuid4().hex[:12]
+        for name, array in arrays.items():
+            np.save(os.path.join(index_dir, f"{name}.{generation}.npy"), np.asarray(array))
+
+        meta = {
+            "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+            "vocab": self.vocab, "doc_ids": self.doc_ids, "generation": generation,
+        }
+        tmp_path = os.path.join(index_dir, "meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(index_dir, "meta.json"))
+
+        # 以前の世代の配列を削除する (メモリマップで読み込み中のファイルも削除後に参照できる)
+        current = {f"{name}.{generation}.npy" for name in arrays}
+        for file_name in os.listdir(index_dir):
+            if file_name.endswith(".npy") and file_name not in current and file_name.split(".")[0] in arrays:
+                os.remove(os.path.join(index_dir, file_name))
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True) -> "SparseBM25Index":
+        """
+        保存したインデックスを読み込む。mmap=Trueの場合、配列はメモリマップとして読み込む
+        """
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        # 世代名のない形式 (以前の保存形式) は<name>.npyを読み込む
+        suffix = f".{meta['generation']}.npy" if "generation" in meta else ".npy"
+        arrays = {
+            name: np.load(os.path.join(index_dir, f"{name}{suffix}"), mmap_mode="r" if mmap else None)
+            for name in cls._ARRAYS
+        }
+
+        index = cls(k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"])
+        index.vocab = meta["vocab"]
+        index.doc_ids = meta["doc_ids"]
+        n_docs, n_terms = len(index.doc_ids), len(index.vocab)
+        index._tf = sp.csr_matrix(
+            (arrays["tf_data"], arrays["tf_indices"], arrays["tf_indptr"]), shape=(n_docs, n_terms), copy=False
+        )
+        index._weights = sp.csr_matrix(
+            (arrays["w_data"], arrays["w_indices"], arrays["w_indptr"]), shape=(n_terms, n_docs), copy=False
+        )
+        index._doc_len = np.asarray(arrays["doc_len"])
+        return index
+
+
+class SparseBM25Retriever(BaseRetriever):
+    """
+    SparseBM25Indexを用いるRetriever (langchainのBM25Retrieverの代替)
+    文書本体はVector DBのdocstoreから取得するため、インデックスには文書IDのみを保持する
+    """
+
+    index: Any
+    docstore: Any
+    k: int = 4
+    preprocess_func: Callable[[str], List[str]] = preprocess_func
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        doc_ids, _ = self.index.search(self.preprocess_func(query), self.k)
+        return [self.docstore.search(doc_id) for doc_id in doc_ids]
+
+    def batch_get_relevant_documents(self, queries: List[str]) -> List[List[Document]]:
+        """
+        複数クエリをまとめて検索する
+        """
+        results = self.index.batch_search([self.preprocess_func(query) for query in queries], self.k)
+        return [[self.docstore.search(doc_id) for doc_id in doc_ids] for doc_ids, _ in results]
+
+
+def build_bm25_index(vector_store, index_dir: Optional[str] = None, **kwargs) -> SparseBM25Index:
+    """
+    Vector DBのdocstoreに格納された文書からBM25インデックスを構築する
+
+    index_dirに保存済みのインデックスがある場合はそれを読み込み、docstoreとの差分 (追加/削除された文書) のみを反映する
+    格納時に分かち書き済みの文書 (metadata["tokens"]) はその結果を使う
+    """
+    docs = vector_store.docstore._dict
+    index = None
+    if index_dir is not None and os.path.exists(os.path.join(index_dir, "meta.json")):
+        index = SparseBM25Index.load(index_dir, mmap=False)
+
+    changed = False
+    if index is None:
+        index = SparseBM25Index(**kwargs)
+        changed = True
+    else:
+        changed = index.remove([doc_id for doc_id in index.doc_ids if doc_id not in docs]) > 0
+
+    indexed = set(index.doc_ids)
+    new_ids = [doc_id for doc_id in docs if doc_id not in indexed]
+    if new_ids:
+        index.add(
+            new_ids,
+            (docs[doc_id].metadata.get("tokens") or tokenize(docs[doc_id].page_content) for doc_id in new_ids)
+        )
+        changed = True
+
+    if index_dir is not None and changed:
+        index.save(index_dir)
+    return index
@@ -0,0 +1,223 @@
+import weakref
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .shard import get_document_company
+from ..tools.embedding import count_tokens
+from ..tools.metrics import get_metrics
+
+
+# コンテキストの組み立ての設定の既定値
+DEFAULT_CONTEXT_CONFIG = {
+    "max_tokens": 4000,       # コンテキストのトークン数の上限
+    "mmr_lambda": 0.7,        # MMRの関連度の重み (1.0の場合は類似したチャンクを避けず、検索順位の順に詰める)
+    "merge_adjacent": True,   # 同じファイルの連続するチャンクを1つにまとめるか
+}
+
+# "stuff"チェーンと同じ、文書間の区切り
+CONTEXT_SEPARATOR = "\n\n"
+
+# Vector DBごとの文書ID -> インデックス内の位置の対応 (index_to_docstore_idの逆引き)
+# Vector DBへの弱参照をキーとし、ホットリロードなどで破棄されたVector DBの対応は自動的に削除される
+_POSITIONS = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=100_000)
+def count_chunk_tokens(text: str) -> int:
+    """
+    チャンクのトークン数 (同じチャンクは複数の質問で繰り返し検索されるため、結果を使い回す)
+    """
+    return count_tokens(text)
+
+def normalize_context_config(config: Optional[Dict] = None) -> Dict:
+    merged = {**DEFAULT_CONTEXT_CONFIG, **(config or {})}
+    unknown = set(merged) - set(DEFAULT_CONTEXT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown context config keys: {sorted(unknown)}")
+    if merged["max_tokens"] < 1:
+        raise ValueError("max_tokens must be >= 1")
+    if not 0 <= merged["mmr_lambda"] <= 1:
+        raise ValueError(f"mmr_lambda must be in [0, 1]: {merged['mmr_lambda']}")
+    return merged
+
+def _document_key(doc: Document):
+    if doc.id:
+        return doc.id
+    if "chunk_index" in doc.metadata:
+        return (get_document_company(doc), doc.metadata["chunk_index"])
+    return doc.page_content
+
+def _docstore_positions(vector_store) -> Dict[str, int]:
+    mapping = vector_store.index_to_docstore_id
+    cached = _POSITIONS.get(vector_store)
+    # Vector DBへの追加・削除があった場合は作り直す
+    if cached is None or cached[0] is not mapping or cached[1] != len(mapping):
+        cached = (mapping, len(mapping), {doc_id: position for position, doc_id in mapping.items()})
+        _POSITIONS[vector_store] = cached
+    return cached[2]
+
+def stored_vectors(vector_store, docs: List[Document]) -> Optional[np.ndarray]:
+    """
+    文書のベクトルをVector DBのインデックスから復元する (PQで保持している場合は量子化後の近似値となる)
+    インデックスにない文書を含む場合や、復元に対応しないインデックスの場合はNoneを返す
+    """
+    positions = _docstore_positions(vector_store)
+    if not docs or any(doc.id not in positions for doc in docs):
+        return None
+    index = vector_store.index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and not ivf.direct_map.type:
+        # IVFからベクトルを復元するには位置 -> 転置リストの対応表が必要
+        ivf.make_direct_map()
+    try:
+        return index.reconstruct_batch(np.asarray([positions[doc.id] for doc in docs], dtype=np.int64))
+    except RuntimeError:
+        return None
+
+def mmr_order(vectors: Optional[np.ndarray], mmr_lambda: float) -> List[int]:
+    """
+    検索順位の順に並んだ候補をMMR (Maximal Marginal Relevance) の順に並べ替える
+
+    関連度は検索順位 (RRF・リランク後の順位) から1 - 順位 / 件数として求め、
+    選択済みのチャンクとの類似度 (ベクトルのコサイン類似度の最大値) を差し引く
+    BM25のみで検索されたチャンクもクエリとのベクトルの類似度によらず順位どおりに評価される
+    """
+    n = 0 if vectors is None else len(vectors)
+    if n == 0 or mmr_lambda >= 1:
+        return list(range(n))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+    relevance = 1.0 - np.arange(n, dtype=np.float32) / n
+
+    order = [0]
+    remaining = np.ones(n, dtype=bool)
+    remaining[0] = False
+    max_similarity = similarity[0].copy()
+    for _ in range(n - 1):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[~remaining] = -np.inf
+        selected = int(np.argmax(scores))
+        order.append(selected)
+        remaining[selected] = False
+        np.maximum(max_similarity, similarity[selected], out=max_similarity)
+    return order
+
+def merge_adjacent_chunks(docs: List[Document]) -> List[Document]:
+    """
+    同じファイルで連続する (chunk_indexが1ずつ増える) チャンクを1つの文書にまとめる
+    2つ目以降のチャンクの先頭のファイル名 (会社名) は除き、まとめた文書は先頭のチャンクの位置に置く
+    metadata["chunk_indices"]にまとめたチャンクの番号を格納する
+    """
+    rank = {id(doc): i for i, doc in enumerate(docs)}
+    runs: Dict[tuple, List[Document]] = {}
+    ordered = sorted(
+        (doc for doc in docs if "chunk_index" in doc.metadata),
+        key=lambda doc: (get_document_company(doc), doc.metadata["chunk_index"])
+        )
+    previous = None
+    run_key = None
+    for doc in ordered:
+        company = get_document_company(doc)
+        if previous is None or get_document_company(previous) != company or (
+                doc.metadata["chunk_index"] != previous.metadata["chunk_index"] + 1):
+            run_key = (company, doc.metadata["chunk_index"])
+        runs.setdefault(run_key, []).append(doc)
+        previous = doc
+
+    merged = []
+    for run in runs.values():
+        head = run[0]
+        position = min(rank[id(doc)] for doc in run)
+        if len(run) == 1:
+            merged.append((position, head))
+            continue
+        company = get_document_company(head)
+        prefix = f"{company}\n\n"
+        texts = [head.page_content] + [
+            doc.page_content[len(prefix):] if doc.page_content.startswith(prefix) else doc.page_content
+            for doc in run[1:]
+        ]
+        metadata = {key: value for key, value in head.metadata.items() if key != "tokens"}
+        metadata["chunk_indices"] = [doc.metadata["chunk_index"] for doc in run]
+        document = Document(page_content=CONTEXT_SEPARATOR.join(texts), metadata=metadata, id=head.id)
+        merged.append((position, document))
+    merged.extend((rank[id(doc)], doc) for doc in docs if "chunk_index" not in doc.metadata)
+    return [doc for _, doc in sorted(merged, key=lambda item: item[0])]
+
+def pack_context(
+        docs: List[Document],
+        vector_store=None,
+        max_tokens: int = 4000,
+        mmr_lambda: float = 0.7,
+        merge_adjacent: bool = True
+        ) -> List[Document]:
+    """
+    検索結果の文書からLLMに渡すコンテキストをトークン数の上限内で組み立てる
+
+    1. 同じチャンク (ハイブリッド検索で密ベクトル・BM25の両方から得られたものなど) を除く
+    2. Vector DBに保存済みのベクトルを用いてMMRで並べ替え、似た内容のチャンクが上位を占めないようにする
+    3. MMRの順にトークン数の上限 (max_tokens) に収まるチャンクを詰める (収まらないチャンクは飛ばして次を試す)
+    4. merge_adjacent=Trueの場合、同じファイルで連続するチャンクを1つにまとめる
+
+    Args:
+        docs (list): 検索順位の順に並んだ文書
+        vector_store (FAISS): 文書のベクトルを保持するVector DB (Noneの場合はMMRを行わない)
+        max_tokens (int): コンテキストのトークン数の上限
+        mmr_lambda (float): MMRの関連度の重み (0に近いほど多様性を重視する)
+        merge_adjacent (bool): 連続するチャンクをまとめるか
+
+    Returns:
+        list: コンテキストに含める文書
+    """
+    unique = {}
+    for doc in docs:
+        unique.setdefault(_document_key(doc), doc)
+    candidates = list(unique.values())
+
+    vectors = stored_vectors(vector_store, candidates) if vector_store is not None and mmr_lambda < 1 else None
+    order = mmr_order(vectors, mmr_lambda) if vectors is not None else list(range(len(candidates)))
+
+    separator_tokens = count_chunk_tokens(CONTEXT_SEPARATOR)
+    used = 0
+    selected = []
+    for i in order:
+        tokens = count_chunk_tokens(candidates[i].page_content) + (separator_tokens if selected else 0)
+        if used + tokens > max_tokens:
+            continue
+        used += tokens
+        selected.append(candidates[i])
+
+    metrics = get_metrics()
+    metrics.observe("context_tokens", sum(count_chunk_tokens(doc.page_content) for doc in docs), kind="retrieved")
+    metrics.observe("context_tokens", used, kind="packed")
+    metrics.observe("context_documents", len(docs), kind="retrieved")
+    metrics.observe("context_documents", len(selected), kind="packed")
+
+    if merge_adjacent:
+        selected = merge_adjacent_chunks(selected)
+    return selected
+
+
+class PackedContextRetriever(BaseRetriever):
+    """
+    内部のRetrieverの検索結果をpack_contextでトークン数の上限内に詰めるRetriever
+    """
+
+    retriever: Any
+    vector_store: Any = None
+    config: Dict = {}
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        with get_metrics().timer("context", documents=len(docs)):
+            return pack_context(docs, self.vector_store, **normalize_context_config(self.config))
@@ -0,0 +1,358 @@
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .bm25 import SparseBM25Index
+from .shard import CompanyShards
+from ..tools.metrics import get_metrics
+from ..tools.tokenizer import preprocess_func
+
+
+# スコアの統合方法
+#   "rrf"      : 重み付きReciprocal Rank Fusion (重み / (順位 + c)。langchainのEnsembleRetrieverと同じ定義)
+#   "weighted" : クエリごとにスコアを最小値0・最大値1に正規化した重み付き和
+#   "convex"   : 密ベクトルのコサイン類似度とBM25スコア / 最大値の凸結合 (重みは和が1になるよう正規化する)
+FUSION_METHODS = ("rrf", "weighted", "convex")
+
+# クエリごとの検索結果 (文書IDのリスト, スコアの配列。スコアは大きいほど関連度が高い)
+SearchResult = Tuple[List[str], np.ndarray]
+# 全クエリの検索結果を連結した (クエリ番号, 文書の番号, スコア, クエリ内の順位 (1始まり)) の1次元の配列
+FlatResults = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# BM25インデックス -> Vector DB -> BM25の文書の位置からVector DBのインデックス内の位置への対応
+# 両方とも弱参照をキーとし、ホットリロードなどで破棄されたインデックスの対応は自動的に削除される
+_BM25_POSITIONS = weakref.WeakKeyDictionary()
+
+
+def dense_similarities(vector_store, distances: np.ndarray) -> np.ndarray:
+    """
+    FAISSの距離をコサイン類似度に変換する
+    L2距離 (FAISSは2乗距離を返す) は正規化済みのベクトル (OpenAIの埋め込みなど) を前提に 1 - d / 2 とする
+    """
+    if getattr(vector_store, "distance_strategy", None) == DistanceStrategy.MAX_INNER_PRODUCT:
+        return distances
+    return 1.0 - distances / 2.0
+
+def _flatten_rows(codes: np.ndarray, scores: np.ndarray) -> FlatResults:
+    """
+    (クエリ数, k) の文書の番号とスコアの配列 (番号が負の要素は欠損) を連結した1次元の配列にする
+    """
+    valid = codes >= 0
+    ranks = np.cumsum(valid, axis=1)
+    queries, columns = np.nonzero(valid)
+    return queries, codes[queries, columns], scores[queries, columns].astype(np.float32), ranks[queries, columns]
+
+def _flatten_lists(results: Sequence[SearchResult], codes: Dict[str, int]) -> FlatResults:
+    """
+    クエリごとの (文書IDのリスト, スコア) を連結した1次元の配列にする (文書IDはcodesで番号に変換する)
+    """
+    lengths = np.asarray([len(doc_ids) for doc_ids, _ in results], dtype=np.int64)
+    queries = np.repeat(np.arange(len(results)), lengths)
+    doc_codes = np.fromiter(
+        (codes.setdefault(doc_id, len(codes)) for doc_ids, _ in results for doc_id in doc_ids),
+        dtype=np.int64, count=int(lengths.sum())
+        )
+    scores = np.concatenate(
+        [np.asarray(scores, dtype=np.float32) for _, scores in results] or [np.zeros(0, dtype=np.float32)]
+        )
+    offsets = np.cumsum(lengths) - lengths
+    ranks = np.arange(len(doc_codes)) - np.repeat(offsets, lengths) + 1
+    return queries, doc_codes, scores, ranks
+
+def _segment_reduce(ufunc, values: np.ndarray, queries: np.ndarray, n_queries: int, initial: float) -> np.ndarray:
+    """
+    クエリごとの最小値・最大値 (ufunc.at による集約。検索結果が空のクエリはinitialとなる)
+    """
+    reduced = np.full(n_queries, initial, dtype=np.float32)
+    ufunc.at(reduced, queries, values)
+    return reduced
+
+def _top_per_query(
+        queries: np.ndarray, doc_codes: np.ndarray, scores: np.ndarray, n_queries: int, k: Optional[int]
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    クエリ番号の順に並んだ配列から、クエリごとに先頭k件を残す
+
+    Returns:
+        np.ndarray: クエリごとの件数
+        np.ndarray: 文書の番号
+        np.ndarray: スコア
+    """
+    counts = np.bincount(queries, minlength=n_queries)
+    if k is not None:
+        keep = np.arange(len(queries)) - np.repeat(np.cumsum(counts) - counts, counts) < k
+        doc_codes, scores = doc_codes[keep], scores[keep]
+        counts = np.minimum(counts, k)
+    return counts, doc_codes, scores
+
+def fuse_flat(
+        sources: Sequence[FlatResults],
+        weights: Sequence[float],
+        n_queries: int,
+        method: str = "rrf",
+        c: int = 60,
+        k: Optional[int] = None
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    複数の検索結果 (密ベクトル・BM25など) を全クエリまとめてNumPyで統合する
+
+    同じ文書は文書の番号で1つにまとめ、スコアが同じ場合は先の検索結果で先に現れた文書を上位とする
+    (method="rrf"の場合、langchainのEnsembleRetrieverと同じ順位となる)
+    片方の検索結果にない文書のその検索結果に対するスコアは0とする
+
+    Args:
+        sources (list): 検索結果ごとの (クエリ番号, 文書の番号, スコア, 順位) の配列 (密ベクトルのスコアはコサイン類似度)
+        weights (list): 検索結果ごとの重み
+        n_queries (int): クエリ数
+        method (str): "rrf" / "weighted" / "convex" (FUSION_METHODSを参照)
+        c (int): RRFの定数
+        k (int): クエリごとの件数の上限 (Noneの場合はすべて)
+
+    Returns:
+        np.ndarray: クエリごとの件数
+        np.ndarray: クエリ番号の昇順・統合スコアの降順に並べた文書の番号
+        np.ndarray: 統合スコア
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method} (expected one of {FUSION_METHODS})")
+    if len(sources) != len(weights):
+        raise ValueError("sources and weights must have the same length")
+    weights = np.asarray(weights, dtype=np.float32)
+    if method == "convex":
+        weights = weights / weights.sum()
+
+    all_queries, all_codes, all_contributions = [], [], []
+    for source, ((queries, doc_codes, scores, ranks), weight) in enumerate(zip(sources, weights)):
+        if method == "rrf":
+            contributions = weight / (ranks + c)
+        elif method == "weighted":
+            low = _segment_reduce(np.minimum, scores, queries, n_queries, np.inf)[queries]
+            high = _segment_reduce(np.maximum, scores, queries, n_queries, -np.inf)[queries]
+            spread = high - low
+            # スコアがすべて同じクエリは1とする
+            contributions = weight * np.divide(scores - low, spread, out=np.ones_like(scores), where=spread > 0)
+        elif source == 0:
+            # 密ベクトル (先頭の検索結果) はコサイン類似度をそのまま用いる
+            contributions = weight * np.clip(scores, 0.0, 1.0)
+        else:
+            high = _segment_reduce(np.maximum, scores, queries, n_queries, 0.0)[queries]
+            contributions = weight * np.divide(scores, high, out=np.zeros_like(scores), where=high > 0)
+        all_queries.append(queries)
+        all_codes.append(doc_codes)
+        all_contributions.append(contributions)
+
+    queries = np.concatenate(all_queries).astype(np.int64)
+    doc_codes = np.concatenate(all_codes).astype(np.int64)
+    contributions = np.concatenate(all_contributions)
+    if not len(doc_codes):
+        return np.zeros(n_queries, dtype=np.int64), doc_codes, contributions
+
+    # (クエリ, 文書) ごとにスコアを合算し、クエリ番号の昇順・スコアの降順・初出の順に並べる
+    n_codes = int(doc_codes.max()) + 1
+    keys, first, inverse = np.unique(queries * n_codes + doc_codes, return_index=True, return_inverse=True)
+    fused = np.bincount(inverse, weights=contributions, minlength=len(keys))
+    order = np.lexsort((first, -fused, keys // n_codes))
+    return _top_per_query(keys[order] // n_codes, keys[order] % n_codes, fused[order], n_queries, k)
+
+def _split_by_query(counts: np.ndarray, doc_ids: List[str], scores: np.ndarray) -> List[List[Tuple[str, float]]]:
+    scores = scores.tolist()
+    results = []
+    start = 0
+    for count in counts.tolist():
+        results.append(list(zip(doc_ids[start:start + count], scores[start:start + count])))
+        start += count
+    return results
+
+def fuse_results(
+        results: Sequence[Sequence[SearchResult]],
+        weights: Sequence[float],
+        method: str = "rrf",
+        c: int = 60,
+        k: Optional[int] = None
+        ) -> List[List[Tuple[str, float]]]:
+    """
+    クエリごとの (文書IDのリスト, スコア) の形の検索結果を、文書IDでまとめて統合する (fuse_flatを参照)
+
+    Returns:
+        list: クエリごとの (文書ID, 統合スコア) のリスト (統合スコアの降順)
+    """
+    codes: Dict[str, int] = {}
+    sources = [_flatten_lists(source_results, codes) for source_results in results]
+    counts, doc_codes, fused = fuse_flat(sources, weights, len(results[0]) if results else 0, method, c, k)
+    id_of = list(codes)
+    return _split_by_query(counts, [id_of[code] for code in doc_codes.tolist()], fused)
+
+def _bm25_positions(vector_store, bm25_index: SparseBM25Index) -> np.ndarray:
+    """
+    BM25インデックスの文書の位置 -> Vector DBのインデックス内の位置 (ない文書は-1) の対応
+    文書の追加・削除があった場合は作り直す
+    """
+    per_store = _BM25_POSITIONS.get(bm25_index)
+    if per_store is None:
+        per_store = _BM25_POSITIONS.setdefault(bm25_index, weakref.WeakKeyDictionary())
+    mapping = vector_store.index_to_docstore_id
+    cached = per_store.get(vector_store)
+    if cached is None or cached[0] is not bm25_index.doc_ids or cached[1] != (len(bm25_index), len(mapping)):
+        positions = {doc_id: position for position, doc_id in mapping.items()}
+        array = np.asarray([positions.get(doc_id, -1) for doc_id in bm25_index.doc_ids], dtype=np.int64)
+        cached = (bm25_index.doc_ids, (len(bm25_index), len(mapping)), array)
+        per_store[vector_store] = cached
+    return cached[2]
+
+def hybrid_search_batch(
+        questions: List[str],
+        vector_store,
+        topk: int = 30,
+        bm25_index: Optional[SparseBM25Index] = None,
+        hybrid_topk: int = 30,
+        hybrid_weights: Sequence[float] = (0.5, 0.5),
+        fusion: str = "rrf",
+        shards: Optional[CompanyShards] = None,
+        query_vectors: Optional[np.ndarray] = None,
+        k: Optional[int] = None,
+        rrf_c: int = 60,
+        tokenize: Callable[[str], List[str]] = preprocess_func
+        ) -> Tuple[List[List[Tuple[str, float]]], Dict[str, float]]:
+    """
+    密ベクトルとBM25の検索を全クエリまとめて並行に実行し、文書ごとにスコアを統合する
+
+    ・密ベクトル: 全クエリを1回の埋め込みリクエストでベクトル化し、FAISSのsearchを1回呼び出す
+    ・BM25: 全クエリのスコアを1回の疎行列の積で求め、上位k件もまとめて選ぶ (密ベクトルの検索とスレッドで並行に実行する)
+    ・統合: fuse_flatで全クエリをまとめて統合する
+      文書はVector DBのインデックス内の位置で照合し、文書IDへの変換は統合後の上位の文書のみ行う
+    bm25_indexがNoneの場合は密ベクトルの検索のみを行う (スコアはコサイン類似度)
+    shardsを指定した場合、質問に含まれる会社名でその会社のインデックスのみを検索する (会社名がない質問は全体を検索)
+    段階ごとの処理時間はtools.metricsにも記録する (retrieve.embed_query / retrieve.dense / retrieve.sparse / retrieve.fusion)
+
+    Returns:
+        list: クエリごとの (文書ID, スコア) のリスト (スコアの降順)
+        dict: 段階ごとの処理時間 (秒。embed_query / dense / sparse / fusion / total)
+    """
+    metrics = get_metrics()
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    routes = [shards.route(q) for q in questions] if shards is not None else None
+    # 会社ごとのインデックスは位置が異なるため、振り分ける場合は文書IDを番号に変換して照合する
+    codes: Dict[str, int] = {}
+
+    def timed(stage, func):
+        stage_start = time.perf_counter()
+        with metrics.timer(f"retrieve.{stage}", queries=len(questions)):
+            result = func()
+        timings[stage] = time.perf_counter() - stage_start
+        return result
+
+    def sparse_search():
+        queries_tokens = [tokenize(q) for q in questions]
+        if routes is not None:
+            return shards.sparse_search_batch(queries_tokens, routes, hybrid_topk, bm25_index)
+        positions, scores = bm25_index.batch_top_k(queries_tokens, hybrid_topk)
+        return _flatten_rows(_bm25_positions(vector_store, bm25_index)[positions], scores)
+
+    def dense_search():
+        vectors = query_vectors
+        if vectors is None:
+            vectors = timed("embed_query", lambda: np.asarray(
+                vector_store.embeddings.embed_documents(questions), dtype=np.float32
+                ))
+
+        def search():
+            if routes is not None:
+                return [
+                    (
+                        [doc_id for doc_id, _ in items],
+                        dense_similarities(vector_store, np.asarray([d for _, d in items], dtype=np.float32))
+                    )
+                    for items in shards.dense_search_batch(vectors, routes, topk)
+                ]
+            normalized = np.array(vectors, dtype=np.float32)
+            if getattr(vector_store, "_normalize_L2", False):
+                faiss.normalize_L2(normalized)
+            distances, positions = vector_store.index.search(normalized, topk)
+            return _flatten_rows(positions, dense_similarities(vector_store, distances))
+        return timed("dense", search)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sparse_future = None
+        if bm25_index is not None:
+            sparse_future = executor.submit(timed, "sparse", sparse_search)
+        sources = [executor.submit(dense_search).result()]
+        if sparse_future is not None:
+            sources.append(sparse_future.result())
+
+    def fuse():
+        flat = [_flatten_lists(source, codes) for source in sources] if routes is not None else sources
+        if len(flat) == 1:
+            queries, doc_codes, scores, _ = flat[0]
+            return _top_per_query(queries, doc_codes, scores, len(questions), k)
+        return fuse_flat(flat, hybrid_weights, len(questions), method=fusion, c=rrf_c, k=k)
+
+    counts, doc_codes, scores = timed("fusion", fuse)
+    id_of = list(codes) if routes is not None else vector_store.index_to_docstore_id
+    fused = _split_by_query(counts, [id_of[code] for code in doc_codes.tolist()], scores)
+    timings["total"] = time.perf_counter() - start
+    return fused, timings
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    密ベクトル (FAISS) とBM25 (SparseBM25Index) の検索を並行に実行し、文書IDでスコアを統合するRetriever
+    (langchainのEnsembleRetrieverの代替。検索は順番ではなく並行に行い、統合はNumPyで行う)
+
+    batch_searchで複数クエリをまとめて検索でき、段階ごとの処理時間も返す
+    """
+
+    vector_store: Any
+    bm25_index: Any = None
+    shards: Any = None
+    topk: int = 30
+    hybrid_topk: int = 30
+    weights: List[float] = [0.5, 0.5]
+    fusion: str = "rrf"
+    rrf_c: int = 60
+    k: Optional[int] = None
+    preprocess_func: Callable[[str], List[str]] = preprocess_func
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        return self.batch_search([query])[0][0]
+
+    def batch_search(
+            self, queries: List[str], query_vectors: Optional[np.ndarray] = None
+            ) -> Tuple[List[List[Document]], Dict[str, float]]:
+        """
+        複数クエリをまとめて検索する
+
+        Returns:
+            list: クエリごとの文書 (metadataは変更せず、統合スコアの降順)
+            dict: 段階ごとの処理時間 (秒)
+        """
+        fused, timings = hybrid_search_batch(
+            queries,
+            self.vector_store,
+            topk=self.topk,
+            bm25_index=self.bm25_index,
+            hybrid_topk=self.hybrid_topk,
+            hybrid_weights=self.weights,
+            fusion=self.fusion,
+            shards=self.shards,
+            query_vectors=query_vectors,
+            k=self.k,
+            rrf_c=self.rrf_c,
+            tokenize=self.preprocess_func
+            )
+        docstore = self.vector_store.docstore
+        return [[docstore.search(doc_id) for doc_id, _ in result] for result in fused], timings
+
+    def batch_get_relevant_documents(self, queries: List[str]) -> List[List[Document]]:
+        return self.batch_search(queries)[0]
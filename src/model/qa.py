@@ -0,0 +1,282 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+
+from langchain_core.documents import Document
+
+from .bm25 import SparseBM25Index
+from .context import normalize_context_config, pack_context
+from .hybrid import hybrid_search_batch
+from .query_cache import QueryCache, documents_from_json, documents_to_json, vector_store_version
+from .rerank import rerank_batch
+from .shard import CompanyShards
+from ..tools.embedding import get_encoding
+from ..tools.faiss_index import apply_search_params
+from ..tools.metrics import get_metrics, record_llm_request
+from ..tools.rate_limit import AsyncRateLimiter, backoff_delay
+
+
+def retrieve_batch(
+        questions: List[str],
+        vector_store,
+        topk: int = 30,
+        bm25_index: Optional[SparseBM25Index] = None,
+        hybrid_topk: int = 30,
+        hybrid_weights: Sequence[float] = (0.5, 0.5),
+        rerank: bool = False,
+        rerank_topk: int = 10,
+        rerank_kwargs: Optional[dict] = None,
+        search_params: Optional[dict] = None,
+        shards: Optional[CompanyShards] = None,
+        query_vectors: Optional[np.ndarray] = None,
+        fusion: str = "rrf"
+        ) -> List[List[Document]]:
+    """
+    質問をまとめて検索する
+
+    ・全質問を1回の埋め込みリクエストでベクトル化し、FAISSのsearchを1回だけ呼び出す
+    ・bm25_indexを指定した場合、BM25の検索を並行して実行し、fusionの方法 (RRF / weighted / convex) で統合する
+      (hybrid.hybrid_search_batchを参照)
+    ・rerank=Trueの場合、全質問の候補文書をまとめてリランクする
+    ・search_paramsを指定した場合、近似最近傍探索のパラメータ (nprobe, efSearchなど) をインデックスに設定する
+    ・shardsを指定した場合、質問に含まれる会社名でその会社のインデックスのみを検索する (会社名がない質問は全体を検索)
+    ・密ベクトル (dense)・BM25 (sparse)・統合 (fusion)・リランク (rerank) の処理時間をtools.metricsに記録する
+    ・query_vectorsを指定した場合、質問の埋め込みを省略する (回答のキャッシュの照合で埋め込み済みの場合)
+
+    Returns:
+        list: 質問ごとの検索結果の文書
+    """
+    apply_search_params(vector_store.index, search_params)
+    results, _ = hybrid_search_batch(
+        questions,
+        vector_store,
+        topk=topk,
+        bm25_index=bm25_index,
+        hybrid_topk=hybrid_topk,
+        hybrid_weights=hybrid_weights,
+        fusion=fusion,
+        shards=shards,
+        query_vectors=query_vectors
+        )
+    docstore = vector_store.docstore
+    candidates = [[docstore.search(doc_id) for doc_id, _ in result] for result in results]
+
+    if rerank:
+        candidates = rerank_batch(questions, candidates, rerank_topk, **(rerank_kwargs or {}))
+    return candidates
+
+def format_context(docs: List[Document]) -> str:
+    """
+    langchainの"stuff"チェーンと同様に、文書の本文を空行区切りで連結する
+    """
+    return "\n\n".join(doc.page_content for doc in docs)
+
+async def agenerate_answer(
+        llm,
+        prompt_text: str,
+        semaphore: asyncio.Semaphore,
+        limiter: Optional[AsyncRateLimiter],
+        estimated_tokens: int,
+        max_retries: int
+        ) -> str:
+    """
+    LLMで回答を生成する (同時実行数とレート制限を守り、失敗した場合は待機して再試行する)
+    """
+    model = getattr(llm, "model_name", None) or getattr(llm, "deployment_name", None) or type(llm).__name__
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire(estimated_tokens)
+                start = time.perf_counter()
+                message = await llm.ainvoke(prompt_text)
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            record_llm_request(
+                "answer", model, "error" if attempt == max_retries else "retry", time.perf_counter() - start,
+                attempt=attempt, error=type(e).__name__, delay=delay if attempt < max_retries else None
+                )
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        usage = getattr(message, "usage_metadata", None)
+        record_llm_request("answer", model, "ok", time.perf_counter() - start, usage, attempt=attempt)
+        if limiter is not None and usage:
+            limiter.adjust(usage["total_tokens"] - estimated_tokens)
+        return message.content
+
+def parse_answer(outcome: str, output_parser=None, max_answer_tokens: int = 54) -> str:
+    """
+    LLMの出力から回答を取り出す (output_parserがNoneの場合は出力をそのまま回答とする)
+    回答がmax_answer_tokensトークンを超える場合は「不明」とする
+    """
+    answer = output_parser.parse(outcome)["answer"] if output_parser is not None else outcome.strip()
+    if len(get_encoding().encode(answer, disallowed_special=())) > max_answer_tokens:
+        answer = "不明"
+    return answer
+
+def save_csv(df: pl.DataFrame, output_path: str) -> None:
+    """
+    提出形式 (ヘッダーなし) でCSVを保存する
+    """
+    csv_data = df.write_csv().split("\n", 1)[-1]
+    with open(output_path, "w") as f:
+        f.write(csv_data)
+
+async def aanswer_questions(
+        questions: List[str],
+        vector_store,
+        llm,
+        prompt,
+        output_parser=None,
+        limiter: Optional[AsyncRateLimiter] = None,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        max_answer_tokens: int = 54,
+        output_path: Optional[str] = None,
+        answer_cache: Optional[QueryCache] = None,
+        context: Optional[Dict] = None,
+        **retrieve_kwargs
+        ) -> Tuple[pl.DataFrame, List[List[Document]]]:
+    """
+    質問をまとめて検索し、回答を並列に生成する
+
+    answer_cacheを指定した場合、同一・類似の質問についてはキャッシュ済みの回答 (LLMの出力) と参照文書を再利用し、
+    検索とLLM呼び出しを省略する。キャッシュのインデックスのバージョンはVector DBの内容から設定する
+    (プロンプト・モデル・検索の設定はanswer_cacheの名前空間に含める。query_cache.cache_namespaceを参照)
+    shardsを指定した場合、類似の質問の回答は振り分け先の会社が同じ場合にのみ再利用する
+    (会社名だけが異なる質問は埋め込みの類似度が高く、別の会社の回答を返してしまうため)
+    contextを指定した場合、検索結果をcontext.pack_contextでトークン数の上限内に詰めてからプロンプトに渡す
+    (重複の除去、MMRによる並べ替え、連続するチャンクの結合。設定はcontext.DEFAULT_CONTEXT_CONFIGを参照)
+
+    Args:
+        questions (list): 質問のリスト
+        vector_store (FAISS): Vector DB
+        llm: langchainのChatModel
+        prompt (PromptTemplate): "context"と"question"を入力に持つプロンプト
+        output_parser: 回答のパーサー ("answer"キーを持つdictを返す。Noneの場合は出力をそのまま回答とする)
+        limiter (AsyncRateLimiter): LLM呼び出しのレート制限
+        max_concurrency (int): LLM呼び出しの同時実行数
+        max_retries (int): LLM呼び出しの最大リトライ回数
+        max_answer_tokens (int): 回答の最大トークン数 (超えた場合は「不明」とする)
+        output_path (str): 提出用CSVの出力先 (Noneの場合は保存しない)
+        answer_cache (QueryCache): 回答のキャッシュ
+        context (dict): コンテキストの組み立ての設定 (Noneの場合は検索結果をすべて渡す)
+        **retrieve_kwargs: retrieve_batchに渡す検索の設定
+
+    Returns:
+        pl.DataFrame: index, answerの2列からなる回答
+        list: 質問ごとの参照文書 (contextを指定した場合はプロンプトに渡した文書)
+    """
+    if context is not None:
+        context = normalize_context_config(context)
+    loop = asyncio.get_running_loop()
+    outcomes: List = [None] * len(questions)
+    source_documents: List[List[Document]] = [[] for _ in questions]
+    pending = list(range(len(questions)))
+    query_vectors = None
+
+    shards = retrieve_kwargs.get("shards")
+    routes = [sorted(shards.route(q)) for q in questions] if shards is not None else None
+
+    if answer_cache is not None:
+        answer_cache.set_index_version(await asyncio.to_thread(vector_store_version, vector_store))
+        use_similar = answer_cache.similarity_threshold is not None
+        for i, question in enumerate(questions):
+            cached = answer_cache.get_exact(question, record_miss=not use_similar)
+            if cached is not None:
+                outcomes[i] = cached["output"]
+                source_documents[i] = documents_from_json(cached["sources"])
+        pending = [i for i in pending if outcomes[i] is None]
+        if pending and use_similar:
+            query_vectors = await loop.run_in_executor(None, lambda: np.asarray(
+                vector_store.embeddings.embed_documents([questions[i] for i in pending]), dtype=np.float32
+                ))
+            for i, vector in zip(pending, query_vectors):
+                accept = None
+                if routes is not None:
+                    accept = lambda value, route=routes[i]: value.get("companies") == route
+                cached = answer_cache.get_similar(vector, accept)
+                if cached is not None:
+                    outcomes[i] = cached["output"]
+                    source_documents[i] = documents_from_json(cached["sources"])
+            query_vectors = query_vectors[[outcomes[i] is None for i in pending]]
+            pending = [i for i in pending if outcomes[i] is None]
+
+    if pending:
+        retrieved = await loop.run_in_executor(
+            None, lambda: retrieve_batch(
+                [questions[i] for i in pending], vector_store, query_vectors=query_vectors, **retrieve_kwargs
+                )
+            )
+        if context is not None:
+            with get_metrics().timer("context", queries=len(pending)):
+                retrieved = await loop.run_in_executor(
+                    None, lambda: [pack_context(docs, vector_store, **context) for docs in retrieved]
+                    )
+        for i, docs in zip(pending, retrieved):
+            source_documents[i] = docs
+
+    encoding = get_encoding()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    prompt_texts = [
+        prompt.format(context=format_context(source_documents[i]), question=questions[i])
+        for i in pending
+    ]
+    generated = await asyncio.gather(*(
+        agenerate_answer(
+            llm, prompt_text, semaphore, limiter,
+            len(encoding.encode(prompt_text, disallowed_special=())) + max_answer_tokens,
+            max_retries
+            )
+        for prompt_text in prompt_texts
+    ), return_exceptions=True)
+    for j, (i, outcome) in enumerate(zip(pending, generated)):
+        outcomes[i] = outcome
+        if answer_cache is not None and not isinstance(outcome, BaseException):
+            value = {"output": outcome, "sources": documents_to_json(source_documents[i])}
+            if routes is not None:
+                value["companies"] = routes[i]
+            answer_cache.set(questions[i], value, query_vectors[j] if query_vectors is not None else None)
+
+    metrics = get_metrics()
+    answers = []
+    for i, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            metrics.inc("answer_errors_total", reason="generate")
+            metrics.event("answer_error", index=i, reason="generate", max_retries=max_retries, error=repr(outcome))
+            answers.append("Error")
+            continue
+        try:
+            answer = parse_answer(outcome, output_parser, max_answer_tokens)
+        except Exception as e:
+            metrics.inc("answer_errors_total", reason="parse")
+            metrics.event("answer_error", index=i, reason="parse", error=repr(e))
+            answer = "Error"
+        answers.append(answer)
+
+    df = pl.DataFrame(
+        data={
+            "index": list(range(len(questions))),
+            "answer": answers
+        },
+        schema={
+            "index": pl.UInt32,
+            "answer": pl.String
+        }
+    )
+    if output_path is not None:
+        save_csv(df, output_path)
+    return df, source_documents
+
+def answer_questions(*args, **kwargs) -> Tuple[pl.DataFrame, List[List[Document]]]:
+    """
+    aanswer_questionsの同期版 (イベントループが動いていない環境向け。Jupyterでは aanswer_questions をawaitする)
+    """
+    return asyncio.run(aanswer_questions(*args, **kwargs))
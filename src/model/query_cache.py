@@ -0,0 +1,338 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from ..tools.cache import hash_parts
+from ..tools.metrics import get_metrics
+
+
+def normalize_query(text: str) -> str:
+    """
+    完全一致の照合用にクエリを正規化する (NFKC、英字の小文字化、連続する空白の集約、末尾の句読点・疑問符の除去)
+    """
+    text = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    return text.rstrip("?？。.!！ ")
+
+def cache_namespace(name: str, **config) -> str:
+    """
+    キャッシュの名前空間を生成する
+    結果に影響する設定 (検索のtopk、プロンプト、モデル名など) をconfigに含めると、設定ごとに別のキャッシュとなる
+    """
+    return f"{name}:{hash_parts(json.dumps(config, ensure_ascii=False, sort_keys=True, default=str))[:16]}"
+
+def vector_store_version(vector_store) -> str:
+    """
+    Vector DBの内容 (ベクトル数と文書ID) から、インデックスのバージョンを表すハッシュ値を生成する
+    文書の追加・削除・再構築で値が変わるため、キャッシュの無効化に用いる
+    """
+    ids = [vector_store.index_to_docstore_id[i] for i in sorted(vector_store.index_to_docstore_id)]
+    return hash_parts(str(vector_store.index.ntotal), *ids)[:16]
+
+def _jsonable(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+def documents_to_json(docs: List[Document]) -> List[Dict]:
+    return [{"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+def documents_from_json(items: List[Dict]) -> List[Document]:
+    return [Document(id=item.get("id"), page_content=item["page_content"], metadata=item["metadata"]) for item in items]
+
+
+class QueryCache:
+    """
+    クエリ単位の検索結果・回答を保持するSQLiteベースの永続キャッシュ
+
+    ・1段目: 正規化したクエリの完全一致 (get_exact)
+    ・2段目: クエリの埋め込みベクトルのコサイン類似度がsimilarity_threshold以上の既存のクエリ (get_similar)
+      (会社名・年度だけが異なる質問も類似度は高くなるため、しきい値は高めに設定する)
+    ・ttl_secondsを過ぎたエントリは参照時に削除する
+    ・エントリ数がmax_entriesを超えた場合、最終アクセスが古いものから削除 (LRU)
+    ・namespaceごとにインデックスのバージョンを保持し、バージョンが変わった場合はその名前空間のエントリをすべて削除する
+
+    類似度の計算に用いるベクトルは名前空間ごとにメモリ上に保持する
+
+    Args:
+        path (str): SQLiteファイルのパス
+        namespace (str): 名前空間 (検索結果と回答、設定の異なるRetrieverなどを区別する。cache_namespaceで生成する)
+        index_version (str): インデックスのバージョン (vector_store_versionなど。set_index_versionで後から設定してもよい)
+        similarity_threshold (float): 2段目のキャッシュとみなすコサイン類似度の下限 (Noneの場合は完全一致のみ)
+        ttl_seconds (float): エントリの有効期間 (Noneの場合は無期限)
+        max_entries (int): 名前空間あたりの最大エントリ数
+    """
+
+    def __init__(
+            self,
+            path: str,
+            namespace: str = "default",
+            index_version: Optional[str] = None,
+            similarity_threshold: Optional[float] = 0.97,
+            ttl_seconds: Optional[float] = None,
+            max_entries: int = 10_000
+            ):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.namespace = namespace
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.index_version: Optional[str] = None
+        self._keys: List[str] = []
+        self._vectors: List[np.ndarray] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS queries (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding BLOB,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_queries_namespace ON queries (namespace, last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS versions (namespace TEXT PRIMARY KEY, index_version TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self.set_index_version(index_version)
+
+    def set_index_version(self, index_version: Optional[str]) -> None:
+        """
+        インデックスのバージョンを設定する。保存済みのバージョンと異なる場合は名前空間のエントリをすべて削除する
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT index_version FROM versions WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+            if index_version is not None and (row is None or row[0] != index_version):
+                if row is not None:
+                    self._conn.execute("DELETE FROM queries WHERE namespace = ?", (self.namespace,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO versions VALUES (?, ?)", (self.namespace, index_version)
+                )
+            self._conn.commit()
+            self.index_version = index_version if index_version is not None else (row[0] if row else None)
+            self._load_vectors()
+
+    def _load_vectors(self) -> None:
+        rows = self._conn.execute(
+            "SELECT key, embedding FROM queries WHERE namespace = ? AND embedding IS NOT NULL", (self.namespace,)
+        ).fetchall()
+        self._keys = [key for key, _ in rows]
+        self._vectors = [np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows]
+        self._matrix = None
+
+    def _key(self, query: str) -> str:
+        return hash_parts(self.namespace, normalize_query(query))
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _remove_vectors(self, keys) -> None:
+        keys = set(keys)
+        kept = [(key, vector) for key, vector in zip(self._keys, self._vectors) if key not in keys]
+        self._keys = [key for key, _ in kept]
+        self._vectors = [vector for _, vector in kept]
+        self._matrix = None
+
+    def _get_row(self, key: str) -> Optional[Any]:
+        """
+        キーに対応する値を取得する (期限切れの場合は削除してNoneを返す)。ロックを保持した状態で呼び出す
+        """
+        row = self._conn.execute("SELECT value, created_at FROM queries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self._expired(row[1]):
+            self._conn.execute("DELETE FROM queries WHERE key = ?", (key,))
+            self._conn.commit()
+            self._remove_vectors([key])
+            return None
+        self._conn.execute("UPDATE queries SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+        return json.loads(row[0])
+
+    def _record(self, level: Optional[str]) -> None:
+        metrics = get_metrics()
+        if level is None:
+            self.misses += 1
+            metrics.inc("cache_requests_total", cache="query", result="miss")
+            return
+        if level == "exact":
+            self.exact_hits += 1
+        else:
+            self.similar_hits += 1
+        metrics.inc("cache_requests_total", cache="query", result="hit")
+        metrics.inc("query_cache_hits_total", level=level)
+
+    def get_exact(self, query: str, record_miss: bool = True) -> Optional[Any]:
+        """
+        正規化したクエリが完全一致するエントリの値を取得する
+        record_miss=Falseの場合、ミスを記録しない (続けてget_similarを呼び出す場合)
+        """
+        with self._lock:
+            value = self._get_row(self._key(query))
+        if value is not None or record_miss:
+            self._record("exact" if value is not None else None)
+        return value
+
+    def get_similar(self, embedding, accept: Optional[Callable[[Any], bool]] = None) -> Optional[Any]:
+        """
+        埋め込みベクトルのコサイン類似度がしきい値以上で最も近いエントリの値を取得する
+        acceptを指定した場合、最も近いエントリの値がacceptを満たさなければミスとする
+        (会社名など、類似度では区別できない条件が一致する場合にのみ再利用する)
+        """
+        value = None
+        if self.similarity_threshold is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            with self._lock:
+                if self._vectors and norm > 0:
+                    if self._matrix is None:
+                        self._matrix = np.vstack(self._vectors)
+                    similarities = self._matrix @ (vector / norm)
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        value = self._get_row(self._keys[best])
+        if value is not None and accept is not None and not accept(value):
+            get_metrics().inc("query_cache_rejected_total")
+            value = None
+        self._record("similar" if value is not None else None)
+        return value
+
+    def get(self, query: str, embedding=None) -> Optional[Any]:
+        """
+        完全一致、類似クエリの順に値を取得する (embeddingがNoneの場合は完全一致のみ)
+        """
+        value = self.get_exact(query, record_miss=embedding is None)
+        if value is None and embedding is not None:
+            value = self.get_similar(embedding)
+        return value
+
+    def set(self, query: str, value: Any, embedding=None) -> None:
+        """
+        値 (JSONに変換できるもの) を保存する。embeddingを指定した場合は類似クエリの照合にも用いる
+        """
+        key = self._key(query)
+        data = None
+        vector = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+                data = vector.tobytes()
+            else:
+                vector = None
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, self.namespace, query, data, json.dumps(value, ensure_ascii=False, default=_jsonable), now, now)
+            )
+            self._remove_vectors([key])
+            if vector is not None:
+                self._keys.append(key)
+                self._vectors.append(vector)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        count = self._conn.execute(
+            "SELECT COUNT(*) FROM queries WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+        if count <= self.max_entries:
+            return
+        rows = self._conn.execute(
+            "SELECT key FROM queries WHERE namespace = ? ORDER BY last_access LIMIT ?",
+            (self.namespace, count - self.max_entries)
+        ).fetchall()
+        keys = [key for key, in rows]
+        self._conn.executemany("DELETE FROM queries WHERE key = ?", [(key,) for key in keys])
+        self._remove_vectors(keys)
+
+    def invalidate(self) -> int:
+        """
+        名前空間のエントリをすべて削除する
+        """
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM queries WHERE namespace = ?", (self.namespace,)).rowcount
+            self._conn.commit()
+            self._remove_vectors(list(self._keys))
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM queries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+        requests = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.similar_hits) / requests if requests else 0.0,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    QueryCacheで検索結果を再利用するRetriever
+
+    完全一致でヒットしない場合、embeddingsでクエリを埋め込んで類似クエリの検索結果を探す
+    (キャッシュにない場合は内部のRetrieverでも埋め込むため、クエリの埋め込みは2回となる)
+    会社名だけが異なる質問は類似度が高くなるため、類似クエリの検索結果は、shards (CompanyShards) で判定した
+    振り分け先の会社が一致する場合にのみ再利用する (shardsを指定しない場合は完全一致のみ)
+    """
+
+    retriever: Any
+    cache: Any
+    embeddings: Any = None
+    shards: Any = None
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        use_similar = (
+            self.embeddings is not None and self.shards is not None and self.cache.similarity_threshold is not None
+        )
+        route = sorted(self.shards.route(query)) if self.shards is not None else None
+        cached = self.cache.get_exact(query, record_miss=not use_similar)
+        embedding = None
+        if cached is None and use_similar:
+            embedding = self.embeddings.embed_query(query)
+            cached = self.cache.get_similar(
+                embedding, lambda value: isinstance(value, dict) and value.get("companies") == route
+                )
+        if cached is not None:
+            # 会社の情報を持たない形式 (文書のリスト) で保存されたエントリも読み込む
+            return documents_from_json(cached["documents"] if isinstance(cached, dict) else cached)
+
+        docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        self.cache.set(query, {"documents": documents_to_json(docs), "companies": route}, embedding)
+        return docs
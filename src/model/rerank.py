@@ -0,0 +1,157 @@
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from langchain_core.documents.compressor import BaseDocumentCompressor
+
+from ..tools.metrics import get_metrics
+
+DEFAULT_RERANK_MODEL = "bclavie/JaColBERT"
+
+# プロセス内で共有するリランクモデル ((モデル名, n_gpu) -> RAGPretrainedModel)
+_MODELS: Dict[Tuple[str, int], object] = {}
+# モデルごとの推論のロック (文書の最大トークン数の設定は共有のモデルに対して行うため、推論の間は他の呼び出しを待たせる)
+_MODEL_LOCKS: Dict[Tuple[str, int], threading.Lock] = {}
+_LOCK = threading.Lock()
+
+
+def get_rerank_model(model_name: str = DEFAULT_RERANK_MODEL, n_gpu: int = -1):
+    """
+    リランクモデルを取得する。モデルごとに1度だけ読み込み、以降はプロセス内で共有する
+
+    Args:
+        model_name (str): モデル名
+        n_gpu (int): 使用するGPU数 (-1の場合は利用可能なすべて、0の場合はCPU)
+    """
+    key = (model_name, n_gpu)
+    with _LOCK:
+        if key not in _MODELS:
+            from ragatouille import RAGPretrainedModel
+            _MODELS[key] = RAGPretrainedModel.from_pretrained(model_name, n_gpu=n_gpu)
+            _MODEL_LOCKS[key] = threading.Lock()
+        return _MODELS[key]
+
+def clear_rerank_models() -> None:
+    """
+    読み込み済みのリランクモデルを破棄する
+    """
+    with _LOCK:
+        _MODELS.clear()
+        _MODEL_LOCKS.clear()
+
+def rerank_batch(
+        queries: Sequence[str],
+        candidates: Sequence[List[Document]],
+        k: int,
+        model_name: str = DEFAULT_RERANK_MODEL,
+        n_gpu: int = -1,
+        batch_size: int = 32,
+        max_length: Optional[int] = None
+        ) -> List[List[Document]]:
+    """
+    複数クエリの候補文書をまとめてリランクする
+
+    全クエリの候補文書の和集合を1度だけエンコードし、各クエリについて自身の候補文書のスコアのみで順位付けする
+    同じ文書が複数クエリの候補となる場合もエンコードは1回で済む
+
+    Args:
+        queries (list): クエリのリスト
+        candidates (list): クエリごとの候補文書のリスト
+        k (int): クエリごとに返す文書数
+        model_name (str): リランクモデル名
+        n_gpu (int): 使用するGPU数 (0の場合はCPU)
+        batch_size (int): エンコード時のバッチサイズ
+        max_length (int): 文書の最大トークン数 (Noneの場合はモデルの設定に従う)。超える部分は切り詰める
+                          共有のモデルの設定はこの呼び出しの間のみ変更し、終了後に元に戻す
+
+    Returns:
+        list: クエリごとのリランク後の文書 (スコアの降順で最大k件)
+    """
+    if not queries:
+        return []
+
+    texts: List[str] = []
+    text_index: Dict[str, int] = {}
+    for docs in candidates:
+        for doc in docs:
+            if doc.page_content not in text_index:
+                text_index[doc.page_content] = len(texts)
+                texts.append(doc.page_content)
+    if not texts:
+        return [[] for _ in queries]
+
+    model = get_rerank_model(model_name, n_gpu)
+    config = getattr(getattr(model, "model", None), "config", None)
+    with _MODEL_LOCKS.setdefault((model_name, n_gpu), threading.Lock()):
+        previous = getattr(config, "doc_maxlen", None)
+        if max_length is not None and previous is not None:
+            config.doc_maxlen = max_length
+        try:
+            with get_metrics().timer("retrieve.rerank", queries=len(queries), documents=len(texts)):
+                results = model.rerank(query=list(queries), documents=texts, k=len(texts), bsize=batch_size)
+        finally:
+            if max_length is not None and previous is not None:
+                config.doc_maxlen = previous
+    if len(queries) == 1 and results and isinstance(results[0], dict):
+        results = [results]
+
+    reranked = []
+    for docs, query_results in zip(candidates, results):
+        scores = {result["result_index"]: result["score"] for result in query_results}
+        scored = []
+        for doc in docs:
+            score = scores.get(text_index[doc.page_content], float("-inf"))
+            scored.append((score, doc))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        kept = []
+        for score, doc in scored[:k]:
+            doc = doc.model_copy()
+            doc.metadata = {**doc.metadata, "relevance_score": score}
+            kept.append(doc)
+        reranked.append(kept)
+    return reranked
+
+
+class SharedColBERTReranker(BaseDocumentCompressor):
+    """
+    共有のリランクモデルを用いるlangchainのDocumentCompressor
+    ContextualCompressionRetrieverのbase_compressorとして利用する
+    """
+
+    model_name: str = DEFAULT_RERANK_MODEL
+    k: int = 5
+    n_gpu: int = -1
+    batch_size: int = 32
+    max_length: Optional[int] = None
+
+    def compress_documents(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None
+            ) -> Sequence[Document]:
+        return rerank_batch(
+            [query], [list(documents)], self.k,
+            model_name=self.model_name,
+            n_gpu=self.n_gpu,
+            batch_size=self.batch_size,
+            max_length=self.max_length
+            )[0]
+
+    def compress_documents_batch(
+            self,
+            documents: Sequence[List[Document]],
+            queries: Sequence[str]
+            ) -> List[List[Document]]:
+        """
+        複数クエリの候補文書をまとめてリランクする
+        """
+        return rerank_batch(
+            queries, documents, self.k,
+            model_name=self.model_name,
+            n_gpu=self.n_gpu,
+            batch_size=self.batch_size,
+            max_length=self.max_length
+            )
@@ -1,26 +1,35 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
-import MeCab
-from sudachipy import tokenizer
-from sudachipy import dictionary
+from langchain.retrievers.contextual_compression import ContextualCompressionRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 
-from ragatouille import RAGPretrainedModel
+from .bm25 import build_bm25_index
+from .context import PackedContextRetriever, normalize_context_config
+from .hybrid import HybridRetriever
+from .query_cache import CachedRetriever, QueryCache, vector_store_version
+from .rerank import DEFAULT_RERANK_MODEL, SharedColBERTReranker
+from .shard import CompanyShardRetriever, CompanyShards
+from ..tools.faiss_index import apply_search_params
+from ..tools.metrics import get_metrics
+from ..tools.tokenizer import mecab_tokenizer, preprocess_func  # noqa: F401
 
-from langchain.retrievers.contextual_compression import ContextualCompressionRetriever
-from langchain.retrievers import BM25Retriever, EnsembleRetriever
 
+class TimedRetriever(BaseRetriever):
+    """
+    内部のRetrieverの検索時間をtools.metricsに段階 (stage) として記録するRetriever
+    """
 
-def mecab_tokenizer(text):
-    mecab = MeCab.Tagger("-Owakati")
-    return mecab.parse(text).split()
+    retriever: Any
+    stage: str
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        with get_metrics().timer(self.stage):
+            return self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
 
-def preprocess_func(text: str) -> List[str]:
-    tokenizer_obj = dictionary.Dictionary(dict="full").create()
-    mode = tokenizer.Tokenizer.SplitMode.A
-    tokens = tokenizer_obj.tokenize(text ,mode)
-    words = [token.surface() for token in tokens]
-    words = list(set(words))
-    return words
 
 def create_retriever(
         vector_store,
@@ -29,49 +38,89 @@ def create_retriever(
         hybrid_topk: int,
         hybrid_weights: List[float],
         rerank: bool,
-        rerank_topk: int
+        rerank_topk: int,
+        bm25_index_dir: Optional[str] = None,
+        rerank_model: str = DEFAULT_RERANK_MODEL,
+        rerank_batch_size: int = 32,
+        rerank_max_length: Optional[int] = None,
+        rerank_n_gpu: int = -1,
+        search_params: Optional[Dict] = None,
+        company_shards: Optional[CompanyShards] = None,
+        query_cache: Optional[QueryCache] = None,
+        context: Optional[Dict] = None,
+        fusion: str = "rrf"
         ):
+    """
+    Vector DBからRetrieverを構築
+
+    hybrid=Trueの場合、BM25 (SparseBM25Index) とのハイブリッド検索 (hybrid.HybridRetriever) とする
+    密ベクトルとBM25の検索は並行に実行し、fusionの方法 ("rrf" / "weighted" / "convex") で文書IDごとにスコアを統合する
+    bm25_index_dirを指定した場合、BM25インデックスを保存し、次回以降はdocstoreとの差分のみを反映して再利用する
+    rerank=Trueの場合、リランクモデルはプロセス内で1度だけ読み込み、複数のRetrieverで共有する
+    search_paramsを指定した場合、近似最近傍探索の精度と速度のパラメータをインデックスに設定する
+    (例: IVFは{"nprobe": 32}、HNSWは{"efSearch": 128}。設定はVector DBのインデックス自体に反映される)
+    company_shardsを指定した場合、クエリに含まれる会社名でその会社のインデックスのみを検索する
+    (密ベクトル・BM25とも。会社名を含まないクエリは全体のインデックスを検索する)
+    密ベクトル (dense)・BM25 (sparse)・統合 (fusion)・リランク (rerank) の処理時間はtools.metricsに記録する
+    contextを指定した場合、検索結果をトークン数の上限内に詰める (重複の除去、MMRによる並べ替え、連続するチャンクの結合。
+    設定はcontext.DEFAULT_CONTEXT_CONFIGを参照)
+    query_cacheを指定した場合、同一・類似のクエリの検索結果を再利用する
+    (キャッシュのインデックスのバージョンはVector DBの内容から設定し、Vector DBが更新された場合はキャッシュを破棄する。
+    類似クエリの再利用はcompany_shardsを指定した場合のみで、振り分け先の会社が一致する場合に限る)
+    """
+    apply_search_params(vector_store.index, search_params)
 
-    def create_rerank_retriever(base_retriever, model="bclavie/JaColBERT"):
-        rerank_model = RAGPretrainedModel.from_pretrained(model)
+    def create_rerank_retriever(base_retriever):
         retriever = ContextualCompressionRetriever(
-            base_compressor=rerank_model.as_langchain_document_compressor(k=rerank_topk),
+            base_compressor=SharedColBERTReranker(
+                model_name=rerank_model,
+                k=rerank_topk,
+                n_gpu=rerank_n_gpu,
+                batch_size=rerank_batch_size,
+                max_length=rerank_max_length
+                ),
             base_retriever=base_retriever
         )
         return retriever
 
-    def create_hybrid_retriever(vector_store, retriever):
-        docs = []
-        for id, doc in vector_store.docstore._dict.items():
-            docs.append(doc)
-
-        for_hybrid_retriever = BM25Retriever.from_documents(
-            documents=docs,
-            k=hybrid_topk,
+    def create_hybrid_retriever(vector_store):
+        retriever = HybridRetriever(
+            vector_store=vector_store,
+            bm25_index=build_bm25_index(vector_store, index_dir=bm25_index_dir),
+            shards=company_shards,
+            topk=topk,
+            hybrid_topk=hybrid_topk,
+            weights=hybrid_weights,
+            fusion=fusion,
             preprocess_func=preprocess_func
             )
-        retriever = EnsembleRetriever(
-            retrievers=[retriever, for_hybrid_retriever],
-            weights=hybrid_weights
-        )
         return retriever
 
-    retriever = vector_store.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": topk}
-        )
     if hybrid:
-        retriever = create_hybrid_retriever(
-            vector_store=vector_store,
-            retriever=retriever
-            )
-        if rerank:
-            retriever = create_rerank_retriever(
-                base_retriever=retriever
-            )
+        retriever = create_hybrid_retriever(vector_store=vector_store)
+    else:
+        if company_shards is not None:
+            retriever = CompanyShardRetriever(shards=company_shards, k=topk, mode="dense")
+        else:
+            retriever = vector_store.as_retriever(
+                search_type="similarity",
+                search_kwargs={"k": topk}
+                )
+        retriever = TimedRetriever(retriever=retriever, stage="retrieve.dense")
 
     if rerank:
         retriever = create_rerank_retriever(
                 base_retriever=retriever
             )
-    return retriever
\ No newline at end of file
+
+    if context is not None:
+        retriever = PackedContextRetriever(
+            retriever=retriever, vector_store=vector_store, config=normalize_context_config(context)
+            )
+
+    if query_cache is not None:
+        query_cache.set_index_version(vector_store_version(vector_store))
+        retriever = CachedRetriever(
+            retriever=retriever, cache=query_cache, embeddings=vector_store.embeddings, shards=company_shards
+            )
+    return retriever
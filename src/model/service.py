@@ -0,0 +1,733 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import deque
+from http import HTTPStatus
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from langchain_core.documents import Document
+
+from .bm25 import build_bm25_index
+from .context import normalize_context_config, pack_context
+from .hybrid import FUSION_METHODS, hybrid_search_batch
+from .qa import agenerate_answer, format_context, parse_answer
+from .rerank import DEFAULT_RERANK_MODEL, get_rerank_model, rerank_batch
+from .shard import build_company_shards
+from ..tools.create_docs import get_current_version
+from ..tools.embedding import count_tokens
+from ..tools.faiss_index import read_faiss_store
+from ..tools.metrics import get_metrics
+from ..tools.rate_limit import AsyncRateLimiter
+
+
+# 検索サービスの設定の既定値
+DEFAULT_SERVICE_CONFIG = {
+    # 検索 (qa.retrieve_batchと同じ)
+    "topk": 30,
+    "hybrid": True,
+    "hybrid_topk": 30,
+    "hybrid_weights": [0.5, 0.5],
+    "fusion": "rrf",
+    "company_routing": False,       # 質問に含まれる会社名でその会社のインデックスのみを検索するか
+    "search_params": None,          # 近似最近傍探索のパラメータ (nprobe, efSearchなど)
+    "mmap": True,                   # インデックスをメモリマップとして読み込むか
+    # リランク
+    "rerank": False,
+    "rerank_topk": 10,
+    "rerank_model": DEFAULT_RERANK_MODEL,
+    "rerank_batch_size": 32,
+    "rerank_max_length": None,
+    "rerank_n_gpu": -1,
+    # 回答 (/answer)
+    "context": None,                # コンテキストの組み立ての設定 (context.DEFAULT_CONTEXT_CONFIGを参照。Noneの場合は検索結果をすべて渡す)
+    "max_concurrency": 8,           # LLM呼び出しの同時実行数
+    "max_retries": 3,
+    "max_answer_tokens": 54,
+    # マイクロバッチ
+    "max_batch_size": 32,           # 1回にまとめるリクエスト数の上限
+    "max_wait_ms": 5.0,             # 最初のリクエストから後続のリクエストを待つ時間
+    "batch_workers": 2,             # 同時に処理するバッチ数 (埋め込みのリクエスト中も次のバッチを処理できる)
+    # ホットリロード・統計
+    "reload_interval": 5.0,         # 新しいバージョンのインデックスを確認する間隔 (秒。0の場合は確認しない)
+    "stats_window": 1000,           # レイテンシの分位点を求める直近のリクエスト数
+}
+
+# /answerのプロンプトの既定値 (promptを指定しない場合)
+DEFAULT_ANSWER_PROMPT = "以下の情報のみを用いて、質問に簡潔に回答してください。\n\n情報: {context}\n\n質問: {question}\n回答:"
+
+# HTTPリクエストの本文の最大バイト数
+MAX_BODY_BYTES = 1024 * 1024
+# 統計を記録するエンドポイント (それ以外のパスへのリクエストは"other"としてまとめる)
+ENDPOINTS = ("/search", "/answer", "/reload", "/stats", "/metrics", "/health")
+
+
+def normalize_service_config(config: Optional[Dict] = None) -> Dict:
+    merged = {**DEFAULT_SERVICE_CONFIG, **(config or {})}
+    unknown = set(merged) - set(DEFAULT_SERVICE_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown service config keys: {sorted(unknown)}")
+    if merged["fusion"] not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {merged['fusion']} (expected one of {FUSION_METHODS})")
+    if merged["max_batch_size"] < 1 or merged["batch_workers"] < 1:
+        raise ValueError("max_batch_size and batch_workers must be >= 1")
+    if merged["context"] is not None:
+        merged["context"] = normalize_context_config(merged["context"])
+    return merged
+
+def _json_default(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+def _document_json(doc: Document, score: Optional[float]) -> Dict:
+    # BM25用の分かち書き結果は応答に含めない
+    metadata = {key: value for key, value in doc.metadata.items() if key != "tokens"}
+    return {"id": doc.id, "page_content": doc.page_content, "metadata": metadata, "score": score}
+
+def _latency_summary(latencies) -> Dict:
+    if not latencies:
+        return {"count": 0}
+    values = np.asarray(latencies, dtype=np.float64)
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+class IndexState:
+    """
+    読み込み済みの1バージョン分のインデックス (Vector DB、BM25インデックス、会社ごとのインデックス)
+    ホットリロードでは新しいIndexStateを読み込んでから参照を差し替え、処理中のバッチは読み込み時のIndexStateを使い続ける
+    """
+
+    def __init__(self, version: str, vector_store, manifest: Dict, bm25_index=None, shards=None):
+        self.version = version
+        self.vector_store = vector_store
+        self.manifest = manifest
+        self.bm25_index = bm25_index
+        self.shards = shards
+        self.loaded_at = time.time()
+
+    def __len__(self) -> int:
+        return self.vector_store.index.ntotal
+
+
+def load_index_state(index_dir: str, embeddings, config: Dict) -> Optional[IndexState]:
+    """
+    index_dirの現在のバージョン (create_docs.process_files_in_batchesで保存したもの) を読み込む
+    BM25インデックスはバージョンのディレクトリ内 (<index_dir>/<バージョン>/bm25) に保存し、2回目以降は読み込むのみとする
+
+    Returns:
+        IndexState: 読み込んだインデックス (保存済みのバージョンがない場合はNone)
+    """
+    version = get_current_version(index_dir)
+    if version is None:
+        return None
+    # CURRENTが読み込み中に差し替えられてもバージョンとインデックスが食い違わないよう、バージョンのディレクトリから直接読み込む
+    version_dir = os.path.join(index_dir, version)
+    vector_store = read_faiss_store(version_dir, embeddings, mmap=config["mmap"], search_params=config["search_params"])
+    with open(os.path.join(version_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    bm25_index = None
+    if config["hybrid"]:
+        bm25_index = build_bm25_index(vector_store, index_dir=os.path.join(version_dir, "bm25"))
+    shards = None
+    if config["company_routing"]:
+        shards = build_company_shards(vector_store, bm25=config["hybrid"])
+    return IndexState(version, vector_store, manifest, bm25_index, shards)
+
+
+class MicroBatcher:
+    """
+    同時に届いたリクエストをまとめて1回の処理 (handler) に渡す
+
+    ・最初のリクエストからmax_wait秒またはmax_batch_size件に達するまで後続のリクエストを待ち、まとめてhandlerを呼び出す
+    ・handlerはスレッドで実行し、workers個のバッチを同時に処理する (処理中も次のバッチの受け付けは止めない)
+    ・handlerが例外を送出した場合は、そのバッチのすべてのリクエストに例外を返す
+
+    Args:
+        handler (callable): リクエストのリストを受け取り、同じ順の結果のリストを返す関数
+        max_batch_size (int): 1回にまとめるリクエスト数の上限
+        max_wait (float): 後続のリクエストを待つ秒数
+        workers (int): 同時に処理するバッチ数
+        name (str): 計測値のラベル
+    """
+
+    def __init__(
+            self,
+            handler: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 32,
+            max_wait: float = 0.005,
+            workers: int = 2,
+            name: str = "search"
+            ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.max_size = 0
+        self.in_flight = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        metrics = get_metrics()
+        while True:
+            batch = await self._collect()
+            # 待っている間に取り消されたリクエスト (接続の切断など) は処理しない
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            self.max_size = max(self.max_size, len(batch))
+            self.in_flight += len(batch)
+            metrics.observe("service_batch_size", len(batch), batcher=self.name)
+            metrics.observe("service_queue_depth", self.queued, batcher=self.name)
+            try:
+                results = await loop.run_in_executor(None, self.handler, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self.in_flight -= len(batch)
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_size,
+        }
+
+
+class RetrievalService:
+    """
+    保存済みのインデックスを1度だけ読み込み、検索と回答をHTTPで提供するローカルのサービス (asyncio)
+
+    ・POST /search  : {"query": str} または {"queries": [str, ...]} (任意で"k": 正の整数) -> 検索結果の文書とスコア
+    ・POST /answer  : {"question": str} -> 回答と参照文書 (llmを指定した場合のみ)
+    ・POST /reload  : 新しいバージョンのインデックスを直ちに読み込む
+    ・GET  /stats   : インデックスのバージョン、キューの滞留数、バッチサイズ、エンドポイントごとのレイテンシ
+    ・GET  /metrics : tools.metricsの計測値 (Prometheus形式)
+    ・GET  /health  : インデックスの読み込み状況
+
+    同時に届いた/searchと/answerの検索はMicroBatcherでまとめ、埋め込み・FAISS検索・BM25・リランクを1回ずつ実行する
+    index_dirのCURRENTが更新された場合 (process_files_in_batchesでの再保存)、新しいバージョンを別スレッドで読み込み、
+    読み込み後に参照を差し替える (差し替えまでは古いバージョンで応答を続ける)
+
+    Args:
+        index_dir (str): create_docs.process_files_in_batchesで保存したVector DBのディレクトリ
+        embeddings: LangChainのEmbeddings (インデックスの構築時と同じモデル)
+        config (dict): サービスの設定 (DEFAULT_SERVICE_CONFIGを参照)
+        llm: langchainのChatModel (Noneの場合は/answerを提供しない)
+        prompt (PromptTemplate): "context"と"question"を入力に持つプロンプト (Noneの場合はDEFAULT_ANSWER_PROMPT)
+        output_parser: 回答のパーサー ("answer"キーを持つdictを返す)
+        limiter (AsyncRateLimiter): LLM呼び出しのレート制限
+    """
+
+    def __init__(
+            self,
+            index_dir: str,
+            embeddings,
+            config: Optional[Dict] = None,
+            llm=None,
+            prompt=None,
+            output_parser=None,
+            limiter: Optional[AsyncRateLimiter] = None
+            ):
+        self.index_dir = index_dir
+        self.embeddings = embeddings
+        self.config = normalize_service_config(config)
+        self.llm = llm
+        self.prompt = prompt
+        self.output_parser = output_parser
+        self.limiter = limiter
+        self.state: Optional[IndexState] = None
+        self.reloads = 0
+        self.last_reload_error: Optional[str] = None
+        self.started_at = time.time()
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        self.batcher = MicroBatcher(
+            self._search_batch,
+            max_batch_size=self.config["max_batch_size"],
+            max_wait=self.config["max_wait_ms"] / 1000,
+            workers=self.config["batch_workers"],
+            )
+        self._latencies: Dict[str, deque] = {}
+        self._requests: Dict[str, Dict[str, int]] = {}
+        # リランクモデルはスレッド間で同時に呼び出さない
+        self._rerank_lock = threading.Lock()
+        self._reload_lock: Optional[asyncio.Lock] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def open(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        インデックス (とリランクモデル) を読み込み、HTTPの待ち受けを開始する
+        保存済みのバージョンがない場合も起動し、バージョンが保存されるまで/searchには503を返す
+        """
+        self._reload_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(self.config["max_concurrency"])
+        self._stopped = asyncio.Event()
+        await self.reload()
+        if self.config["rerank"]:
+            await asyncio.to_thread(get_rerank_model, self.config["rerank_model"], self.config["rerank_n_gpu"])
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        if self.config["reload_interval"] > 0:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        stopが呼ばれるまで (またはタスクが取り消されるまで) サービスを実行する
+        """
+        await self.open(host, port)
+        print(f"Serving {self.index_dir} (version {self.state and self.state.version}) on {self.base_url}", flush=True)
+        try:
+            await self._stopped.wait()
+        finally:
+            await self.close()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "RetrievalService":
+        """
+        別スレッドのイベントループでサービスを起動する (ベンチマーク・ノートブック向け)
+        port=0の場合は空いているポートを用いる (base_urlで参照する)
+        """
+        ready = threading.Event()
+        errors: List[BaseException] = []
+
+        async def run():
+            self._loop = asyncio.get_running_loop()
+            try:
+                await self.open(host, port)
+            except BaseException as e:
+                errors.append(e)
+                ready.set()
+                return
+            ready.set()
+            try:
+                await self._stopped.wait()
+            finally:
+                await self.close()
+
+        self._thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self) -> None:
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "RetrievalService":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    async def reload(self, force: bool = False) -> bool:
+        """
+        index_dirの現在のバージョンが読み込み済みのものと異なる場合に読み込み、参照を差し替える
+        読み込みに失敗した場合は読み込み済みのバージョンで応答を続ける
+
+        Returns:
+            bool: 新しいバージョンに差し替えたか
+        """
+        async with self._reload_lock:
+            version = await asyncio.to_thread(get_current_version, self.index_dir)
+            if version is None or (not force and self.state is not None and version == self.state.version):
+                return False
+            start = time.perf_counter()
+            try:
+                with get_metrics().timer("service.reload", version=version):
+                    state = await asyncio.to_thread(load_index_state, self.index_dir, self.embeddings, self.config)
+            except Exception as e:
+                self.last_reload_error = f"{type(e).__name__}: {e}"
+                print(f"Failed to load index version {version}: {self.last_reload_error}", flush=True)
+                return False
+            if state is None:
+                return False
+            previous = self.state.version if self.state is not None else None
+            self.state = state
+            self.reloads += 1
+            self.last_reload_error = None
+            get_metrics().inc("service_reloads_total")
+            print(
+                f"Loaded index version {state.version} ({len(state)} vectors, {time.perf_counter() - start:.1f}s, "
+                f"previous: {previous})",
+                flush=True
+                )
+            return True
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.config["reload_interval"])
+            try:
+                await self.reload()
+            except Exception as e:
+                self.last_reload_error = f"{type(e).__name__}: {e}"
+
+    def _search_batch(self, queries: List[str]) -> List[Tuple[IndexState, List[Document], List[float]]]:
+        """
+        マイクロバッチの検索 (スレッドで実行する)。バッチ内のクエリはすべて同じバージョンのインデックスで検索する
+        """
+        state = self.state
+        if state is None:
+            raise LookupError("index is not loaded yet")
+        config = self.config
+        results, _ = hybrid_search_batch(
+            queries,
+            state.vector_store,
+            topk=config["topk"],
+            bm25_index=state.bm25_index,
+            hybrid_topk=config["hybrid_topk"],
+            hybrid_weights=config["hybrid_weights"],
+            fusion=config["fusion"],
+            shards=state.shards
+            )
+        docstore = state.vector_store.docstore
+        candidates = [[docstore.search(doc_id) for doc_id, _ in result] for result in results]
+        scores = [[score for _, score in result] for result in results]
+        if config["rerank"]:
+            with self._rerank_lock:
+                candidates = rerank_batch(
+                    queries,
+                    candidates,
+                    config["rerank_topk"],
+                    model_name=config["rerank_model"],
+                    n_gpu=config["rerank_n_gpu"],
+                    batch_size=config["rerank_batch_size"],
+                    max_length=config["rerank_max_length"]
+                    )
+            scores = [[doc.metadata["relevance_score"] for doc in docs] for docs in candidates]
+        return [(state, docs, doc_scores) for docs, doc_scores in zip(candidates, scores)]
+
+    async def search(self, query: str, k: Optional[int] = None) -> Dict:
+        state, docs, scores = await self.batcher.submit(query)
+        if k is not None:
+            docs, scores = docs[:k], scores[:k]
+        return {
+            "query": query,
+            "version": state.version,
+            "documents": [_document_json(doc, score) for doc, score in zip(docs, scores)],
+        }
+
+    async def answer(self, question: str) -> Dict:
+        state, docs, _ = await self.batcher.submit(question)
+        if self.config["context"] is not None:
+            docs = await asyncio.to_thread(pack_context, docs, state.vector_store, **self.config["context"])
+        prompt_text = (self.prompt.format if self.prompt is not None else DEFAULT_ANSWER_PROMPT.format)(
+            context=format_context(docs), question=question
+            )
+        outcome = await agenerate_answer(
+            self.llm, prompt_text, self._semaphore, self.limiter,
+            count_tokens(prompt_text) + self.config["max_answer_tokens"],
+            self.config["max_retries"]
+            )
+        return {
+            "question": question,
+            "answer": parse_answer(outcome, self.output_parser, self.config["max_answer_tokens"]),
+            "version": state.version,
+            "documents": [_document_json(doc, None) for doc in docs],
+        }
+
+    def stats(self) -> Dict:
+        state = self.state
+        return {
+            "index": {
+                "version": state.version if state is not None else None,
+                "vectors": len(state) if state is not None else 0,
+                "loaded_at": state.loaded_at if state is not None else None,
+                "reloads": self.reloads,
+                "last_reload_error": self.last_reload_error,
+            },
+            "uptime_seconds": time.time() - self.started_at,
+            "queue": self.batcher.stats(),
+            "endpoints": {
+                endpoint: {**counts, "latency": _latency_summary(self._latencies[endpoint])}
+                for endpoint, counts in self._requests.items()
+            },
+        }
+
+    def _record_request(self, endpoint: str, status: int, seconds: float) -> None:
+        # 任意のパスごとに統計が増え続けないよう、未知のパスは1つにまとめる
+        endpoint = endpoint if endpoint in ENDPOINTS else "other"
+        counts = self._requests.setdefault(endpoint, {"requests": 0, "errors": 0})
+        counts["requests"] += 1
+        if status >= 400:
+            counts["errors"] += 1
+        self._latencies.setdefault(endpoint, deque(maxlen=self.config["stats_window"])).append(seconds)
+        get_metrics().observe("service_request_seconds", seconds, endpoint=endpoint, status=str(status))
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        if method == "GET" and path == "/health":
+            status = HTTPStatus.OK if self.state is not None else HTTPStatus.SERVICE_UNAVAILABLE
+            return status, {"status": "ok" if self.state is not None else "loading"}
+        if method == "GET" and path == "/stats":
+            return HTTPStatus.OK, self.stats()
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, get_metrics().to_prometheus()
+        if method == "POST" and path == "/reload":
+            reloaded = await self.reload()
+            return HTTPStatus.OK, {"reloaded": reloaded, "version": self.state.version if self.state else None}
+        if method != "POST" or path not in ("/search", "/answer"):
+            return HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint: {method} {path}"}
+
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {"error": f"Invalid JSON: {e}"}
+        if not isinstance(payload, dict):
+            return HTTPStatus.BAD_REQUEST, {"error": "request body must be a JSON object"}
+        k = payload.get("k")
+        if k is not None and (isinstance(k, bool) or not isinstance(k, int) or k < 1):
+            return HTTPStatus.BAD_REQUEST, {"error": "'k' must be a positive integer"}
+        if self.state is None:
+            return HTTPStatus.SERVICE_UNAVAILABLE, {"error": "index is not loaded yet"}
+
+        if path == "/search":
+            if isinstance(payload.get("queries"), list) and all(isinstance(q, str) for q in payload["queries"]):
+                results = await asyncio.gather(*(self.search(query, k) for query in payload["queries"]))
+                return HTTPStatus.OK, {"results": list(results)}
+            if isinstance(payload.get("query"), str):
+                return HTTPStatus.OK, await self.search(payload["query"], k)
+            return HTTPStatus.BAD_REQUEST, {"error": "'query' (str) or 'queries' (list of str) is required"}
+
+        if self.llm is None:
+            return HTTPStatus.NOT_FOUND, {"error": "answer is not configured (no llm)"}
+        if not isinstance(payload.get("question"), str):
+            return HTTPStatus.BAD_REQUEST, {"error": "'question' (str) is required"}
+        return HTTPStatus.OK, await self.answer(payload["question"])
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        HTTP/1.1の1接続を処理する (keep-aliveで同じ接続の複数リクエストに順に応答する)
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY_BYTES:
+                    status, payload = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "request body is too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    keep_alive = version.strip() == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    path = urlsplit(target).path
+                    start = time.perf_counter()
+                    try:
+                        status, payload = await self._dispatch(method, path, body)
+                    except LookupError as e:
+                        status, payload = HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(e)}
+                    except Exception as e:
+                        status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+                    self._record_request(path, status, time.perf_counter() - start)
+
+                if isinstance(payload, str):
+                    data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+                else:
+                    data = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+                    content_type = "application/json"
+                head = (
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"content-type: {content_type}; charset=utf-8\r\n"
+                    f"content-length: {len(data)}\r\n"
+                    f"connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    )
+                writer.write(head.encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="保存済みのインデックスを読み込み、検索と回答をHTTPで提供する")
+    parser.add_argument("--index-dir", required=True, help="process_files_in_batchesで保存したVector DBのディレクトリ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--topk", type=int, default=DEFAULT_SERVICE_CONFIG["topk"])
+    parser.add_argument("--no-hybrid", action="store_true", help="BM25とのハイブリッド検索を行わない")
+    parser.add_argument("--hybrid-topk", type=int, default=DEFAULT_SERVICE_CONFIG["hybrid_topk"])
+    parser.add_argument("--fusion", choices=FUSION_METHODS, default=DEFAULT_SERVICE_CONFIG["fusion"])
+    parser.add_argument("--company-routing", action="store_true", help="質問に含まれる会社名でその会社のインデックスのみを検索する")
+    parser.add_argument("--rerank", action="store_true")
+    parser.add_argument("--rerank-topk", type=int, default=DEFAULT_SERVICE_CONFIG["rerank_topk"])
+    parser.add_argument("--context-max-tokens", type=int, default=None, help="回答のコンテキストのトークン数の上限")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_SERVICE_CONFIG["max_batch_size"])
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_SERVICE_CONFIG["max_wait_ms"])
+    parser.add_argument("--batch-workers", type=int, default=DEFAULT_SERVICE_CONFIG["batch_workers"])
+    parser.add_argument(
+        "--reload-interval", type=float, default=DEFAULT_SERVICE_CONFIG["reload_interval"],
+        help="新しいバージョンのインデックスを確認する間隔 (秒。0の場合は/reloadでのみ読み込む)"
+        )
+    parser.add_argument("--no-mmap", action="store_true", help="インデックスをメモリに読み込む")
+    parser.add_argument(
+        "--embedding-base-url", default=None,
+        help="OpenAI互換の埋め込みAPIのURL (benchmarks.stub_serverなど。省略時はAzure OpenAIの環境変数を用いる)"
+        )
+    parser.add_argument("--llm-base-url", default=None, help="OpenAI互換のChat Completions APIのURL (省略時はAzure OpenAI)")
+    parser.add_argument("--no-answer", action="store_true", help="/answerを提供しない")
+    parser.add_argument("--prompt-file", default=None, help="回答のプロンプト ({context}と{question}を含むテキスト)")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from dotenv import load_dotenv
+    from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings, ChatOpenAI, OpenAIEmbeddings
+
+    args = build_parser().parse_args(argv)
+    load_dotenv()
+
+    config = {
+        "topk": args.topk,
+        "hybrid": not args.no_hybrid,
+        "hybrid_topk": args.hybrid_topk,
+        "fusion": args.fusion,
+        "company_routing": args.company_routing,
+        "rerank": args.rerank,
+        "rerank_topk": args.rerank_topk,
+        "max_batch_size": args.max_batch_size,
+        "max_wait_ms": args.max_wait_ms,
+        "batch_workers": args.batch_workers,
+        "reload_interval": args.reload_interval,
+        "mmap": not args.no_mmap,
+    }
+    if args.context_max_tokens is not None:
+        config["context"] = {"max_tokens": args.context_max_tokens}
+
+    if args.embedding_base_url is not None:
+        embeddings = OpenAIEmbeddings(
+            model="stub", base_url=args.embedding_base_url, api_key="stub", check_embedding_ctx_length=False
+            )
+    else:
+        embeddings = AzureOpenAIEmbeddings(model=os.getenv("EMBEDDING"))
+
+    llm = None
+    if not args.no_answer:
+        if args.llm_base_url is not None:
+            llm = ChatOpenAI(model="stub", base_url=args.llm_base_url, api_key="stub", max_retries=0)
+        else:
+            llm = AzureChatOpenAI(
+                openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                deployment_name=os.getenv("MODEL"),
+                api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+                temperature=0,
+                top_p=1,
+                max_tokens=54,
+                max_retries=0,
+                )
+
+    prompt = None
+    if args.prompt_file is not None:
+        from langchain_core.prompts import PromptTemplate
+
+        with open(args.prompt_file, "r", encoding="utf-8") as f:
+            prompt = PromptTemplate.from_template(f.read())
+
+    service = RetrievalService(args.index_dir, embeddings, config=config, llm=llm, prompt=prompt)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .bm25 import SparseBM25Index
+from ..tools.aho_corasick import AhoCorasick
+from ..tools.faiss_index import create_faiss_index
+from ..tools.tokenizer import preprocess_func, tokenize
+
+
+# 会社名の別名を生成する際に取り除く法人格の表記 (NFKCで正規化済みの形)
+LEGAL_FORMS = ("株式会社", "(株)", "有限会社", "合同会社")
+
+
+def normalize_company_text(text: str) -> str:
+    """
+    会社名の照合用にテキストを正規化する (NFKC、英字の小文字化、空白の除去)
+    """
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+def company_aliases(company: str, min_length: int = 2) -> List[str]:
+    """
+    会社名から照合用の別名 (正規化した会社名、法人格を除いた会社名) を生成する
+    """
+    name = normalize_company_text(company)
+    aliases = {name}
+    stripped = name
+    for legal_form in LEGAL_FORMS:
+        stripped = stripped.replace(legal_form, "")
+    if len(stripped) >= min_length:
+        aliases.add(stripped)
+    return sorted(aliases)
+
+def get_document_company(doc: Document) -> str:
+    """
+    文書の会社名を取得する (metadata["company"]がない場合は、チャンク先頭に付与したファイル名を用いる)
+    """
+    company = doc.metadata.get("company")
+    if company:
+        return company
+    return doc.page_content.split("\n", 1)[0].strip()
+
+def search_faiss_index(index: faiss.Index, doc_ids, query_vectors: np.ndarray, k: int) -> List[List[Tuple[str, float]]]:
+    """
+    FAISSのインデックスを検索し、位置を文書IDに変換する
+
+    Args:
+        index (faiss.Index): インデックス
+        doc_ids: 位置 -> 文書ID (listまたはlangchainのindex_to_docstore_id)
+        query_vectors (np.ndarray): (クエリ数, 次元数) のクエリのベクトル
+        k (int): クエリごとの検索件数
+
+    Returns:
+        list: クエリごとの (文書ID, 距離) のリスト
+    """
+    if not len(query_vectors):
+        return []
+    distances, indices = index.search(np.ascontiguousarray(query_vectors, dtype=np.float32), k)
+    results = []
+    for row_distances, row_indices in zip(distances, indices):
+        results.append([
+            (doc_ids[i], float(d))
+            for d, i in zip(row_distances, row_indices) if i != -1
+        ])
+    return results
+
+
+class CompanyMatcher:
+    """
+    Aho-Corasick法でクエリに含まれる会社名 (別名を含む) を検出する
+
+    Args:
+        companies: 会社名のリスト
+        aliases (dict): 会社名 -> 追加の別名のリスト
+    """
+
+    def __init__(self, companies: Iterable[str], aliases: Optional[Dict[str, Iterable[str]]] = None):
+        aliases = aliases or {}
+        table: Dict[str, set] = {}
+        for company in companies:
+            names = company_aliases(company) + [normalize_company_text(alias) for alias in aliases.get(company, ())]
+            for name in names:
+                table.setdefault(name, set()).add(company)
+        # 同じ別名を持つ会社はまとめて返す
+        self.automaton = AhoCorasick({name: tuple(sorted(owners)) for name, owners in table.items()})
+
+    def match(self, query: str) -> List[str]:
+        """
+        クエリに含まれる会社名を出現順に返す (一方が他方を含む別名は長い方を優先する)
+        """
+        matched = []
+        for _, _, companies in self.automaton.find_longest(normalize_company_text(query)):
+            for company in companies:
+                if company not in matched:
+                    matched.append(company)
+        return matched
+
+
+class CompanyShard:
+    """
+    1社分の文書のインデックス (密ベクトルとBM25)
+    """
+
+    def __init__(self, doc_ids: List[str], index: faiss.Index, bm25: Optional[SparseBM25Index] = None):
+        self.doc_ids = doc_ids
+        self.index = index
+        self.bm25 = bm25
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+
+class CompanyShards:
+    """
+    会社ごとのインデックスと、クエリを該当する会社のインデックスに振り分けるルーター
+
+    クエリに会社名が含まれる場合はその会社のインデックスのみを検索し (複数社の場合は結果を統合)、
+    含まれない場合は全体のインデックスを検索する
+    """
+
+    def __init__(self, vector_store, shards: Dict[str, CompanyShard], matcher: CompanyMatcher):
+        self.vector_store = vector_store
+        self.shards = shards
+        self.matcher = matcher
+
+    @property
+    def companies(self) -> List[str]:
+        return list(self.shards)
+
+    def route(self, query: str) -> List[str]:
+        """
+        クエリの検索対象とする会社名を返す (空の場合は全体のインデックスを検索する)
+        """
+        return [company for company in self.matcher.match(query) if company in self.shards]
+
+    def dense_search_batch(
+            self,
+            query_vectors: np.ndarray,
+            routes: Sequence[List[str]],
+            k: int
+            ) -> List[List[Tuple[str, float]]]:
+        """
+        クエリのベクトルを振り分け先ごとにまとめて検索する (会社ごとにsearchを1回呼び出す)
+
+        Returns:
+            list: クエリごとの (文書ID, 距離) のリスト (距離の昇順)
+        """
+        query_vectors = np.array(query_vectors, dtype=np.float32)
+        if getattr(self.vector_store, "_normalize_L2", False):
+            faiss.normalize_L2(query_vectors)
+
+        results: List[List[Tuple[str, float]]] = [[] for _ in routes]
+        fallback_rows = [i for i, companies in enumerate(routes) if not companies]
+        if fallback_rows:
+            fallback_results = search_faiss_index(
+                self.vector_store.index, self.vector_store.index_to_docstore_id, query_vectors[fallback_rows], k
+                )
+            for i, result in zip(fallback_rows, fallback_results):
+                results[i] = result
+
+        for company, rows in _group_by_company(routes).items():
+            shard = self.shards[company]
+            for i, result in zip(rows, search_faiss_index(shard.index, shard.doc_ids, query_vectors[rows], k)):
+                results[i].extend(result)
+
+        for i, companies in enumerate(routes):
+            if len(companies) > 1:
+                results[i] = sorted(results[i], key=lambda item: item[1])[:k]
+        return results
+
+    def sparse_search_batch(
+            self,
+            queries_tokens: Sequence[List[str]],
+            routes: Sequence[List[str]],
+            k: int,
+            fallback_index: Optional[SparseBM25Index] = None
+            ) -> List[Tuple[List[str], np.ndarray]]:
+        """
+        分かち書き済みのクエリを振り分け先ごとにまとめてBM25で検索する
+        振り分け先がないクエリはfallback_index (全体のBM25インデックス) で検索する
+
+        会社ごとのBM25インデックスはidfと平均文書長がそれぞれ異なり、スコアをそのまま比較できないため、
+        複数の会社に振り分けたクエリは会社ごとにスコアを0-1に正規化 (min-max) してから統合する
+
+        Returns:
+            list: クエリごとの (文書IDのリスト, スコア) (スコアの降順)
+        """
+        results: List[Tuple[List[str], np.ndarray]] = [([], np.zeros(0, dtype=np.float32)) for _ in routes]
+        fallback_rows = [i for i, companies in enumerate(routes) if not companies]
+        if fallback_rows and fallback_index is not None:
+            fallback_results = fallback_index.batch_search([queries_tokens[i] for i in fallback_rows], k)
+            for i, result in zip(fallback_rows, fallback_results):
+                results[i] = result
+
+        partial: Dict[int, List[Tuple[str, float]]] = {}
+        for company, rows in _group_by_company(routes).items():
+            shard = self.shards[company]
+            if shard.bm25 is None:
+                continue
+            for i, (doc_ids, scores) in zip(rows, shard.bm25.batch_search([queries_tokens[i] for i in rows], k)):
+                if len(routes[i]) > 1 and len(scores):
+                    # スコアの降順のため、先頭が最大・末尾が最小 (すべて同じ場合は1とする)
+                    spread = scores[0] - scores[-1]
+                    scores = (scores - scores[-1]) / spread if spread > 0 else np.ones_like(scores)
+                partial.setdefault(i, []).extend(zip(doc_ids, scores.tolist()))
+
+        for i, items in partial.items():
+            items = sorted(items, key=lambda item: item[1], reverse=True)[:k]
+            results[i] = ([doc_id for doc_id, _ in items], np.asarray([score for _, score in items], dtype=np.float32))
+        return results
+
+
+def _group_by_company(routes: Sequence[List[str]]) -> Dict[str, List[int]]:
+    groups: Dict[str, List[int]] = {}
+    for i, companies in enumerate(routes):
+        for company in companies:
+            groups.setdefault(company, []).append(i)
+    return groups
+
+def build_company_shards(
+        vector_store,
+        aliases: Optional[Dict[str, Iterable[str]]] = None,
+        storage: str = "float32",
+        bm25: bool = True,
+        **bm25_kwargs
+        ) -> CompanyShards:
+    """
+    Vector DBの文書を会社ごとに分け、会社ごとの密ベクトルのインデックス (全件探索) とBM25インデックスを構築する
+
+    ベクトルは全体のインデックスから復元する (PQで保持している場合は量子化後の近似値となる)
+    1社あたりの文書数は少ないため、会社ごとのインデックスは全件探索とする
+
+    Args:
+        vector_store (FAISS): Vector DB
+        aliases (dict): 会社名 -> 追加の別名のリスト (クエリの会社名の検出に用いる)
+        storage (str): 会社ごとのインデックスでのベクトルの保持形式 ("float32" または "float16")
+        bm25 (bool): 会社ごとのBM25インデックスを構築するか
+        **bm25_kwargs: SparseBM25Indexのパラメータ
+
+    Returns:
+        CompanyShards: 会社ごとのインデックスとルーター
+    """
+    if storage not in ("float32", "float16"):
+        raise ValueError(f"Unsupported shard storage: {storage} (expected 'float32' or 'float16')")
+
+    index = vector_store.index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # IVFからベクトルを復元するには位置 -> 転置リストの対応表が必要
+        ivf.make_direct_map()
+
+    docstore = vector_store.docstore
+    positions_by_company: Dict[str, List[int]] = {}
+    for position in sorted(vector_store.index_to_docstore_id):
+        doc = docstore.search(vector_store.index_to_docstore_id[position])
+        positions_by_company.setdefault(get_document_company(doc), []).append(position)
+
+    shards = {}
+    for company, positions in positions_by_company.items():
+        doc_ids = [vector_store.index_to_docstore_id[position] for position in positions]
+        shard_index = create_faiss_index(index.d, {"type": "flat", "storage": storage})
+        shard_index.add(index.reconstruct_batch(np.asarray(positions, dtype=np.int64)))
+
+        shard_bm25 = None
+        if bm25:
+            docs = [docstore.search(doc_id) for doc_id in doc_ids]
+            shard_bm25 = SparseBM25Index.from_tokens(
+                doc_ids,
+                (doc.metadata.get("tokens") or tokenize(doc.page_content) for doc in docs),
+                **bm25_kwargs
+                )
+        shards[company] = CompanyShard(doc_ids, shard_index, shard_bm25)
+
+    return CompanyShards(vector_store, shards, CompanyMatcher(shards, aliases))
+
+
+class CompanyShardRetriever(BaseRetriever):
+    """
+    クエリに含まれる会社名で検索対象のインデックスを振り分けるRetriever
+    mode="dense"の場合は密ベクトル、mode="sparse"の場合はBM25で検索する
+    """
+
+    shards: Any
+    k: int = 4
+    mode: str = "dense"
+    fallback_index: Any = None
+    preprocess_func: Callable[[str], List[str]] = preprocess_func
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+            ) -> List[Document]:
+        return self.batch_get_relevant_documents([query])[0]
+
+    def batch_get_relevant_documents(self, queries: List[str]) -> List[List[Document]]:
+        """
+        複数クエリをまとめて検索する
+        """
+        routes = [self.shards.route(query) for query in queries]
+        docstore = self.shards.vector_store.docstore
+        if self.mode == "dense":
+            query_vectors = np.asarray(
+                self.shards.vector_store.embeddings.embed_documents(queries), dtype=np.float32
+                )
+            results = self.shards.dense_search_batch(query_vectors, routes, self.k)
+            return [[docstore.search(doc_id) for doc_id, _ in result] for result in results]
+
+        results = self.shards.sparse_search_batch(
+            [self.preprocess_func(query) for query in queries], routes, self.k, self.fallback_index
+            )
+        return [[docstore.search(doc_id) for doc_id in doc_ids] for doc_ids, _ in results]
@@ -0,0 +1,89 @@
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick法による複数キーワードの同時検索
+
+    キーワード数によらず、テキストを1度走査するだけですべての出現箇所を見つける
+    キーワードごとに任意の値 (会社名など) を対応付けられる
+
+    Args:
+        keywords: キーワードのリスト、または キーワード -> 値 のdict (リストの場合は値をキーワード自身とする)
+    """
+
+    def __init__(self, keywords: Union[Iterable[str], Dict[str, Any]]):
+        if not isinstance(keywords, dict):
+            keywords = {keyword: keyword for keyword in keywords}
+        keywords = {keyword: value for keyword, value in keywords.items() if keyword}
+
+        # ノードごとの遷移先、失敗時の遷移先、そのノードで終わるキーワードの (長さ, 値)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, Any]]] = [[]]
+
+        for keyword, value in keywords.items():
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append((len(keyword), value))
+        self._size = len(keywords)
+        self._build_failure_links()
+
+    def _build_failure_links(self) -> None:
+        # 深さ1のノードの失敗時の遷移先は根とし、幅優先で深いノードの遷移先を決める
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # 失敗時の遷移先で終わるキーワードも出力に含める
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, Any]]:
+        """
+        テキスト中のすべての出現箇所を (開始位置, 終了位置, 値) で返す (重なりを含む)
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in output[node]:
+                yield i + 1 - length, i + 1, value
+
+    def contains_any(self, text: str) -> bool:
+        """
+        いずれかのキーワードを含むか
+        """
+        return next(self.iter_matches(text), None) is not None
+
+    def find_longest(self, text: str) -> List[Tuple[int, int, Any]]:
+        """
+        重ならない出現箇所を左から順に、同じ位置からは最長のものを選んで返す
+        (「トヨタ」と「トヨタ自動車」のように一方が他方を含む場合は長い方のみを返す)
+        """
+        matches = sorted(self.iter_matches(text), key=lambda m: (m[0], -(m[1] - m[0])))
+        selected = []
+        end = 0
+        for start, stop, value in matches:
+            if start >= end:
+                selected.append((start, stop, value))
+                end = stop
+        return selected
@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Union
+
+from openai import APIConnectionError, APIStatusError
+
+from .cache import PageCache, page_cache_key
+from .image_encode import EncodedImage, estimate_image_tokens, load_image
+from .local_render import render_page_markdown
+from .metrics import get_metrics, record_llm_request
+from .rate_limit import AsyncRateLimiter, backoff_delay, parse_retry_after
+from .text_extract import (
+    EXTRACT_PROMPT_TEMPLATE,
+    PROMPT_VERSION,
+    blocks_to_text,
+    build_extract_messages,
+)
+
+
+# リトライ対象とするHTTPステータスコード
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def load_checkpoint(checkpoint_path: str) -> Dict[int, str]:
+    """
+    ドキュメント単位のチェックポイント (ページ番号 -> 抽出結果) を読み込む
+    """
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        pages = json.load(f)["pages"]
+    return {int(i): text for i, text in pages.items()}
+
+def save_checkpoint(checkpoint_path: str, results: Dict[int, str]) -> None:
+    """
+    チェックポイントを一時ファイル経由で書き込み、途中で中断されても破損しないようにする
+    """
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"pages": {str(i): text for i, text in sorted(results.items())}}, f, ensure_ascii=False)
+    os.replace(tmp_path, checkpoint_path)
+
+def estimate_request_tokens(blocks_content: str, image_tokens: int, max_tokens: int) -> int:
+    """
+    レート制限のためのリクエストあたりのトークン数を見積もる
+    日本語は概ね1文字1トークン以下のため、文字数を上限の目安として用いる
+    """
+    return len(EXTRACT_PROMPT_TEMPLATE) + len(blocks_content) + image_tokens + max_tokens
+
+async def aanalyze_image_with_blocks(
+        client,
+        image_path: Union[str, EncodedImage],
+        blocks: list,
+        model: str,
+        limiter: Optional[AsyncRateLimiter] = None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        max_retries: int = 5,
+        max_tokens: int = 4096,
+        image_tokens: int = 1500,
+        cache: Optional[PageCache] = None,
+        detail: Optional[str] = None,
+        document: Optional[str] = None,
+        page: Optional[int] = None
+        ) -> str:
+    """
+    analyze_image_with_blocksの非同期版
+    レート制限の枠を確保してからリクエストし、失敗時はRetry-Afterを考慮した指数バックオフで再試行する
+    リクエストごとの応答時間・トークン数・再試行はtools.metricsに記録する
+
+    Args:
+        client (AsyncOpenAI | AsyncAzureOpenAI): 非同期クライアント (SDK側のリトライはmax_retries=0で無効化を推奨)
+        image_path (str | EncodedImage): 画像のパス、またはメモリ上でエンコードした画像
+        blocks (list): テキストブロック情報
+        model (str): モデル名
+        limiter (AsyncRateLimiter): 共有するレート制限 (Noneの場合は制限なし)
+        semaphore (asyncio.Semaphore): 同時実行数の制限 (Noneの場合は逐次実行)
+        max_retries (int): 最大リトライ回数
+        max_tokens (int): 出力の最大トークン数
+        image_tokens (int): 画像1枚あたりのトークン数の見積もり
+        cache (PageCache): 解析結果のキャッシュ (ヒットした場合はAPIを呼び出さない)
+        detail (str): 画像の解像度の指定 ("low", "high", "auto"。Noneの場合は指定しない)
+        document (str): 計測値に記録するドキュメント名
+        page (int): 計測値に記録するページ番号
+
+    Returns:
+        str: 解析結果
+    """
+    blocks_content = blocks_to_text(blocks)
+    base64_image, mime_type = await asyncio.to_thread(load_image, image_path)
+
+    if cache is not None:
+        key = page_cache_key(base64_image, blocks_content, EXTRACT_PROMPT_TEMPLATE, model, detail, max_tokens=max_tokens, temperature=0.0)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    messages = build_extract_messages(base64_image, blocks_content, mime_type, detail)
+    if isinstance(image_path, EncodedImage):
+        image_tokens = estimate_image_tokens(image_path.width, image_path.height, detail)
+    estimated_tokens = estimate_request_tokens(blocks_content, image_tokens, max_tokens)
+    semaphore = semaphore or asyncio.Semaphore(1)
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        async with semaphore:
+            if limiter is not None:
+                await limiter.acquire(estimated_tokens)
+            start = time.perf_counter()
+            try:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.0
+                )
+            except APIConnectionError as e:
+                error = e
+            except APIStatusError as e:
+                if e.status_code not in RETRYABLE_STATUS_CODES:
+                    record_llm_request(
+                        "extract", model, "error", time.perf_counter() - start,
+                        document=document, page=page, attempt=attempt, error=e.status_code
+                        )
+                    raise
+                error = e
+                retry_after = parse_retry_after(e.response.headers)
+            else:
+                record_llm_request(
+                    "extract", model, "ok", time.perf_counter() - start, response.usage, image_tokens,
+                    document=document, page=page, attempt=attempt
+                    )
+                if limiter is not None and response.usage is not None:
+                    limiter.adjust(response.usage.total_tokens - estimated_tokens)
+                content = response.choices[0].message.content
+                if cache is not None and content is not None:
+                    cache.set(key, content, model=model, prompt_version=PROMPT_VERSION)
+                return content
+
+        status = "error" if attempt == max_retries else "retry"
+        record_llm_request(
+            "extract", model, status, time.perf_counter() - start,
+            document=document, page=page, attempt=attempt, error=type(error).__name__
+            )
+        if attempt == max_retries:
+            raise error
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+async def aextract_pages(
+        client,
+        image_paths: List[Union[str, EncodedImage]],
+        pages_blocks: List[list],
+        model: str,
+        limiter: Optional[AsyncRateLimiter] = None,
+        max_concurrency: int = 8,
+        checkpoint_path: Optional[str] = None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        local_pages: Optional[Sequence[bool]] = None,
+        document: Optional[str] = None,
+        **kwargs
+        ) -> List[str]:
+    """
+    1ドキュメント分の全ページを同時実行数を制限しながら非同期に解析する
+    チェックポイントに記録済みのページはスキップし、完了したページから順次チェックポイントに記録する
+    local_pagesでTrueとしたページはAPIを呼び出さず、テキストブロック情報からローカルでMarkdownを生成する
+    (ローカルの生成結果はチェックポイントに記録しない)
+
+    Args:
+        client (AsyncOpenAI | AsyncAzureOpenAI): 非同期クライアント
+        image_paths (list): ページごとの画像のパス (またはEncodedImage)
+        pages_blocks (list): ページごとのテキストブロック情報
+        model (str): モデル名
+        limiter (AsyncRateLimiter): 共有するレート制限
+        max_concurrency (int): 同時実行数 (semaphoreが指定された場合は無視)
+        checkpoint_path (str): チェックポイントのパス (Noneの場合は記録しない)
+        semaphore (asyncio.Semaphore): 複数ドキュメントで共有する同時実行数の制限
+        local_pages (list): ページごとのローカルで変換するかどうか (local_render.classify_pageの"local")
+        document (str): 計測値に記録するドキュメント名
+        **kwargs: aanalyze_image_with_blocksに渡す追加の引数
+
+    Returns:
+        list: ページ順に並んだ解析結果
+    """
+    metrics = get_metrics()
+    results = load_checkpoint(checkpoint_path)
+    local_results = {}
+    for i in range(len(image_paths)):
+        if local_pages is not None and local_pages[i] and i not in results:
+            with metrics.timer("local_render", document=document, page=i + 1):
+                local_results[i] = render_page_markdown(pages_blocks[i])
+    semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+
+    async def run(i):
+        with metrics.timer("extract_page", document=document, page=i + 1):
+            text = await aanalyze_image_with_blocks(
+                client, image_paths[i], pages_blocks[i], model,
+                limiter=limiter, semaphore=semaphore, document=document, page=i + 1, **kwargs
+                )
+        results[i] = text
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, results)
+
+    pending = [i for i in range(len(image_paths)) if i not in results and i not in local_results]
+    metrics.inc("extract_pages_total", len(results), route="checkpoint")
+    metrics.inc("extract_pages_total", len(local_results), route="local")
+    metrics.inc("extract_pages_total", len(pending), route="model")
+    # 1ページの失敗で他のページを中断しないよう、全ページの完了を待ってから例外を送出する
+    outcomes = await asyncio.gather(*(run(i) for i in pending), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+
+    results.update(local_results)
+    return [results[i] for i in range(len(image_paths))]
+
+async def aextract_documents(
+        client,
+        documents: List[dict],
+        model: str,
+        limiter: Optional[AsyncRateLimiter] = None,
+        max_concurrency: int = 8,
+        **kwargs
+        ) -> List[List[str]]:
+    """
+    複数ドキュメントを同時実行数とレート制限を共有しながら非同期に解析する
+
+    Args:
+        client (AsyncOpenAI | AsyncAzureOpenAI): 非同期クライアント
+        documents (list): "image_paths" (画像のパスまたはEncodedImage), "pages_blocks",
+                          "checkpoint_path" (任意), "local_pages" (任意), "name" (任意、計測値に記録する名前)
+                          をキーに持つdictのリスト
+        model (str): モデル名
+        limiter (AsyncRateLimiter): 共有するレート制限
+        max_concurrency (int): 全ドキュメントを通した同時実行数
+        **kwargs: aanalyze_image_with_blocksに渡す追加の引数
+
+    Returns:
+        list: ドキュメントごとの、ページ順に並んだ解析結果
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(*(
+        aextract_pages(
+            client,
+            document["image_paths"],
+            document["pages_blocks"],
+            model,
+            limiter=limiter,
+            checkpoint_path=document.get("checkpoint_path"),
+            semaphore=semaphore,
+            local_pages=document.get("local_pages"),
+            document=document.get("name"),
+            **kwargs
+            )
+        for document in documents
+    ))
+
+def extract_pages(client, image_paths, pages_blocks, model, **kwargs) -> List[str]:
+    """
+    aextract_pagesの同期版 (イベントループが動いていない環境向け。Jupyterでは aextract_pages をawaitする)
+    """
+    return asyncio.run(aextract_pages(client, image_paths, pages_blocks, model, **kwargs))
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import get_metrics
+
+
+def hash_parts(*parts) -> str:
+    """
+    複数の要素 (str / bytes) から衝突しにくいsha256のキーを生成
+    要素の境界が曖昧にならないよう、各要素の長さも含めてハッシュ化する
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+def page_cache_key(
+        image_data,
+        blocks_content: str,
+        prompt_template: str,
+        model: str,
+        detail: Optional[str] = None,
+        max_tokens: int = 4096,
+        temperature: float = 0.0
+        ) -> str:
+    """
+    ページ画像、テキストブロック情報、プロンプトテンプレート、モデル名と
+    出力に影響するリクエストパラメータ (画像の解像度、最大トークン数、temperature) から解析結果のキャッシュキーを生成
+    """
+    return hash_parts(image_data, blocks_content, prompt_template, model, str(detail), str(max_tokens), repr(float(temperature)))
+
+
+class PageCache:
+    """
+    ページ画像からのMarkdown生成結果を保持するSQLiteベースの永続キャッシュ
+
+    ・キーはページ画像、テキストブロック情報、プロンプト、モデル名、リクエストパラメータのハッシュ
+    ・ヒット/ミス数を記録
+    ・合計サイズがmax_bytesを超えた場合、最終アクセスが古いものから削除 (LRU)
+    ・モデル名またはプロンプトのバージョン単位で無効化が可能
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = 2 * 1024 ** 3):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_last_access ON pages (last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                get_metrics().inc("cache_requests_total", cache="page", result="miss")
+                return None
+            self.hits += 1
+            get_metrics().inc("cache_requests_total", cache="page", result="hit")
+            self._conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, value: str, model: str, prompt_version: str) -> None:
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, prompt_version, value, size, time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM pages ORDER BY last_access").fetchall()
+        removed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM pages WHERE key = ?", removed)
+
+    def invalidate(self, model: Optional[str] = None, prompt_version: Optional[str] = None) -> int:
+        """
+        指定したモデル名、プロンプトのバージョンに一致するエントリを削除 (両方Noneの場合は全削除)
+
+        Returns:
+            int: 削除したエントリ数
+        """
+        conditions, params = [], []
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+        if prompt_version is not None:
+            conditions.append("prompt_version = ?")
+            params.append(prompt_version)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            deleted = self._conn.execute(f"DELETE FROM pages{where}", params).rowcount
+            self._conn.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+            ).fetchone()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    チャンクの埋め込みベクトルを保持するSQLiteベースの永続キャッシュ
+
+    キーはクリーニング後のチャンクテキストと埋め込みモデル名のハッシュ
+    ベクトルはfloat32のバイト列として保存する
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        return hash_parts(model, text)
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        """
+        複数のキーに対応するベクトル (float32のバイト列) をまとめて取得
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLiteのプレースホルダ数の上限を超えないよう分割して問い合わせる
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        get_metrics().inc("cache_requests_total", hits, cache="embedding", result="hit")
+        get_metrics().inc("cache_requests_total", len(keys) - hits, cache="embedding", result="miss")
+        return found
+
+    def set_many(self, items: List[Tuple[str, str, bytes]]) -> None:
+        """
+        (キー, モデル名, ベクトルのバイト列) のリストをまとめて保存
+        """
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", items)
+            self._conn.commit()
+
+    def invalidate(self, model: Optional[str] = None) -> int:
+        with self._lock:
+            if model is None:
+                deleted = self._conn.execute("DELETE FROM embeddings").rowcount
+            else:
+                deleted = self._conn.execute("DELETE FROM embeddings WHERE model = ?", (model,)).rowcount
+            self._conn.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,40 @@
 import os
-import re
+import json
 import time
-from typing import List, Any
+import uuid
+import shutil
+import hashlib
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Any, Dict, Iterable, Iterator, Mapping, Optional, Tuple
 from tqdm.auto import tqdm
 
+import numpy as np
+
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
 from langchain.vectorstores import FAISS
-from openai import InternalServerError
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+from .cache import EmbeddingCache
+from .dedup import NearDuplicateFinder, find_near_duplicates, normalize_dedup_config
+from .embedding import count_tokens, embed_texts
+from .faiss_index import (
+    build_faiss_index, estimate_vector_bytes, needs_training, normalize_index_spec, read_faiss_store,
+    stores_exact_vectors, supports_remove
+)
+from .markdown_loader import markdown_sections, read_markdown
+from .metrics import get_metrics
+from .text_clean import clean_text
+from .tokenizer import tokenize
+
+
+# チャンクの形式のバージョン (分割方法やmetadataを変更した場合に更新し、保存済みのチャンクとインデックスを作り直す)
+#   1: UnstructuredMarkdownLoaderで読み込み
+#   2: markdown_loaderで読み込み、見出しの階層をmetadata["headings"]に格納
+CHUNK_FORMAT_VERSION = 2
 
 
 class JapaneseCharacterTextSplitter(RecursiveCharacterTextSplitter):
@@ -15,95 +42,510 @@ class JapaneseCharacterTextSplitter(RecursiveCharacterTextSplitter):
         separators = ["\n\n", "\n", "。", "、", " ", ""]
         super().__init__(separators=separators, **kwargs)
 
-def clean_text(text: str) -> str:
+@lru_cache(maxsize=None)
+def get_text_splitter(chunk_size: int, chunk_overlap: int) -> JapaneseCharacterTextSplitter:
+    """
+    分割パラメータごとに1つのテキスト分割器を使い回す (ファイルごとに生成しない)
+    """
+    return JapaneseCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def file_sha256(path: str) -> str:
+    """
+    ファイル内容のsha256ハッシュを計算
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_and_split_markdown(md_path: str, chunk_size: int, chunk_overlap: int, pretokenize: bool = True) -> list:
+    """
+    Markdownファイルを読み込み、チャンクに分割してクリーニングする
+    各チャンクの先頭にはファイル名 (会社名) を付与する
+    metadataには読み込んだファイルのパス ("source")、会社名 ("company")、ファイル内のチャンクの順番 ("chunk_index")、
+    チャンクの先頭を含む区間の見出しの階層 ("headings") を格納する
+    pretokenize=Trueの場合、BM25用の分かち書き結果をmetadata["tokens"]に格納する
+    """
+    text = read_markdown(md_path)
+    sections = markdown_sections(text)
+    starts = [start for start, _ in sections]
+    base_filename = os.path.splitext(os.path.basename(md_path))[0]
+
+    doc_chunks = []
+    position = 0
+    for chunk_index, piece in enumerate(get_text_splitter(chunk_size, chunk_overlap).split_text(text)):
+        # チャンクは元のテキストの部分文字列 (前後の空白を除いたもの) で、開始位置は単調に増える
+        found = text.find(piece, position)
+        if found >= 0:
+            position = found
+        page_content = f"{base_filename}\n\n" + clean_text(piece)
+        metadata = {
+            "source": md_path,
+            "company": base_filename,
+            "chunk_index": chunk_index,
+            "headings": list(sections[bisect_right(starts, position) - 1][1]),
+        }
+        if pretokenize:
+            metadata["tokens"] = tokenize(page_content)
+        doc_chunks.append(Document(page_content=page_content, metadata=metadata))
+        position += 1
+    return doc_chunks
+
+def _split_markdown_file(md_path: str, chunk_size: int, chunk_overlap: int, pretokenize: bool) -> list:
+    with get_metrics().timer("chunk", document=os.path.basename(md_path)) as trace:
+        doc_chunks = load_and_split_markdown(md_path, chunk_size, chunk_overlap, pretokenize)
+        trace["chunks"] = len(doc_chunks)
+    return doc_chunks
+
+def iter_markdown_chunks(
+        md_paths: Iterable[str],
+        chunk_size: int,
+        chunk_overlap: int,
+        pretokenize: bool = True,
+        processes: int = 1
+        ) -> Iterator[Tuple[str, list]]:
     """
-    Markdown由来の記法や余分な改行・空白を除去または整理するクリーニング処理の例。
+    Markdownファイルを順にチャンクに分割し、(ファイルのパス, チャンクのリスト) をファイルごとに返すジェネレータ
 
-    ・コードブロック（```）は除去
-    ・インラインコード（`...`）は記号を除いてテキストのみ残す
-    ・リンクはリンクテキストのみを残す
-    ・**や*、__や_による強調は除去
-    ・ヘッダー（#）は除去
-    ・3回以上連続する改行は2回の改行に整理
-    ・連続する空白を1つに整理
-    ・前後の余分な空白を除去
+    processes > 1の場合、ファイルをプロセスプールで並列に分割する
+    先読みはprocesses * 2ファイルまでとし、呼び出し側が埋め込みなどを行っている間も次のファイルの分割が進む
+    (結果はmd_pathsの順に返す。呼び出し側が消費しないチャンクは溜まらない)
+
+    Args:
+        md_paths (list): Markdownファイルのパス
+        chunk_size (int): チャンクの最大文字数
+        chunk_overlap (int): チャンク間で重複させる文字数
+        pretokenize (bool): BM25用の分かち書き結果をmetadataに格納するか
+        processes (int): 分割するプロセス数 (1の場合はこのプロセスで逐次分割する)
     """
-    # コードブロックの除去（複数行に渡る部分）
-    text = re.sub(r'```[\s\S]*?```', '', text)
+    md_paths = list(md_paths)
+    if processes <= 1 or len(md_paths) <= 1:
+        for md_path in md_paths:
+            yield md_path, _split_markdown_file(md_path, chunk_size, chunk_overlap, pretokenize)
+        return
 
-    # インラインコードの除去（バッククォートを除いて中身だけ残す）
-    text = re.sub(r'`([^`]*)`', r'\1', text)
+    remaining = iter(md_paths)
+    with ProcessPoolExecutor(max_workers=min(processes, len(md_paths))) as executor:
+        futures = deque()
+        for md_path in remaining:
+            futures.append((md_path, executor.submit(
+                _split_markdown_file, md_path, chunk_size, chunk_overlap, pretokenize
+                )))
+            if len(futures) >= processes * 2:
+                break
+        while futures:
+            md_path, future = futures.popleft()
+            doc_chunks = future.result()
+            next_path = next(remaining, None)
+            if next_path is not None:
+                futures.append((next_path, executor.submit(
+                    _split_markdown_file, next_path, chunk_size, chunk_overlap, pretokenize
+                    )))
+            yield md_path, doc_chunks
 
-    # リンクの処理：[リンクテキスト](URL) → リンクテキストのみ
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+def deduplicate_chunks(documents: list, ids: List[str], files: List[str], dedup: Dict, protected: int = 0):
+    """
+    近似重複のチャンク (ヘッダー・フッター、定型文、複数ページに同じ表など) を検出する
+    先頭のprotected件 (インデックスに登録済みのチャンク) は常に残す
 
-    # 太字・斜体の記法の除去（**や__で囲まれた部分をそのまま残す）
-    text = re.sub(r'(\*\*|__)(.*?)\1', r'\2', text)
-    text = re.sub(r'(\*|_)(.*?)\1', r'\2', text)
+    Args:
+        documents (list): チャンク (langchainのDocument)
+        ids (list): チャンクID
+        files (list): チャンクごとのファイル名 (scope="file"の場合はファイル内でのみ重複を検出する)
+        dedup (dict): 重複除去の設定 (tools.dedup.DEFAULT_DEDUP_CONFIGを参照)
+        protected (int): 常に残す先頭の件数
 
-    # ヘッダー記法の除去：行頭の#を削除
-    text = re.sub(r'^\s*#{1,6}\s*', '', text, flags=re.MULTILINE)
+    Returns:
+        set: 除去するチャンクの位置
+        dict: 残すチャンクのID -> 置き換えられたチャンク ({"file", "chunk_index"}) のリスト
+    """
+    dedup = normalize_dedup_config(dedup)
+    replaced = find_near_duplicates(
+        [doc.page_content for doc in documents],
+        groups=files,
+        threshold=dedup["threshold"],
+        scope=dedup["scope"],
+        ngram=dedup["ngram"],
+        num_perm=dedup["num_perm"],
+        seed=dedup["seed"],
+        protected=protected
+        )
+    removed = set()
+    duplicates = {}
+    for kept, positions in replaced.items():
+        removed.update(positions)
+        duplicates[ids[kept]] = [
+            {"file": files[position], "chunk_index": documents[position].metadata.get("chunk_index")}
+            for position in positions
+        ]
+    return removed, duplicates
 
-    # ページ番号の除去：例として "P.58" や "p.  58" のようなパターン
-    text = re.sub(r'\b[Pp]\.?\s*\d+\b', '', text)
+def get_current_version(index_dir: str) -> Optional[str]:
+    """
+    index_dir/CURRENT に記録された現在のインデックスのバージョン名を取得
+    """
+    current_path = os.path.join(index_dir, "CURRENT")
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
 
-    # 3つ以上連続する改行は2つに整理
-    text = re.sub(r'\n{3,}', '\n\n', text)
+def load_vector_store(
+        index_dir: str,
+        embeddings,
+        mmap: bool = False,
+        search_params: Optional[Dict] = None
+        ) -> Tuple[Optional[FAISS], Optional[Dict]]:
+    """
+    保存済みのVector DBとマニフェストを読み込む
 
-    # 複数の空白を1つの空白に整理
-    text = re.sub(r' +', ' ', text)
+    Args:
+        index_dir (str): 保存先のディレクトリ
+        embeddings: LangChainのEmbeddings
+        mmap (bool): インデックスをメモリマップとして読み込むか (検索専用。追加・削除はできない)
+        search_params (dict): 検索時のパラメータ (nprobe, efSearchなど)
+
+    Returns:
+        FAISS: Vector DB (未保存の場合はNone)
+        dict: マニフェスト (未保存の場合はNone)
+    """
+    version = get_current_version(index_dir)
+    if version is None:
+        return None, None
+
+    version_dir = os.path.join(index_dir, version)
+    vector_store = read_faiss_store(version_dir, embeddings, mmap=mmap, search_params=search_params)
+    with open(os.path.join(version_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    return vector_store, manifest
+
+def save_vector_store(vector_store: FAISS, index_dir: str, manifest: Dict, keep_versions: int = 2) -> str:
+    """
+    Vector DBとマニフェストを新しいバージョンのディレクトリに保存し、CURRENTを差し替える
+    CURRENTの差し替えはos.replaceで行うため、読み込み側が書き込み途中の状態を参照することはない
+
+    Returns:
+        str: 保存したバージョン名
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    version = f"{time.strftime('%Y%m%d%H%M%S')}_{time.time_ns() % 10 ** 9:09d}"
+    version_dir = os.path.join(index_dir, version)
+    vector_store.save_local(version_dir)
+    with open(os.path.join(version_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    tmp_path = os.path.join(index_dir, "CURRENT.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(index_dir, "CURRENT"))
+
+    # 古いバージョンを削除
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if os.path.isfile(os.path.join(index_dir, name, "manifest.json"))
+    )
+    for name in versions[:-keep_versions]:
+        if name == version:
+            continue
+        shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+    return version
+
+class VectorStoreWriter:
+    """
+    チャンクをflush_chunks件ずつ埋め込み、Vector DBに追加する
+
+    すべてのチャンクを揃えずに埋め込みを始められ、保持するチャンクの件数はflush_chunks件までとなる
+    学習が必要なインデックス (IVF、PQ符号) を新たに生成する場合は、学習データの件数 (index_specのtrain_size) まで溜めてから生成する
+
+    Args:
+        embeddings: LangChainのEmbeddings
+        vector_store (FAISS): 追加先のVector DB (Noneの場合は最初の追加時に生成する)
+        index_spec (dict): 生成するインデックスの設定
+        flush_chunks (int): まとめて埋め込み・追加するチャンク数
+        rebuild (bool): インデックスの再構築か (計測値に記録する)
+        **embed_kwargs: embed_textsに渡す設定
+    """
+
+    def __init__(
+            self,
+            embeddings,
+            vector_store: Optional[FAISS],
+            index_spec: Dict,
+            flush_chunks: int = 4096,
+            rebuild: bool = False,
+            **embed_kwargs
+            ):
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.index_spec = normalize_index_spec(index_spec)
+        self.flush_chunks = flush_chunks
+        self.rebuild = rebuild
+        self.embed_kwargs = embed_kwargs
+        self.added = 0
+        self._documents: List[Document] = []
+        self._ids: List[str] = []
+        self._vectors: List[Optional[np.ndarray]] = []
+
+    def add(self, document: Document, doc_id: str, vector: Optional[np.ndarray] = None) -> None:
+        """
+        チャンクを追加する (vectorを指定した場合は埋め込まずにそのベクトルを用いる)
+        """
+        self._documents.append(document)
+        self._ids.append(doc_id)
+        self._vectors.append(vector)
+        if len(self._documents) >= self.flush_chunks:
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        """
+        溜めたチャンクを埋め込んで追加する (final=Trueの場合は学習データの件数に満たなくても追加する)
+        """
+        if not self._documents:
+            return
+        if (self.vector_store is None and not final and needs_training(self.index_spec)
+                and len(self._documents) < self.index_spec["train_size"]):
+            return
+
+        metrics = get_metrics()
+        texts = [doc.page_content for doc in self._documents]
+        pending = [i for i, vector in enumerate(self._vectors) if vector is None]
+        vectors = np.zeros((0, 0), dtype=np.float32)
+        if pending:
+            with metrics.timer("embed", chunks=len(pending)):
+                vectors = embed_texts(self.embeddings, [texts[i] for i in pending], **self.embed_kwargs)
+        if len(pending) < len(texts):
+            # 既存のインデックスから復元したベクトルと埋め込んだベクトルを元の順に並べる
+            embedded = dict(zip(pending, vectors))
+            vectors = np.stack([
+                embedded[i] if vector is None else vector for i, vector in enumerate(self._vectors)
+            ]).astype(np.float32, copy=False)
+        with metrics.timer("index", vectors=len(texts), rebuild=self.rebuild):
+            if self.vector_store is None:
+                index = build_faiss_index(vectors, self.index_spec)
+                self.vector_store = FAISS(self.embeddings, index, InMemoryDocstore(), {})
+            self.vector_store.add_embeddings(
+                list(zip(texts, vectors.tolist())), metadatas=[doc.metadata for doc in self._documents], ids=self._ids
+                )
+        self.added += len(texts)
+        self._documents, self._ids, self._vectors = [], [], []
 
-    # 前後の不要な空白・改行の除去
-    return text.strip()
 
 def process_files_in_batches(
         embeddings,
         md_paths: List[str],
         chunk_size: int = 512,
         chunk_overlap: int = 32,
-        batch_size: int = 10,
+        batch_size: int = 256,
         max_retries: int = 3,
-        retry_interval: int = 5
+        retry_interval: int = 5,
+        index_dir: Optional[str] = None,
+        max_batch_tokens: int = 100_000,
+        max_workers: int = 4,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        pretokenize: bool = True,
+        index_spec: Optional[Dict] = None,
+        chunks: Optional[Mapping[str, list]] = None,
+        dedup: Optional[Dict] = None,
+        chunk_workers: int = 1,
+        flush_chunks: int = 4096
         ):
     """
     指定されたディレクトリ内のMarkdownファイルをファイルごとに逐次処理する
+
+    index_dirを指定した場合、Vector DBとマニフェスト (ファイルごとのハッシュ値とチャンクID、分割パラメータ) を保存し、
+    次回以降は追加・変更されたファイルのみをチャンク分割・埋め込みして、削除・変更されたファイルのベクトルは削除する
+    分割パラメータが変わった場合はすべてのファイルを処理し直す
+
+    チャンク分割はファイルごとに逐次 (chunk_workers > 1の場合はプロセスプールで並列に) 行い、
+    分割したチャンクはflush_chunks件ごとに埋め込んでVector DBへ追加する (VectorStoreWriterを参照)
+    埋め込みはbatch_size件・max_batch_tokensトークンを上限としたバッチ単位で、max_workers並列にリクエストする
+    embedding_cacheを指定した場合、キャッシュ済みのチャンクはAPIを呼び出さない
+    pretokenize=Trueの場合、BM25用の分かち書き結果を各チャンクのmetadataに格納し、Retriever構築時に再利用する
+
+    index_specでインデックスの種類 (flat / hnsw / ivfpq) と保持形式 (float32 / float16 / pq) を指定できる
+    (設定項目はtools.faiss_index.DEFAULT_INDEX_SPECを参照)
+    次の場合は既存のチャンクも含めてインデックスを再構築する
+    ・index_specが前回と異なる場合
+    ・削除に対応しないインデックス (hnsw / ivfpq) でベクトルを削除する場合
+    既存のインデックスがfloat32のflat / hnswの場合、既存のチャンクのベクトルはインデックスから復元する
+    それ以外 (IVF、float16、PQ符号) は量子化前のベクトルを復元できないため、embedding_cacheの指定を必須とする
+    (キャッシュにないチャンクは埋め込みをやり直す)
+
+    chunksにファイル名 -> 分割済みのチャンク (load_and_split_markdownの結果) を渡した場合、そのファイルは再分割しない
+    (チャンクはファイルの処理時に1件ずつ取り出すため、必要な時点で読み込むMappingも渡せる)
+
+    dedupを指定した場合、分割後・埋め込み前に近似重複のチャンクを除去する (設定はtools.dedup.DEFAULT_DEDUP_CONFIGを参照)
+    ・scope="corpus"の場合はインデックスに登録済みのチャンクとも照合し、先に登録されたチャンクを残す
+    ・残したチャンクID -> 置き換えたチャンクの対応をマニフェストの"duplicates"に、
+      削減したチャンク数・トークン数・インデックスのバイト数をマニフェストの"dedup_stats"に記録する
+    ・残したチャンクのファイルが削除・変更された場合、置き換えたチャンクのファイルも処理し直す
     """
+    index_spec = normalize_index_spec(index_spec)
 
-    all_documents = []
     vector_store = None
+    manifest = None
+    if index_dir is not None:
+        vector_store, manifest = load_vector_store(index_dir, embeddings)
+    params = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "pretokenize": pretokenize,
+        "chunk_format": CHUNK_FORMAT_VERSION,
+    }
+    if dedup is not None:
+        dedup = normalize_dedup_config(dedup)
+        params["dedup"] = dedup
+    if manifest is None or manifest.get("params") != params:
+        vector_store = None
+        manifest = {"params": params, "files": {}}
+    duplicates = manifest.get("duplicates", {})
+
+    current_files = {os.path.basename(md_path): md_path for md_path in md_paths}
+    file_hashes = {name: file_sha256(md_path) for name, md_path in current_files.items()}
+
+    # 削除・変更されたファイル
+    stale_files = {
+        name for name, entry in manifest["files"].items() if file_hashes.get(name) != entry["sha256"]
+    }
+    # 残したチャンクが削除されると置き換えたチャンクがインデックスから失われるため、そのファイルも処理し直す
+    pending = list(stale_files)
+    while pending:
+        for doc_id in manifest["files"][pending.pop()]["ids"]:
+            for duplicate in duplicates.get(doc_id, ()):
+                if duplicate["file"] in manifest["files"] and duplicate["file"] not in stale_files:
+                    stale_files.add(duplicate["file"])
+                    pending.append(duplicate["file"])
 
-    for md_path in tqdm(md_paths):
-        loader = UnstructuredMarkdownLoader(md_path)
-        content = loader.load()
+    stale_ids = []
+    for name in sorted(stale_files):
+        stale_ids.extend(manifest["files"].pop(name)["ids"])
+    stale = set(stale_ids)
+    duplicates = {
+        doc_id: [duplicate for duplicate in entries if duplicate["file"] not in stale_files]
+        for doc_id, entries in duplicates.items() if doc_id not in stale
+    }
+    duplicates = {doc_id: entries for doc_id, entries in duplicates.items() if entries}
 
-        text_splitter = JapaneseCharacterTextSplitter(
-            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    rebuild = vector_store is not None and (
+        manifest.get("index_spec") != index_spec or (stale_ids and not supports_remove(index_spec))
+    )
+    # 再構築時に既存のチャンクのベクトルをインデックスから復元できるか
+    reuse_vectors = rebuild and stores_exact_vectors(manifest.get("index_spec") or {})
+    if rebuild and not reuse_vectors and embedding_cache is None:
+        raise ValueError(
+            "Rebuilding a quantized index re-embeds every existing chunk; pass embedding_cache to avoid API calls"
             )
-        doc_chunks = text_splitter.split_documents(content)
-        for doc in doc_chunks:
-            doc.page_content = clean_text(doc.page_content)
-            filename = os.path.basename(md_path)
-            base_filename = os.path.splitext(filename)[0]
-            doc.page_content = f"{base_filename}\n\n" + doc.page_content
-        all_documents.extend(doc_chunks)
-
-    # すべてのドキュメントをバッチ処理
-    for i in tqdm(range(0, len(all_documents), batch_size)):
-        batch_documents = all_documents[i:i + batch_size]
-        retries = 0
-        while retries < max_retries:
-            try:
-                if vector_store is None:
-                    vector_store = FAISS.from_documents(batch_documents, embeddings)
-                else:
-                    vector_store.add_documents(batch_documents)
-                break
-            except InternalServerError:
-                retries += 1
-                print(f"Internal Server Error. リトライ {retries}/{max_retries}...")
-                time.sleep(retry_interval)
-            except Exception as e:
-                print(f"予期しないエラーが発生しました: {e}")
-                break
+    if vector_store is not None and stale_ids and not rebuild:
+        vector_store.delete(stale_ids)
+
+    new_files = [name for name in current_files if name not in manifest["files"]]
+    writer = VectorStoreWriter(
+        embeddings,
+        None if rebuild else vector_store,
+        index_spec,
+        flush_chunks=flush_chunks,
+        rebuild=rebuild,
+        cache=embedding_cache,
+        max_tokens_per_batch=max_batch_tokens,
+        max_items_per_batch=batch_size,
+        max_workers=max_workers,
+        max_retries=max_retries,
+        retry_interval=retry_interval
+        )
+    finder = None
+    if dedup is not None and new_files:
+        finder = NearDuplicateFinder(dedup["threshold"], dedup["scope"], dedup["ngram"], dedup["num_perm"], dedup["seed"])
+
+    metrics = get_metrics()
+    # 登録済みのチャンク: 再構築する場合は新しいチャンクより先に追加し、重複除去では照合のみに用いる
+    indexed = []
+    if vector_store is not None and (rebuild or (finder is not None and dedup["scope"] == "corpus")):
+        for position in sorted(vector_store.index_to_docstore_id):
+            doc_id = vector_store.index_to_docstore_id[position]
+            if doc_id not in stale:
+                indexed.append((doc_id, vector_store.docstore.search(doc_id)))
+    if finder is not None and indexed:
+        id_to_file = {doc_id: name for name, entry in manifest["files"].items() for doc_id in entry["ids"]}
+        with metrics.timer("dedup", chunks=len(indexed), indexed=True):
+            for doc_id, doc in indexed:
+                finder.add(doc.page_content, doc_id, id_to_file.get(doc_id, ""), protected=True)
+    if rebuild:
+        positions = {doc_id: position for position, doc_id in vector_store.index_to_docstore_id.items()}
+        for start in range(0, len(indexed), flush_chunks):
+            batch = indexed[start:start + flush_chunks]
+            vectors = [None] * len(batch)
+            if reuse_vectors:
+                vectors = vector_store.index.reconstruct_batch(
+                    np.asarray([positions[doc_id] for doc_id, _ in batch], dtype=np.int64)
+                    )
+            for (doc_id, doc), vector in zip(batch, vectors):
+                writer.add(doc, doc_id, vector)
+
+    def iter_new_chunks():
+        split = iter_markdown_chunks(
+            [current_files[name] for name in new_files if chunks is None or name not in chunks],
+            chunk_size, chunk_overlap, pretokenize, processes=chunk_workers
+            )
+        for name in new_files:
+            if chunks is not None and name in chunks:
+                yield name, chunks[name]
+            else:
+                yield name, next(split)[1]
+
+    # 分割したチャンクを順に重複除去し、埋め込み・追加する
+    file_ids = {}
+    n_new = 0
+    removed_documents = 0
+    removed_tokens = 0
+    removed_text_bytes = 0
+    for name, doc_chunks in tqdm(iter_new_chunks(), total=len(new_files)):
+        n_new += len(doc_chunks)
+        ids = [str(uuid.uuid4()) for _ in doc_chunks]
+        kept = list(zip(ids, doc_chunks))
+        if finder is not None:
+            kept = []
+            with metrics.timer("dedup", document=name, chunks=len(doc_chunks)) as trace:
+                for doc_id, doc in zip(ids, doc_chunks):
+                    kept_id = finder.add(doc.page_content, doc_id, name)
+                    if kept_id is None:
+                        kept.append((doc_id, doc))
+                        continue
+                    duplicates.setdefault(kept_id, []).append(
+                        {"file": name, "chunk_index": doc.metadata.get("chunk_index")}
+                        )
+                    removed_documents += 1
+                    removed_tokens += count_tokens(doc.page_content)
+                    removed_text_bytes += len(doc.page_content.encode("utf-8"))
+                trace["removed"] = len(doc_chunks) - len(kept)
+        for doc_id, doc in kept:
+            writer.add(doc, doc_id)
+        file_ids[name] = [doc_id for doc_id, _ in kept]
+    writer.flush(final=True)
+    vector_store = writer.vector_store
+
+    for name, ids in file_ids.items():
+        manifest["files"][name] = {"sha256": file_hashes[name], "ids": ids}
+    manifest["index_spec"] = index_spec
+    if dedup is not None:
+        manifest["duplicates"] = duplicates
+        if file_ids:
+            # 削減したバイト数はベクトル + docstoreのテキスト
+            vector_bytes = 0
+            if vector_store is not None:
+                vector_bytes = removed_documents * estimate_vector_bytes(vector_store.index.d, index_spec)
+            manifest["dedup_stats"] = {
+                "chunks": n_new,
+                "removed_chunks": removed_documents,
+                "removed_tokens": removed_tokens,
+                "removed_bytes": vector_bytes + removed_text_bytes,
+            }
+            for unit in ("chunks", "tokens", "bytes"):
+                metrics.inc("dedup_removed_total", manifest["dedup_stats"][f"removed_{unit}"], unit=unit)
+            metrics.event("dedup", **manifest["dedup_stats"])
+
+    if index_dir is not None and vector_store is not None and (stale_ids or file_ids or rebuild):
+        save_vector_store(vector_store, index_dir, manifest)
 
     return vector_store
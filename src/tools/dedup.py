@@ -0,0 +1,207 @@
+import unicodedata
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# n-gramのローリングハッシュの基数と、ハッシュ値の攪拌 (MurmurHash3のfmix64) の定数
+_BASE = np.uint64(1_000_003)
+_FMIX = np.uint64(0xFF51AFD7ED558CCD)
+_SHIFT = np.uint64(33)
+
+DEDUP_SCOPES = ("file", "corpus")
+
+# 重複除去の設定の既定値
+DEFAULT_DEDUP_CONFIG = {
+    "threshold": 0.9,   # 重複とみなすJaccard類似度 (MinHashによる推定値) の下限
+    "scope": "file",    # "file" (ファイル内のみ) または "corpus" (全ファイル。会社をまたいで照合するため、定型文の似た他社のチャンクも除去する)
+    "ngram": 5,         # 文字n-gramの長さ
+    "num_perm": 128,    # MinHashの署名の長さ
+    "seed": 0,
+}
+
+
+def normalize_dedup_config(config: Optional[Dict] = None) -> Dict:
+    merged = {**DEFAULT_DEDUP_CONFIG, **(config or {})}
+    if merged["scope"] not in DEDUP_SCOPES:
+        raise ValueError(f"Unknown dedup scope: {merged['scope']} (expected one of {DEDUP_SCOPES})")
+    if not 0 < merged["threshold"] <= 1:
+        raise ValueError(f"threshold must be in (0, 1]: {merged['threshold']}")
+    return merged
+
+
+def shingle_hashes(text: str, ngram: int = 5) -> np.ndarray:
+    """
+    空白を除いたテキストの文字n-gramの32bitのハッシュ値 (重複なし) を返す
+    n-gramはローリングハッシュでまとめて計算し、上位ビットに偏りが出ないよう攪拌してから上位32bitを用いる
+    """
+    text = "".join(unicodedata.normalize("NFKC", text).split())
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return np.zeros(1, dtype=np.uint32)
+    ngram = min(ngram, len(codes))
+    # uint64の配列演算は桁あふれ (2^64を法とする演算) となる
+    hashes = np.zeros(len(codes) - ngram + 1, dtype=np.uint64)
+    for k in range(ngram):
+        hashes = hashes * _BASE + codes[k:len(codes) - ngram + 1 + k]
+    hashes ^= hashes >> _SHIFT
+    hashes *= _FMIX
+    hashes ^= hashes >> _SHIFT
+    return np.unique((hashes >> np.uint64(32)).astype(np.uint32))
+
+
+class MinHashLSH:
+    """
+    MinHash署名とLSH (署名をバンドに分割したバケット) による近似重複の検出
+
+    ・ハッシュ関数は2^32を法とするアフィン変換 (a * x + b、aは奇数) で、32bit整数の演算のみで署名を計算する
+    ・Jaccard類似度がthreshold付近以上となる組がいずれかのバンドで同じバケットに入るよう、バンド数と行数を選ぶ
+    ・同じバケットに入った候補は、署名の一致率 (Jaccard類似度の推定値) がthreshold以上の場合のみ重複とする
+
+    Args:
+        threshold (float): 重複とみなすJaccard類似度の下限
+        num_perm (int): 署名の長さ
+        seed (int): ハッシュ関数の乱数のシード
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, seed: int = 0):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = self._choose_bands(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64).astype(np.uint32) | np.uint32(1)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64).astype(np.uint32)
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self._signatures: List[np.ndarray] = []
+
+    @staticmethod
+    def _choose_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+        """
+        バケットが一致し始める類似度 ((1/b)^(1/r)) がthresholdを超えない範囲で最も近いバンド数bと行数rを選ぶ
+        """
+        best = None
+        for rows in range(1, num_perm + 1):
+            bands = num_perm // rows
+            knee = (1 / bands) ** (1 / rows)
+            if knee > threshold:
+                break
+            best = (bands, rows)
+        return best or (num_perm, 1)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        return (np.multiply.outer(hashes, self._a) + self._b).min(axis=0)
+
+    def query(self, signature: np.ndarray) -> Optional[int]:
+        """
+        登録済みの要素のうち、署名の一致率がthreshold以上で最も高いものの番号を返す (ない場合はNone)
+        """
+        candidates = set()
+        for band, buckets in enumerate(self._buckets):
+            key = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            candidates.update(buckets.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in sorted(candidates):
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity and (best is None or similarity > best_similarity):
+                best, best_similarity = candidate, similarity
+        return best
+
+    def insert(self, signature: np.ndarray) -> int:
+        number = len(self._signatures)
+        self._signatures.append(signature)
+        for band, buckets in enumerate(self._buckets):
+            key = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            buckets.setdefault(key, []).append(number)
+        return number
+
+
+class NearDuplicateFinder:
+    """
+    テキストを1件ずつ追加しながら近似重複を検出する (先に追加したテキストを残す)
+    すべてのテキストを揃えずに、チャンク分割の結果を順に照合できる
+
+    Args:
+        threshold (float): 重複とみなすJaccard類似度の下限
+        scope (str): "file" (同じグループの中でのみ照合する) または "corpus"
+        ngram (int): 文字n-gramの長さ
+        num_perm (int): MinHashの署名の長さ
+        seed (int): 乱数のシード
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.9,
+            scope: str = "corpus",
+            ngram: int = 5,
+            num_perm: int = 128,
+            seed: int = 0
+            ):
+        if scope not in DEDUP_SCOPES:
+            raise ValueError(f"Unknown dedup scope: {scope} (expected one of {DEDUP_SCOPES})")
+        self.threshold = threshold
+        self.scope = scope
+        self.ngram = ngram
+        self.num_perm = num_perm
+        self.seed = seed
+        self._indexes: Dict[str, MinHashLSH] = {}
+        self._keys: Dict[str, List[Hashable]] = {}
+
+    def add(self, text: str, key: Hashable, group: str = "", protected: bool = False) -> Optional[Hashable]:
+        """
+        テキストを照合し、近似重複の場合は残すテキストのkeyを返す (重複のテキストは登録しない)
+        重複でない場合とprotected=True (照合せずに登録する) の場合はNoneを返す
+        """
+        group = group if self.scope == "file" else ""
+        if group not in self._indexes:
+            self._indexes[group] = MinHashLSH(self.threshold, self.num_perm, self.seed)
+            self._keys[group] = []
+        lsh = self._indexes[group]
+        signature = lsh.signature(shingle_hashes(text, self.ngram))
+        match = None if protected else lsh.query(signature)
+        if match is not None:
+            return self._keys[group][match]
+        lsh.insert(signature)
+        self._keys[group].append(key)
+        return None
+
+
+def find_near_duplicates(
+        texts: Sequence[str],
+        groups: Optional[Sequence[str]] = None,
+        threshold: float = 0.9,
+        scope: str = "corpus",
+        ngram: int = 5,
+        num_perm: int = 128,
+        seed: int = 0,
+        protected: int = 0
+        ) -> Dict[int, List[int]]:
+    """
+    近似重複のテキストを検出し、残すテキストと置き換えられるテキストの対応を返す
+
+    先に現れたテキストを残し、後に現れた近似重複のテキストをそれに置き換える
+    scope="file"の場合、同じグループ (groupsの値。ファイル名など) の中でのみ重複を検出する
+    先頭のprotected件 (インデックスに登録済みのチャンクなど) は常に残し、照合の対象としてのみ用いる
+
+    Args:
+        texts (list): テキストのリスト
+        groups (list): テキストごとのグループ (scope="file"の場合は必須)
+        threshold (float): 重複とみなすJaccard類似度の下限
+        scope (str): "file" または "corpus"
+        ngram (int): 文字n-gramの長さ
+        num_perm (int): MinHashの署名の長さ
+        seed (int): 乱数のシード
+        protected (int): 常に残す先頭の件数
+
+    Returns:
+        dict: 残すテキストの番号 -> 置き換えられるテキストの番号のリスト (重複がないテキストは含まない)
+    """
+    if scope == "file" and groups is None:
+        raise ValueError("groups is required when scope='file'")
+
+    finder = NearDuplicateFinder(threshold, scope, ngram, num_perm, seed)
+    replaced: Dict[int, List[int]] = {}
+    for i, text in enumerate(texts):
+        match = finder.add(text, i, groups[i] if groups is not None else "", protected=i < protected)
+        if match is not None:
+            replaced.setdefault(match, []).append(i)
+    return replaced
@@ -0,0 +1,179 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+import numpy as np
+import tiktoken
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from .cache import EmbeddingCache
+from .metrics import get_metrics, record_llm_request
+from .rate_limit import backoff_delay, parse_retry_after
+
+
+# リトライ対象とする一時的なエラー
+RETRYABLE_ERRORS = (APIConnectionError, InternalServerError, RateLimitError)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    """
+    tiktokenのエンコーダを取得 (生成コストが高いためプロセス内で使い回す)
+    """
+    return tiktoken.get_encoding(name)
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def get_embedding_model_name(embeddings) -> str:
+    """
+    キャッシュキーに用いる埋め込みモデル名を取得
+    """
+    for attr in ("model", "deployment", "model_name"):
+        name = getattr(embeddings, attr, None)
+        if name:
+            return str(name)
+    return type(embeddings).__name__
+
+def pack_batches(
+        texts: List[str],
+        max_tokens_per_batch: int,
+        max_items_per_batch: int,
+        token_counter: Callable[[str], int] = count_tokens
+        ) -> List[List[int]]:
+    """
+    トークン数と件数の上限を超えないようにテキストをバッチにまとめる
+
+    Returns:
+        list: バッチごとのテキストのインデックスのリスト
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = token_counter(text)
+        if current and (
+            current_tokens + tokens > max_tokens_per_batch or len(current) >= max_items_per_batch
+        ):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def _embed_batch(embeddings, texts: List[str], max_retries: int, retry_interval: float) -> List[List[float]]:
+    """
+    1バッチ分を埋め込む。一時的なエラーの場合は指数バックオフで再試行し、上限に達した場合は例外を送出する
+    """
+    model_name = get_embedding_model_name(embeddings)
+    get_metrics().observe("embedding_batch_size", len(texts))
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            vectors = embeddings.embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            seconds = time.perf_counter() - start
+            if attempt == max_retries:
+                record_llm_request(
+                    "embed", model_name, "error", seconds, attempt=attempt, batch_size=len(texts), error=type(e).__name__
+                    )
+                raise
+            response = getattr(e, "response", None)
+            retry_after = parse_retry_after(response.headers) if response is not None else None
+            delay = backoff_delay(attempt, retry_after, base_delay=retry_interval)
+            # 再試行は計測値 (llm_requests_total{status="retry"}) とトレースに記録する
+            record_llm_request(
+                "embed", model_name, "retry", seconds,
+                attempt=attempt, batch_size=len(texts), error=type(e).__name__, delay=delay
+                )
+            time.sleep(delay)
+        else:
+            record_llm_request(
+                "embed", model_name, "ok", time.perf_counter() - start, attempt=attempt, batch_size=len(texts)
+                )
+            return vectors
+
+def embed_texts(
+        embeddings,
+        texts: List[str],
+        cache: Optional[EmbeddingCache] = None,
+        max_tokens_per_batch: int = 100_000,
+        max_items_per_batch: int = 256,
+        max_workers: int = 4,
+        max_retries: int = 5,
+        retry_interval: float = 1.0
+        ) -> np.ndarray:
+    """
+    テキストのリストを埋め込みベクトルに変換する
+
+    ・キャッシュ済みのテキストはAPIを呼び出さない
+    ・未キャッシュのテキストはトークン数と件数の上限までバッチにまとめ、複数バッチを並列にリクエストする
+    ・失敗したバッチはバッチ単位で再試行し、再試行の上限に達した場合は例外を送出する (ドキュメントを欠落させない)
+
+    Args:
+        embeddings: LangChainのEmbeddings
+        texts (list): 埋め込み対象のテキスト
+        cache (EmbeddingCache): 埋め込みベクトルのキャッシュ
+        max_tokens_per_batch (int): 1リクエストあたりの最大トークン数
+        max_items_per_batch (int): 1リクエストあたりの最大件数
+        max_workers (int): 同時にリクエストするバッチ数
+        max_retries (int): バッチごとの最大リトライ回数
+        retry_interval (float): リトライ時の基準待機秒数
+
+    Returns:
+        np.ndarray: (テキスト数, 次元数) のfloat32の配列
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    model_name = get_embedding_model_name(embeddings)
+    vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+
+    keys = []
+    if cache is not None:
+        keys = [cache.make_key(text, model_name) for text in texts]
+        cached = cache.get_many(keys)
+        for i, key in enumerate(keys):
+            if key in cached:
+                vectors[i] = np.frombuffer(cached[key], dtype=np.float32)
+
+    # 同一テキストは1度だけ埋め込む
+    pending = {}
+    for i, text in enumerate(texts):
+        if vectors[i] is None:
+            pending.setdefault(text, []).append(i)
+    pending_texts = list(pending)
+
+    batches = pack_batches(pending_texts, max_tokens_per_batch, max_items_per_batch)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_batch = {
+            executor.submit(
+                _embed_batch, embeddings, [pending_texts[j] for j in batch], max_retries, retry_interval
+                ): batch
+            for batch in batches
+        }
+        # 完了したバッチから順にキャッシュへ保存し、失敗したバッチがあっても他のバッチの結果は残す
+        for future in as_completed(future_to_batch):
+            batch = future_to_batch[future]
+            try:
+                batch_vectors = np.asarray(future.result(), dtype=np.float32)
+            except Exception as e:
+                errors.append(e)
+                continue
+            new_items = []
+            for j, vector in zip(batch, batch_vectors):
+                text = pending_texts[j]
+                for i in pending[text]:
+                    vectors[i] = vector
+                if cache is not None:
+                    new_items.append((keys[pending[text][0]], model_name, vector.tobytes()))
+            if new_items:
+                cache.set_many(new_items)
+
+    if errors:
+        raise errors[0]
+
+    return np.vstack(vectors)
@@ -0,0 +1,212 @@
+import os
+import pickle
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+from langchain.vectorstores import FAISS
+
+
+# インデックスの設定の既定値
+# type:
+#   "flat"  : 全件探索 (厳密解。ベクトル数に比例して検索時間が増える)
+#   "hnsw"  : HNSWグラフによる近似最近傍探索
+#   "ivfpq" : 転置インデックス (IVF) による近似最近傍探索 (学習用のサンプルが必要)
+# storage:
+#   "float32" / "float16" / "pq" (直積量子化の符号。メモリ使用量が最も小さい)
+DEFAULT_INDEX_SPEC = {
+    "type": "flat",
+    "storage": "float32",
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "ef_search": 64,
+    "nlist": 1024,
+    "nprobe": 16,
+    "pq_m": 64,
+    "pq_nbits": 8,
+    "train_size": 50_000,
+    "seed": 0,
+}
+
+INDEX_TYPES = ("flat", "hnsw", "ivfpq")
+STORAGE_TYPES = ("float32", "float16", "pq")
+
+# 学習データ数がnlistのこの倍数に満たない場合はnlistを減らす (faissのk-meansの推奨値)
+MIN_POINTS_PER_CENTROID = 39
+
+
+def normalize_index_spec(index_spec: Optional[Dict] = None) -> Dict:
+    """
+    インデックスの設定に既定値を補い、値を検証する
+    type="ivfpq" でstorageを省略した場合はPQ符号で保持する
+    """
+    index_spec = dict(index_spec or {})
+    if index_spec.get("type") == "ivfpq" and "storage" not in index_spec:
+        index_spec["storage"] = "pq"
+    spec = {**DEFAULT_INDEX_SPEC, **index_spec}
+
+    if spec["type"] not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {spec['type']} (expected one of {INDEX_TYPES})")
+    if spec["storage"] not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage type: {spec['storage']} (expected one of {STORAGE_TYPES})")
+    return spec
+
+def supports_remove(index_spec: Dict) -> bool:
+    """
+    ベクトルを削除しても位置 (langchainのindex_to_docstore_idのキー) が詰められるインデックスか
+    HNSWは削除に対応せず、IVFは削除後も位置が詰められないため、削除時はインデックスを再構築する
+    """
+    return normalize_index_spec(index_spec)["type"] == "flat"
+
+def needs_training(index_spec: Dict) -> bool:
+    """
+    ベクトルの追加前に学習データによる学習が必要なインデックス (IVF、PQ符号) か
+    """
+    spec = normalize_index_spec(index_spec)
+    return spec["type"] == "ivfpq" or spec["storage"] == "pq"
+
+def stores_exact_vectors(index_spec: Dict) -> bool:
+    """
+    インデックスから元のベクトルをそのまま復元できるか (float32で保持するflat / HNSW)
+    復元できるインデックスの再構築では埋め込みをやり直さない
+    """
+    spec = normalize_index_spec(index_spec)
+    return spec["storage"] == "float32" and spec["type"] in ("flat", "hnsw")
+
+def create_faiss_index(dim: int, index_spec: Dict) -> faiss.Index:
+    """
+    設定に従って空のインデックスを生成する (距離はlangchainの既定と同じL2)
+    """
+    spec = normalize_index_spec(index_spec)
+    index_type, storage = spec["type"], spec["storage"]
+    if storage == "pq" and dim % spec["pq_m"] != 0:
+        raise ValueError(f"pq_m ({spec['pq_m']}) must divide the embedding dimension ({dim})")
+
+    if index_type == "flat":
+        if storage == "float32":
+            return faiss.IndexFlatL2(dim)
+        if storage == "float16":
+            return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+        return faiss.IndexPQ(dim, spec["pq_m"], spec["pq_nbits"])
+
+    if index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dim, spec["hnsw_m"])
+        elif storage == "float16":
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, spec["hnsw_m"])
+        else:
+            index = faiss.IndexHNSWPQ(dim, spec["pq_m"], spec["hnsw_m"], spec["pq_nbits"])
+        index.hnsw.efConstruction = spec["ef_construction"]
+        index.hnsw.efSearch = spec["ef_search"]
+        return index
+
+    quantizer = faiss.IndexFlatL2(dim)
+    if storage == "float32":
+        index = faiss.IndexIVFFlat(quantizer, dim, spec["nlist"])
+    elif storage == "float16":
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dim, spec["nlist"], faiss.ScalarQuantizer.QT_fp16)
+    else:
+        index = faiss.IndexIVFPQ(quantizer, dim, spec["nlist"], spec["pq_m"], spec["pq_nbits"])
+    index.nprobe = spec["nprobe"]
+    return index
+
+def estimate_vector_bytes(dim: int, index_spec: Optional[Dict] = None) -> int:
+    """
+    1ベクトルあたりのインデックスのメモリ使用量の概算 (ベクトルの符号 + HNSWのリンク / IVFのID)
+    """
+    spec = normalize_index_spec(index_spec)
+    if spec["storage"] == "float32":
+        code_bytes = dim * 4
+    elif spec["storage"] == "float16":
+        code_bytes = dim * 2
+    else:
+        code_bytes = spec["pq_m"] * spec["pq_nbits"] // 8
+    if spec["type"] == "hnsw":
+        # 最下層は2 * hnsw_m本のリンク (int32) を持つ
+        code_bytes += spec["hnsw_m"] * 2 * 4
+    elif spec["type"] == "ivfpq":
+        code_bytes += 8
+    return code_bytes
+
+def build_faiss_index(vectors: np.ndarray, index_spec: Optional[Dict] = None) -> faiss.Index:
+    """
+    設定に従ってインデックスを生成し、必要な場合はvectorsからサンプリングした学習データで学習する
+    ベクトルの追加は行わない (langchainのFAISS.add_embeddingsで追加する)
+
+    Args:
+        vectors (np.ndarray): (ベクトル数, 次元数) の埋め込みベクトル
+        index_spec (dict): インデックスの設定 (DEFAULT_INDEX_SPECを参照)
+
+    Returns:
+        faiss.Index: 学習済みの空のインデックス
+    """
+    spec = normalize_index_spec(index_spec)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_vectors, dim = vectors.shape
+
+    if spec["type"] == "ivfpq":
+        # 学習データが少ない場合はクラスタ数を減らす
+        n_train = min(n_vectors, spec["train_size"])
+        spec["nlist"] = max(1, min(spec["nlist"], n_train // MIN_POINTS_PER_CENTROID))
+
+    index = create_faiss_index(dim, spec)
+    if index.is_trained:
+        return index
+
+    n_train = min(n_vectors, spec["train_size"])
+    if spec["storage"] == "pq" and n_train < 2 ** spec["pq_nbits"]:
+        raise ValueError(
+            f"PQ storage needs at least {2 ** spec['pq_nbits']} training vectors (got {n_train}). "
+            "Use storage='float32'/'float16' or a smaller pq_nbits for small corpora"
+            )
+    rng = np.random.default_rng(spec["seed"])
+    sample = vectors if n_train == n_vectors else vectors[rng.choice(n_vectors, n_train, replace=False)]
+    index.train(sample)
+    return index
+
+def apply_search_params(index: faiss.Index, search_params: Optional[Dict] = None) -> None:
+    """
+    検索時のパラメータ (IVFのnprobe、HNSWのefSearchなど) をインデックスに設定する
+    パラメータ名はfaiss.ParameterSpaceに従う。インデックスに存在しないパラメータを指定した場合は例外を送出する
+    """
+    if not search_params:
+        return
+    parameter_space = faiss.ParameterSpace()
+    for name, value in search_params.items():
+        parameter_space.set_index_parameter(index, name, value)
+
+def read_flags(index_path: str) -> int:
+    """
+    インデックスをメモリマップとして読み込むためのfaiss.read_indexのフラグを、インデックスの種類に応じて選択する
+
+    ・IVF (先頭のfourccが"Iw") : 転置リストをIO_FLAG_MMAPでメモリマップする (IO_FLAG_MMAP_IFCとは併用できない)
+    ・フラット、SQ/float16、HNSWなど : IO_FLAG_MMAPでは符号がヒープに読み込まれるため、
+      符号の配列をIO_FLAG_MMAP_IFCでゼロコピーに参照する (faiss 1.10以降。それより前のバージョンでは通常どおり読み込む)
+    """
+    with open(index_path, "rb") as f:
+        fourcc = f.read(4)
+    if fourcc.startswith(b"Iw"):
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+def read_faiss_store(
+        folder_path: str,
+        embeddings,
+        mmap: bool = True,
+        search_params: Optional[Dict] = None,
+        index_name: str = "index"
+        ) -> FAISS:
+    """
+    FAISS.save_localで保存したVector DBを読み込む
+
+    mmap=Trueの場合、インデックスのベクトル (符号) をファイルのメモリマップとして参照し、ヒープには複製しない
+    (実際にメモリに載るのはOSのページキャッシュ)。インデックスの種類によってメモリマップの方式が異なるため、
+    フラグはread_flagsで選択する。読み込み専用となるため、追加・削除する場合はmmap=Falseとする
+    """
+    index_path = os.path.join(folder_path, f"{index_name}.faiss")
+    index = faiss.read_index(index_path, read_flags(index_path) if mmap else 0)
+    apply_search_params(index, search_params)
+    with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
@@ -0,0 +1,149 @@
+import os
+import base64
+import math
+import mimetypes
+from typing import Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+
+# モデル (GPT-4o系, detail="high") が画像を縮小する上限
+# 長辺2048px以内に収めた後、短辺を768px以内に縮小するため、これを超える解像度はトークン数にも精度にも寄与しない
+MODEL_MAX_LONG_SIDE = 2048
+MODEL_MAX_SHORT_SIDE = 768
+
+IMAGE_FORMATS = {
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+}
+
+
+class EncodedImage:
+    """
+    メモリ上でエンコードした画像 (ファイルに保存せずにリクエストに用いる)
+    """
+
+    def __init__(self, data: bytes, mime_type: str, width: int, height: int):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def __repr__(self) -> str:
+        return f"EncodedImage({self.mime_type}, {self.width}x{self.height}, {self.nbytes} bytes)"
+
+
+def fit_scale(
+        width: float,
+        height: float,
+        max_long_side: Optional[int] = MODEL_MAX_LONG_SIDE,
+        max_short_side: Optional[int] = MODEL_MAX_SHORT_SIDE
+        ) -> float:
+    """
+    画像を長辺・短辺の上限に収めるための縮小率 (1以下) を返す
+    """
+    scale = 1.0
+    if max_long_side:
+        scale = min(scale, max_long_side / max(width, height))
+    if max_short_side:
+        scale = min(scale, max_short_side / min(width, height))
+    return scale
+
+def estimate_image_tokens(
+        width: int,
+        height: int,
+        detail: Optional[str] = None,
+        base_tokens: int = 85,
+        tile_tokens: int = 170
+        ) -> int:
+    """
+    画像1枚あたりの入力トークン数を見積もる (GPT-4o系の512pxタイル単位の計算)
+    モデルの上限 (MODEL_MAX_LONG_SIDE/MODEL_MAX_SHORT_SIDE) に縮小した後のタイル数から算出する
+    detail="low"の場合はbase_tokensのみとなる
+    (gpt-4o-miniは課金上のトークン数が異なるため、base_tokens=2833, tile_tokens=5667を指定する)
+    """
+    if detail == "low":
+        return base_tokens
+    scale = fit_scale(width, height)
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return base_tokens + tile_tokens * tiles
+
+def encode_image_array(
+        image: np.ndarray,
+        image_format: str = "jpeg",
+        quality: int = 85,
+        max_long_side: Optional[int] = MODEL_MAX_LONG_SIDE,
+        max_short_side: Optional[int] = MODEL_MAX_SHORT_SIDE
+        ) -> EncodedImage:
+    """
+    RGB画像を上限の解像度まで縮小し、メモリ上でエンコードする
+
+    Args:
+        image (np.ndarray): (高さ, 幅, 3) のRGB画像
+        image_format (str): "jpeg", "webp" または "png"
+        quality (int): JPEG/WebPの品質 (1-100。PNGでは無視)
+        max_long_side (int): 長辺の上限 (Noneの場合は制限しない)
+        max_short_side (int): 短辺の上限 (Noneの場合は制限しない)
+
+    Returns:
+        EncodedImage: エンコードした画像
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {image_format} (expected one of {list(IMAGE_FORMATS)})")
+
+    height, width = image.shape[:2]
+    scale = fit_scale(width, height, max_long_side, max_short_side)
+    if scale < 1.0:
+        width = max(1, math.floor(width * scale))
+        height = max(1, math.floor(height * scale))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    extension, mime_type = IMAGE_FORMATS[image_format]
+    params = []
+    if image_format == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    ok, buffer = cv2.imencode(extension, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise RuntimeError(f"Failed to encode image as {image_format}")
+    return EncodedImage(buffer.tobytes(), mime_type, width, height)
+
+def load_image(image: Union[str, EncodedImage]) -> Tuple[str, str]:
+    """
+    画像のパスまたはEncodedImageから、リクエストに埋め込むbase64文字列とMIMEタイプを取得する
+    """
+    if isinstance(image, EncodedImage):
+        return image.to_base64(), image.mime_type
+    mime_type = mimetypes.guess_type(image)[0] or "image/png"
+    with open(image, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8"), mime_type
+
+def image_nbytes(image: Union[str, EncodedImage]) -> int:
+    """
+    エンコード後の画像のバイト数
+    """
+    if isinstance(image, EncodedImage):
+        return image.nbytes
+    return os.path.getsize(image)
+
+def summarize_image_sizes(images: List[Union[str, EncodedImage]]) -> Dict[str, float]:
+    """
+    ページごとの画像のバイト数を集計する (ページ数、合計、平均、最大)
+    """
+    sizes = [image_nbytes(image) for image in images]
+    return {
+        "pages": len(sizes),
+        "total_bytes": sum(sizes),
+        "mean_bytes": sum(sizes) / len(sizes) if sizes else 0.0,
+        "max_bytes": max(sizes) if sizes else 0,
+    }
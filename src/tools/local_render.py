@@ -0,0 +1,346 @@
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+# 箇条書きとして扱う行頭の記号
+BULLET_CHARS = "・●○■□◆◇▪▸►•"
+
+# ページ番号とみなす行 (ページの先頭または末尾の数字のみの行)
+_PAGE_NUMBER_PATTERN = re.compile(r"^\d{1,4}$")
+
+# 座標の比較で許容する誤差 (pt)
+_TOLERANCE = 2.0
+
+
+def _area(bbox) -> float:
+    x0, y0, x1, y1 = bbox
+    return max(0.0, x1 - x0) * max(0.0, y1 - y0)
+
+def _union(bbox, other):
+    if bbox is None:
+        return tuple(other)
+    return (min(bbox[0], other[0]), min(bbox[1], other[1]), max(bbox[2], other[2]), max(bbox[3], other[3]))
+
+def _intersection_area(bbox, other) -> float:
+    return _area((max(bbox[0], other[0]), max(bbox[1], other[1]), min(bbox[2], other[2]), min(bbox[3], other[3])))
+
+def _inside_any(bbox, table_bboxes) -> bool:
+    """
+    行の中心がいずれかの表の領域内にあるか (表のテキストはテキストブロックにも含まれるため除外に用いる)
+    """
+    cx = (bbox[0] + bbox[2]) / 2
+    cy = (bbox[1] + bbox[3]) / 2
+    return any(x0 <= cx <= x1 and y0 <= cy <= y1 for x0, y0, x1, y1 in table_bboxes)
+
+def _line_text(line) -> str:
+    """
+    行内のspanを連結する (文字サイズの半分以上の間隔があるspanの間には空白を入れる)
+    """
+    text = ""
+    prev_x1 = None
+    for span in line["spans"]:
+        if prev_x1 is not None and span["bbox"][0] - prev_x1 > (span.get("size") or 0) / 2:
+            text += " "
+        text += span["text"]
+        prev_x1 = span["bbox"][2]
+    return text.strip()
+
+def _line_size(line) -> float:
+    """
+    行の文字サイズ (文字数が最も多いspanの文字サイズ)
+    """
+    return max(line["spans"], key=lambda span: len(span["text"].strip())).get("size") or 0.0
+
+def _is_horizontal(line) -> bool:
+    direction = line.get("dir", (1.0, 0.0))
+    return line.get("wmode", 0) == 0 and direction[0] > 0 and abs(direction[1]) < 1e-3
+
+def _iter_text_lines(blocks, table_bboxes):
+    """
+    表の領域外にある空でないテキスト行を (ブロックの位置, ブロック, 行, テキスト) で返す
+    """
+    for i, block in enumerate(blocks):
+        if block.get("type") != 0:
+            continue
+        for line in block["lines"]:
+            if not line["spans"] or _inside_any(line["bbox"], table_bboxes):
+                continue
+            text = _line_text(line)
+            if text:
+                yield i, block, line, text
+
+def _table_empty_ratio(data) -> float:
+    """
+    表の空セル (結合セルを含む) の割合。1行または1列のみの表は表として扱えないため1とする
+    """
+    if len(data) < 2 or max(len(row) for row in data) < 2:
+        return 1.0
+    cells = [cell for row in data for cell in row]
+    empty = sum(1 for cell in cells if cell is None or not str(cell).strip())
+    return empty / len(cells)
+
+
+def classify_page(
+        blocks: list,
+        min_chars: int = 20,
+        min_text_coverage: float = 0.1,
+        max_image_ratio: float = 0.1,
+        min_order_confidence: float = 0.9,
+        max_fragment_ratio: float = 0.3,
+        max_table_empty_ratio: float = 0.2,
+        max_tabular_rows: int = 1
+        ) -> Dict:
+    """
+    抽出済みのテキストブロック情報から、ページをLLMを用いずに変換できるか判定する
+
+    以下の指標を算出し、いずれも基準を満たすページを「ローカルで変換可能」とする
+    ・文字数、テキストの被覆率 (テキスト行の面積 / ブロック全体を囲む領域の面積)
+    ・画像の面積比 (画像ブロックの面積 / ブロック全体を囲む領域の面積)
+    ・表の有無と複雑さ (空セル・結合セルの割合)、表として検出されなかった表形式の行の数
+      (同じブロック内で同じ高さに並ぶ行、またはページ全体で同じ高さに3つ以上並ぶ行)
+    ・読み順の確からしさ (ブロックの並びが上から下、左の段から右の段の順になっているか、ブロックの重なりがないか)
+    ・断片化の度合い (2文字以下の行の割合。図中のラベルなど)
+
+    ブロックが取得できずに単語から補完したページ、縦書き・回転したテキストを含むページはLLMに回す
+    ベクター描画の図はブロック情報に現れないため、図中のラベルによる被覆率の低下と断片化で検出する
+
+    Args:
+        blocks (list): extract_page_blocksで抽出したテキストブロック情報 (表情報含)
+        min_chars (int): 最小の文字数
+        min_text_coverage (float): テキストの被覆率の下限
+        max_image_ratio (float): 画像の面積比の上限
+        min_order_confidence (float): 読み順の確からしさの下限
+        max_fragment_ratio (float): 断片化した行の割合の上限
+        max_table_empty_ratio (float): 表の空セルの割合の上限
+        max_tabular_rows (int): 表として検出されなかった表形式の行の数の上限
+
+    Returns:
+        dict: "local" (ローカルで変換可能か), "reasons" (LLMに回す理由のリスト) と各指標
+    """
+    tables = [block for block in blocks if block.get("type") == "table"]
+    table_bboxes = [table["bbox"] for table in tables]
+
+    content_bbox = None
+    image_area = 0.0
+    for block in blocks:
+        content_bbox = _union(content_bbox, block["bbox"])
+        if block.get("type") == 1:
+            image_area += _area(block["bbox"])
+
+    chars = 0
+    text_area = 0.0
+    line_count = 0
+    fragments = 0
+    rotated = 0
+    fallback = False
+    text_block_bboxes: Dict[int, Tuple] = {}
+    rows: Dict[int, List[int]] = {}
+    for i, block, line, text in _iter_text_lines(blocks, table_bboxes):
+        n_chars = len(text.replace(" ", ""))
+        chars += n_chars
+        line_count += 1
+        text_area += _area(line["bbox"])
+        if n_chars <= 2:
+            fragments += 1
+        if not _is_horizontal(line):
+            rotated += 1
+        if any(span.get("font") == "unknown" or not span.get("size") for span in line["spans"]):
+            fallback = True
+        text_block_bboxes[i] = block["bbox"]
+        baseline = line["spans"][0].get("origin", (0, line["bbox"][3]))[1]
+        rows.setdefault(round(baseline / 2), []).append(i)
+
+    # 読み順: 前のブロックより上かつ左に戻る並び (段の切り替えではない逆行) と、他のブロックと重なるブロックを数える
+    ordered = list(text_block_bboxes.values())
+    anomalies = 0
+    for prev, current in zip(ordered, ordered[1:]):
+        if current[1] < prev[1] - _TOLERANCE and current[0] < prev[2] - _TOLERANCE:
+            anomalies += 1
+    for j, bbox in enumerate(ordered):
+        for other in ordered[j + 1:]:
+            if _intersection_area(bbox, other) > 0.3 * min(_area(bbox), _area(other)):
+                anomalies += 1
+                break
+
+    tabular_rows = sum(
+        1 for row in rows.values()
+        if len(row) >= 3 or (len(row) >= 2 and len(set(row)) < len(row))
+    )
+
+    content_area = _area(content_bbox) if content_bbox is not None else 0.0
+    result = {
+        "chars": chars,
+        "text_coverage": text_area / content_area if content_area else 0.0,
+        "image_ratio": min(1.0, image_area / content_area) if content_area else 0.0,
+        "tables": len(tables),
+        "table_empty_ratio": max((_table_empty_ratio(table["data"]) for table in tables), default=0.0),
+        "tabular_rows": tabular_rows,
+        "order_confidence": max(0.0, 1.0 - anomalies / len(ordered)) if ordered else 0.0,
+        "fragment_ratio": fragments / line_count if line_count else 0.0,
+    }
+
+    reasons = []
+    if fallback:
+        reasons.append("fallback_blocks")
+    if chars < min_chars:
+        reasons.append("few_chars")
+    if result["image_ratio"] > max_image_ratio:
+        reasons.append("images")
+    if result["text_coverage"] < min_text_coverage:
+        reasons.append("sparse_text")
+    if result["table_empty_ratio"] > max_table_empty_ratio:
+        reasons.append("complex_table")
+    if tabular_rows > max_tabular_rows:
+        reasons.append("tabular_text")
+    if rotated:
+        reasons.append("rotated_text")
+    if result["order_confidence"] < min_order_confidence:
+        reasons.append("reading_order")
+    if result["fragment_ratio"] > max_fragment_ratio:
+        reasons.append("fragmented")
+
+    result["local"] = not reasons
+    result["reasons"] = reasons
+    return result
+
+def summarize_routes(classifications: Sequence[Dict]) -> Dict:
+    """
+    classify_pageの結果を集計する (ローカルで変換するページの割合と、LLMに回す理由ごとのページ数)
+    """
+    local = sum(1 for classification in classifications if classification["local"])
+    reasons = Counter(reason for classification in classifications for reason in classification["reasons"])
+    return {
+        "pages": len(classifications),
+        "local": local,
+        "model": len(classifications) - local,
+        "local_ratio": local / len(classifications) if classifications else 0.0,
+        "reasons": dict(reasons.most_common()),
+    }
+
+
+def _join_lines(text: str, line: str) -> str:
+    """
+    折り返された行を連結する (英数字同士の場合のみ空白を入れる)
+    """
+    if text and text[-1].isascii() and text[-1].isalnum() and line[0].isascii() and line[0].isalnum():
+        return f"{text} {line}"
+    return text + line
+
+def _escape_cell(cell) -> str:
+    if cell is None:
+        return ""
+    return " ".join(str(cell).split()).replace("|", "\\|")
+
+def table_to_markdown(data: List[list]) -> str:
+    """
+    find_tablesで抽出した表 (行のリスト) をMarkdownの表に変換する (1行目を見出し行とする)
+    """
+    n_cols = max((len(row) for row in data), default=0)
+    if not n_cols:
+        return ""
+    rows = [[_escape_cell(cell) for cell in row] + [""] * (n_cols - len(row)) for row in data]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + " --- |" * n_cols]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+def render_page_markdown(
+        blocks: list,
+        heading_ratio: float = 1.15,
+        max_heading_levels: int = 3,
+        max_heading_length: int = 60
+        ) -> str:
+    """
+    テキストブロック情報からLLMを用いずにMarkdownを生成する (classify_pageでローカルと判定したページ向け)
+
+    ・本文の文字サイズ (最も多くの文字に使われているサイズ) のheading_ratio倍以上の短い行を見出しとし、
+      文字サイズの大きい順に "#", "##", ... を割り当てる
+    ・行頭が箇条書きの記号の行は箇条書きとし、続く行は同じ項目の折り返しとして連結する
+    ・その他の行はブロック単位で段落にまとめる
+    ・表はfind_tablesの結果からMarkdownの表を生成し、表の領域内のテキスト行は出力しない
+    ・ページの先頭または末尾の数字のみの行はページ番号とみなして出力しない
+
+    Args:
+        blocks (list): テキストブロック情報 (表情報含)
+        heading_ratio (float): 見出しとみなす文字サイズの本文に対する比率
+        max_heading_levels (int): 見出しの階層数の上限 (これより小さい見出しは最下位の階層とする)
+        max_heading_length (int): 見出しとみなす行の最大文字数
+
+    Returns:
+        str: Markdown形式のテキスト
+    """
+    table_bboxes = [block["bbox"] for block in blocks if block.get("type") == "table"]
+    text_lines = list(_iter_text_lines(blocks, table_bboxes))
+
+    # 本文の文字サイズと見出しの階層
+    size_chars: Counter = Counter()
+    for _, _, line, text in text_lines:
+        size_chars[round(_line_size(line) * 2) / 2] += len(text)
+    body_size = size_chars.most_common(1)[0][0] if size_chars else 0.0
+
+    def heading_size(line, text) -> Optional[float]:
+        size = round(_line_size(line) * 2) / 2
+        if body_size and size >= body_size * heading_ratio and len(text) <= max_heading_length:
+            return size
+        return None
+
+    heading_sizes = sorted(
+        {heading_size(line, text) for _, _, line, text in text_lines} - {None}, reverse=True
+        )
+    heading_levels = {size: min(level, max_heading_levels) for level, size in enumerate(heading_sizes, start=1)}
+
+    page_number_lines = set()
+    for position in (0, -1):
+        if text_lines and _PAGE_NUMBER_PATTERN.match(text_lines[position][3]):
+            page_number_lines.add(id(text_lines[position][2]))
+
+    # ブロックの順に、見出し・箇条書き・段落・表の要素を組み立てる
+    elements: List[Tuple[str, str]] = []
+    lines_by_block: Dict[int, list] = {}
+    for i, _, line, text in text_lines:
+        if id(line) not in page_number_lines:
+            lines_by_block.setdefault(i, []).append((line, text))
+
+    for i, block in enumerate(blocks):
+        if block.get("type") == "table":
+            table = table_to_markdown(block["data"])
+            if table:
+                elements.append(("table", table))
+            continue
+
+        current_kind = None
+        for line, text in lines_by_block.get(i, ()):
+            size = heading_size(line, text)
+            if size is not None:
+                kind = f"heading{heading_levels[size]}"
+            elif text[0] in BULLET_CHARS:
+                kind = "item"
+                text = text[1:].strip()
+                if not text:
+                    continue
+                elements.append((kind, text))
+                current_kind = kind
+                continue
+            else:
+                # 箇条書きの項目に続く行は項目の折り返しとする
+                kind = "item" if current_kind == "item" else "text"
+
+            if kind == current_kind:
+                elements[-1] = (kind, _join_lines(elements[-1][1], text))
+            else:
+                elements.append((kind, text))
+            current_kind = kind
+
+    markdown = ""
+    prev_kind = None
+    for kind, text in elements:
+        if kind.startswith("heading"):
+            text = "#" * int(kind[len("heading"):]) + " " + text
+        elif kind == "item":
+            text = "- " + text
+        if markdown:
+            # 連続する箇条書きは1つのリストにまとめる
+            markdown += "\n" if kind == "item" and prev_kind == "item" else "\n\n"
+        markdown += text
+        prev_kind = kind
+    return markdown
@@ -0,0 +1,45 @@
+import re
+from bisect import bisect_right
+from typing import List, Tuple
+
+
+# ATX形式の見出し (行頭の#1〜6個と空白に続くテキスト。末尾の閉じの#は除く)
+_HEADING_PATTERN = re.compile(r'^ {0,3}(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$', flags=re.MULTILINE)
+# コードブロックの開始・終了の行 (コードブロック内の#は見出しとみなさない)
+_FENCE_PATTERN = re.compile(r'^ {0,3}(?:```|~~~)', flags=re.MULTILINE)
+
+
+def read_markdown(md_path: str) -> str:
+    with open(md_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def markdown_sections(text: str) -> List[Tuple[int, List[str]]]:
+    """
+    Markdownを見出しごとの区間に分け、区間の開始位置と見出しの階層 (上位の見出しから順) を返す
+    区間はテキストを隙間なく覆い、最初の見出しより前の部分は見出しなしの区間とする
+
+    Args:
+        text (str): Markdownのテキスト
+
+    Returns:
+        list: (区間の開始位置, 見出しのリスト) のリスト (開始位置の昇順)
+    """
+    fences = [match.start() for match in _FENCE_PATTERN.finditer(text)] if "```" in text or "~~~" in text else []
+    sections = [(0, [])]
+    stack: List[Tuple[int, str]] = []
+    for match in _HEADING_PATTERN.finditer(text):
+        title = match.group(2).strip()
+        # 開始・終了の行の間 (奇数番目の区間) にある見出しはコードブロック内
+        if not title or bisect_right(fences, match.start()) % 2 == 1:
+            continue
+        level = len(match.group(1))
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        stack.append((level, title))
+        headings = [heading for _, heading in stack]
+        if sections[-1][0] == match.start():
+            sections[-1] = (match.start(), headings)
+        else:
+            sections.append((match.start(), headings))
+    return sections
+
@@ -0,0 +1,357 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# Prometheusのメトリクス名の接頭辞
+METRIC_PREFIX = "fdua"
+# トレースの出力先を子プロセス (プロセスプールのワーカー) に引き継ぐための環境変数
+TRACE_ENV = "FDUA_METRICS_TRACE"
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict) -> _LabelKey:
+    return tuple(sorted((str(key), str(value)) for key, value in labels.items() if value is not None))
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(key: _LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in key) + "}"
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", f"{METRIC_PREFIX}_{name}")
+
+
+class MetricsRegistry:
+    """
+    処理時間・トークン数・リトライ回数などの計測値をプロセス内で集計し、JSON Linesのトレースに記録する
+
+    ・カウンタ (inc) は累積値、観測値 (observe) は件数・合計・最大値を保持する
+    ・timerはブロックの経過時間 (wall) とスレッドのCPU時間 (cpu) を段階 (stage) ごとに記録する
+      (非同期処理のCPU時間は同じスレッドの他のコルーチンの処理を含むため、非同期処理ではwallのみを参照する)
+    ・trace_pathを指定した場合、timerとeventの記録を1行1件のJSONとして追記する
+      (ページ番号・ドキュメント名などの粒度の細かい情報はトレースにのみ記録し、集計値のラベルには含めない)
+    ・集計値はsnapshot (dict) またはto_prometheus (Prometheusのテキスト形式) で出力する
+
+    集計値はプロセスごとに保持されるため、プロセスプールのワーカーの計測値はトレースからのみ参照できる
+    (summarize_traceでトレースを集計する)
+    """
+
+    def __init__(self, trace_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, _LabelKey], float] = {}
+        self._summaries: Dict[Tuple[str, _LabelKey], List[float]] = {}
+        self._trace = None
+        self.trace_path = None
+        if trace_path:
+            self.open_trace(trace_path)
+
+    def open_trace(self, trace_path: str) -> None:
+        """
+        トレースの出力先を設定する (既存のファイルには追記する)
+        """
+        self.close_trace()
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        # 複数プロセスから追記しても行が混ざらないよう、1行ずつ書き出す
+        self._trace = open(trace_path, "a", encoding="utf-8", buffering=1)
+        self.trace_path = trace_path
+
+    def close_trace(self) -> None:
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+            self._trace = None
+            self.trace_path = None
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        """
+        カウンタに加算する
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        観測値 (処理時間、バッチサイズなど) を記録する
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    def event(self, kind: str, **fields) -> None:
+        """
+        トレースに1件の記録を追記する (トレースの出力先が未設定の場合は何もしない)
+        """
+        if self._trace is None:
+            return
+        record = {"ts": time.time(), "pid": os.getpid(), "kind": kind, **fields}
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._trace is not None:
+                self._trace.write(line)
+
+    @contextmanager
+    def timer(self, stage: str, **fields) -> Iterator[Dict]:
+        """
+        ブロックの経過時間とCPU時間を段階ごとに記録する
+
+        yieldしたdictに追加した項目 (トークン数など) はトレースの記録に含まれる
+        ブロック内で例外が発生した場合は、エラーとして件数を記録した上で例外を送出する
+
+        Args:
+            stage (str): 段階の名前 (集計値のラベル)
+            **fields: トレースにのみ記録する項目 (ドキュメント名、ページ番号など)
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        status = "ok"
+        try:
+            yield fields
+        except BaseException as e:
+            status = "error"
+            fields["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            self.observe("stage_wall_seconds", wall, stage=stage)
+            self.observe("stage_cpu_seconds", cpu, stage=stage)
+            if status != "ok":
+                self.inc("stage_errors_total", stage=stage)
+            self.event("stage", stage=stage, status=status, wall=wall, cpu=cpu, **fields)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def snapshot(self) -> Dict:
+        """
+        集計値をdictで返す (キャッシュのヒット率はcache_requests_totalから算出する)
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            summaries = {key: list(value) for key, value in self._summaries.items()}
+
+        cache_requests: Dict[str, Dict[str, float]] = {}
+        for (name, key), value in counters.items():
+            if name == "cache_requests_total":
+                labels = dict(key)
+                cache_requests.setdefault(labels.get("cache", ""), {}).setdefault(labels.get("result", ""), 0.0)
+                cache_requests[labels.get("cache", "")][labels.get("result", "")] += value
+
+        return {
+            "counters": [
+                {"name": name, "labels": dict(key), "value": value}
+                for (name, key), value in sorted(counters.items())
+            ],
+            "summaries": [
+                {"name": name, "labels": dict(key), "count": count, "sum": total, "max": peak}
+                for (name, key), (count, total, peak) in sorted(summaries.items())
+            ],
+            "cache_hit_rate": {
+                cache: results.get("hit", 0.0) / sum(results.values()) if sum(results.values()) else 0.0
+                for cache, results in cache_requests.items()
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        集計値をPrometheusのテキスト形式で返す
+        観測値はsummary (_count, _sum) と、最大値のgauge (_max) として出力する
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted((key, list(value)) for key, value in self._summaries.items())
+
+        lines = []
+        current = None
+        for (name, key), value in counters:
+            metric = _metric_name(name)
+            if metric != current:
+                lines.append(f"# TYPE {metric} counter")
+                current = metric
+            lines.append(f"{metric}{_format_labels(key)} {value:g}")
+
+        current = None
+        for (name, key), (count, total, _) in summaries:
+            metric = _metric_name(name)
+            if metric != current:
+                lines.append(f"# TYPE {metric} summary")
+                current = metric
+            labels = _format_labels(key)
+            lines.append(f"{metric}_count{labels} {count:g}")
+            lines.append(f"{metric}_sum{labels} {total:.6g}")
+        current = None
+        for (name, key), (_, _, peak) in summaries:
+            metric = _metric_name(name) + "_max"
+            if metric != current:
+                lines.append(f"# TYPE {metric} gauge")
+                current = metric
+            lines.append(f"{metric}{_format_labels(key)} {peak:.6g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Prometheusのテキスト形式のスナップショットを一時ファイル経由で書き出す (node_exporterのtextfile collector向け)
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+_REGISTRY: Optional[MetricsRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """
+    プロセス内で共有するMetricsRegistryを取得する
+    環境変数FDUA_METRICS_TRACEが設定されている場合、そのパスにトレースを記録する
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = MetricsRegistry(os.environ.get(TRACE_ENV))
+    return _REGISTRY
+
+def configure_metrics(trace_path: Optional[str] = None, reset: bool = False) -> MetricsRegistry:
+    """
+    トレースの出力先を設定する
+
+    環境変数にも設定するため、以降に起動したプロセスプールのワーカーも同じファイルに追記する
+
+    Args:
+        trace_path (str): トレース (JSON Lines) の出力先 (Noneの場合はトレースを記録しない)
+        reset (bool): それまでの集計値を破棄するかどうか
+    """
+    metrics = get_metrics()
+    if reset:
+        metrics.reset()
+    if trace_path is None:
+        os.environ.pop(TRACE_ENV, None)
+        metrics.close_trace()
+    else:
+        os.environ[TRACE_ENV] = os.path.abspath(trace_path)
+        metrics.open_trace(os.path.abspath(trace_path))
+    return metrics
+
+def record_llm_request(
+        operation: str,
+        model: str,
+        status: str,
+        seconds: float,
+        usage=None,
+        image_tokens: int = 0,
+        document: Optional[str] = None,
+        **fields
+        ) -> Dict[str, int]:
+    """
+    APIの1回のリクエストの結果 (件数、応答時間、トークン数) を記録する
+
+    Args:
+        operation (str): 処理の種類 ("extract", "embed", "answer")
+        model (str): モデル名
+        status (str): "ok" (成功), "retry" (再試行する失敗), "error" (再試行しない失敗)
+        seconds (float): 応答までの秒数
+        usage: APIの応答のusage (prompt_tokens, completion_tokens) またはlangchainのusage_metadata
+        image_tokens (int): 画像の入力トークン数の見積もり (prompt_tokensの内数として別に記録する)
+        document (str): ドキュメント名 (トレースにのみ記録する。ドキュメントごとのトークン数はsummarize_traceで集計する)
+        **fields: トレースにのみ記録する項目 (ページ番号、試行回数など)
+
+    Returns:
+        dict: "prompt", "completion", "image" のトークン数
+    """
+    tokens = {"prompt": 0, "completion": 0, "image": 0}
+    if isinstance(usage, dict):
+        # langchainのusage_metadata
+        tokens["prompt"] = int(usage.get("input_tokens", 0) or 0)
+        tokens["completion"] = int(usage.get("output_tokens", 0) or 0)
+    elif usage is not None:
+        tokens["prompt"] = int(getattr(usage, "prompt_tokens", 0) or 0)
+        tokens["completion"] = int(getattr(usage, "completion_tokens", 0) or 0)
+    if usage is not None:
+        tokens["image"] = int(image_tokens)
+
+    metrics = get_metrics()
+    metrics.inc("llm_requests_total", operation=operation, model=model, status=status)
+    metrics.observe("llm_request_seconds", seconds, operation=operation)
+    for kind, count in tokens.items():
+        if count:
+            metrics.inc("llm_tokens_total", count, operation=operation, model=model, kind=kind)
+    metrics.event(
+        "llm_request", operation=operation, model=model, status=status, wall=seconds, document=document,
+        **{f"{kind}_tokens": count for kind, count in tokens.items()}, **fields
+        )
+    return tokens
+
+def summarize_trace(trace_path: str, since: Optional[float] = None) -> Dict:
+    """
+    トレースを集計する (プロセスプールのワーカーの記録も含む)
+    sinceを指定した場合、その時刻 (time.time()) 以降の記録のみを集計する
+
+    Returns:
+        dict: "stages" (段階ごとの件数、エラー数、wall/cpuの合計、wallの最大),
+              "llm" (処理の種類ごとのリクエスト数、再試行数、トークン数),
+              "documents" (ドキュメントごとの段階別の時間、リクエスト数、トークン数)
+    """
+    stages: Dict[str, Dict] = {}
+    llm: Dict[str, Dict] = {}
+    documents: Dict[str, Dict] = {}
+    with open(trace_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if since is not None and record["ts"] < since:
+                continue
+            name = record.get("document")
+            document = None
+            if name is not None:
+                document = documents.setdefault(name, {"wall": {}, "requests": 0, "tokens": {}})
+
+            if record.get("kind") == "stage":
+                stage = stages.setdefault(
+                    record["stage"], {"count": 0, "errors": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0}
+                    )
+                stage["count"] += 1
+                stage["errors"] += record.get("status") != "ok"
+                stage["wall"] += record["wall"]
+                stage["cpu"] += record["cpu"]
+                stage["max_wall"] = max(stage["max_wall"], record["wall"])
+                if document is not None:
+                    document["wall"][record["stage"]] = document["wall"].get(record["stage"], 0.0) + record["wall"]
+
+            elif record.get("kind") == "llm_request":
+                operation = llm.setdefault(record["operation"], {"requests": 0, "retries": 0, "errors": 0, "tokens": {}})
+                operation["requests"] += 1
+                operation["retries"] += record["status"] == "retry"
+                operation["errors"] += record["status"] == "error"
+                if document is not None:
+                    document["requests"] += 1
+                for kind in ("prompt", "completion", "image"):
+                    count = record.get(f"{kind}_tokens", 0)
+                    if not count:
+                        continue
+                    operation["tokens"][kind] = operation["tokens"].get(kind, 0) + count
+                    if document is not None:
+                        document["tokens"][kind] = document["tokens"].get(kind, 0) + count
+    return {"stages": stages, "llm": llm, "documents": documents}
@@ -0,0 +1,563 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Mapping, Optional
+
+from langchain_core.documents import Document
+
+from ..dataset.postprocess import process_markdown_file
+from ..dataset.preprocess import iter_blocks_and_png
+from .batch_extract import aextract_pages
+from .cache import EmbeddingCache, PageCache, hash_parts
+from .create_docs import (
+    CHUNK_FORMAT_VERSION, deduplicate_chunks, file_sha256, load_and_split_markdown, process_files_in_batches
+)
+from .dedup import DEDUP_SCOPES, DEFAULT_DEDUP_CONFIG
+from .embedding import embed_texts
+from .image_encode import MODEL_MAX_LONG_SIDE, MODEL_MAX_SHORT_SIDE
+from .local_render import classify_page, summarize_routes
+from .metrics import configure_metrics, get_metrics, summarize_trace
+from .rate_limit import AsyncRateLimiter
+from .text_extract import extract_company_name
+
+
+# パイプラインの段階 (この順に実行する)
+#   render  : PDFの分割判定、ページ画像の描画、テキストブロック情報の抽出
+#   extract : LLM (またはローカルの変換) によるMarkdown生成
+#   chunk   : Markdownの後処理とチャンク分割
+#   embed   : チャンクの埋め込み (埋め込みキャッシュに保存)
+#   index   : Vector DBの構築 (全ドキュメントの処理後に1回のみ)
+STAGES = ("render", "extract", "chunk", "embed", "index")
+
+# パイプラインの設定の既定値
+DEFAULT_PIPELINE_CONFIG = {
+    # 段階ごとの並列数
+    "render_workers": os.cpu_count() or 1,  # 描画するプロセス数 (ドキュメント単位)
+    "extract_documents": 4,                 # 同時に抽出するドキュメント数
+    "extract_concurrency": 16,              # 全ドキュメントで共有するページ単位のAPI同時実行数
+    "chunk_workers": 2,                     # 後処理・チャンク分割するプロセス数
+    "embed_workers": 4,                     # 埋め込みの同時リクエスト数
+    "queue_size": 4,                        # 段階間のキューに滞留できるドキュメント数
+    # APIのレート制限
+    "requests_per_minute": 500,
+    "tokens_per_minute": 2_000_000,
+    # 描画
+    "dpi": 300,
+    "split": True,
+    "image_format": "jpeg",
+    "quality": 85,
+    "max_long_side": MODEL_MAX_LONG_SIDE,
+    "max_short_side": MODEL_MAX_SHORT_SIDE,
+    # 抽出
+    "local_render": True,
+    # 後処理・チャンク分割
+    "line_target_words": ["統合報告書", "統合レポート"],
+    "header_keywords": ["INDEX", "目次"],
+    "chunk_size": 500,
+    "chunk_overlap": 0,
+    "pretokenize": True,
+    # 近似重複のチャンクの除去 (Noneの場合は行わない。設定はtools.dedup.DEFAULT_DEDUP_CONFIGを参照)
+    "dedup": None,
+    # Vector DB
+    "index_spec": None,
+    # 計測値のトレース (work_dir/metrics/trace.jsonl) とPrometheus形式のスナップショットを出力するかどうか
+    "metrics": True,
+    # この段階まで実行する
+    "until": "index",
+}
+
+# 段階の終了を後続の段階に伝える番兵
+_DONE = object()
+
+
+def normalize_pipeline_config(config: Optional[Dict] = None) -> Dict:
+    """
+    パイプラインの設定を既定値で補完し、値を検証する
+    """
+    merged = dict(DEFAULT_PIPELINE_CONFIG)
+    merged.update(config or {})
+    unknown = set(merged) - set(DEFAULT_PIPELINE_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown pipeline config keys: {sorted(unknown)}")
+    if merged["until"] not in STAGES:
+        raise ValueError(f"Unknown stage: {merged['until']} (expected one of {list(STAGES)})")
+    for key in (
+            "render_workers", "extract_documents", "extract_concurrency", "chunk_workers", "embed_workers", "queue_size"
+            ):
+        if merged[key] < 1:
+            raise ValueError(f"{key} must be >= 1")
+    return merged
+
+def document_name(pdf_path: str) -> str:
+    """
+    PDFのファイル名からドキュメント名を生成する (例: "1_xxx.pdf" -> "001")
+    """
+    return os.path.basename(pdf_path).split('.')[0].split('_')[0].zfill(3)
+
+def _write_json(path: str, data) -> None:
+    """
+    一時ファイルに書き出してから差し替える (書き込み途中のファイルをチェックポイントとして読まないため)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _jsonable_blocks(blocks: list) -> list:
+    """
+    画像ブロックのバイト列 (画像データ、マスク) を除き、JSONで保存できる形にする
+    """
+    return [
+        {key: value for key, value in block.items() if not isinstance(value, bytes)}
+        if block.get("type") == 1 else block
+        for block in blocks
+    ]
+
+def _render_document(pdf_path: str, render_dir: str, render_kwargs: Dict) -> List[Dict]:
+    """
+    プロセスプールのワーカーで1ドキュメントを描画し、ページごとのテキストブロック情報と画像のファイル名を保存する
+    """
+    pages = [
+        {"blocks": _jsonable_blocks(blocks), "image": os.path.basename(image_path)}
+        for _, blocks, image_path in iter_blocks_and_png(pdf_path, render_dir, save_images=True, **render_kwargs)
+    ]
+    _write_json(os.path.join(render_dir, "pages.json"), pages)
+    return pages
+
+def _chunk_document(markdown_path: str, postprocess_dir: str, chunk_dir: str, config: Dict) -> Dict:
+    """
+    プロセスプールのワーカーで1ドキュメントを後処理してチャンクに分割し、チャンクを保存する
+    後処理後のファイルと分割パラメータが保存済みのチャンクと同じ場合は分割を省略する
+    """
+    process_markdown_file(markdown_path, config["line_target_words"], config["header_keywords"], postprocess_dir)
+    postprocessed_path = os.path.join(postprocess_dir, os.path.basename(markdown_path))
+    name = os.path.splitext(os.path.basename(markdown_path))[0]
+    chunk_path = os.path.join(chunk_dir, f"{name}.json")
+    key = hash_parts(
+        file_sha256(postprocessed_path),
+        json.dumps([config["chunk_size"], config["chunk_overlap"], config["pretokenize"], CHUNK_FORMAT_VERSION])
+        )
+
+    if os.path.exists(chunk_path):
+        saved = _read_json(chunk_path)
+        if saved["key"] == key:
+            return {"path": postprocessed_path, "chunks": saved["chunks"], "skipped": True}
+
+    chunks = [
+        {"page_content": doc.page_content, "metadata": doc.metadata}
+        for doc in load_and_split_markdown(
+            postprocessed_path, config["chunk_size"], config["chunk_overlap"], config["pretokenize"]
+            )
+    ]
+    _write_json(chunk_path, {"key": key, "chunks": chunks})
+    return {"path": postprocessed_path, "chunks": chunks, "skipped": False}
+
+def _pages_to_markdown(extracted_texts: List[str]) -> List[str]:
+    """
+    ページごとの抽出結果を "## P.ページ番号" の見出しを付けて連結するための行に変換する
+    """
+    return [f"## P.{i+1}\n\n{extracted_text}\n\n" for i, extracted_text in enumerate(extracted_texts)]
+
+
+class PipelineStats:
+    """
+    段階ごとの処理件数 (処理、チェックポイントによる省略、失敗) と処理時間の集計
+    """
+
+    def __init__(self):
+        self.stages = {stage: {"done": 0, "skipped": 0, "failed": 0, "seconds": 0.0} for stage in STAGES}
+        self.failures: List[Dict] = []
+        self.classifications: List[Dict] = []
+
+    def record(self, stage: str, name: str, status: str, seconds: float, error: Optional[BaseException] = None) -> None:
+        self.stages[stage][status] += 1
+        self.stages[stage]["seconds"] += seconds
+        get_metrics().observe("pipeline_document_seconds", seconds, stage=stage, status=status)
+        message = f"[{stage}] {name}: {status} ({seconds:.1f}s)"
+        if error is not None:
+            self.failures.append({"stage": stage, "name": name, "error": repr(error)})
+            message += f" {type(error).__name__}: {error}"
+        print(message, flush=True)
+
+    def summary(self) -> Dict:
+        summary = {"stages": self.stages, "failures": self.failures}
+        if self.classifications:
+            summary["routes"] = summarize_routes(self.classifications)
+        return summary
+
+
+class SavedChunks(Mapping):
+    """
+    chunk段階で保存したチャンクを、後処理後のMarkdownのファイル名をキーとして参照時に読み込むMapping
+    index段階に全ドキュメントのチャンクをまとめて保持せずに渡す (create_docs.process_files_in_batchesのchunks)
+    """
+
+    def __init__(self, chunk_dir: str, names: List[str]):
+        self.chunk_dir = chunk_dir
+        self.names = list(dict.fromkeys(names))
+        self._names = set(self.names)
+
+    def __contains__(self, name) -> bool:
+        # Mappingの既定の実装はチャンクを読み込むため、ファイル名のみで判定する
+        return name in self._names
+
+    def __getitem__(self, name: str) -> List[Document]:
+        if name not in self._names:
+            raise KeyError(name)
+        saved = _read_json(os.path.join(self.chunk_dir, f"{os.path.splitext(name)[0]}.json"))
+        return [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in saved["chunks"]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+async def _run_stage(
+        stage: str,
+        handler,
+        workers: int,
+        inbox: asyncio.Queue,
+        outbox: Optional[asyncio.Queue],
+        stats: PipelineStats
+        ) -> None:
+    """
+    inboxのドキュメントをworkers個のタスクで並行に処理し、結果をoutboxに渡す
+    失敗したドキュメントは記録して後続の段階には渡さない
+    outboxが満杯の場合は空きが出るまで待つため、後続の段階が詰まると前段の処理も止まる
+    """
+    async def worker():
+        while True:
+            doc = await inbox.get()
+            if doc is _DONE:
+                # 同じ段階の他のワーカーにも終了を伝える
+                await inbox.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                doc, skipped = await handler(doc)
+            except Exception as e:
+                stats.record(stage, doc["name"], "failed", time.perf_counter() - start, e)
+                continue
+            stats.record(stage, doc["name"], "skipped" if skipped else "done", time.perf_counter() - start)
+            if outbox is not None:
+                await outbox.put(doc)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+async def run_pipeline(
+        pdf_paths: List[str],
+        work_dir: str,
+        client,
+        model: str,
+        embeddings=None,
+        index_dir: Optional[str] = None,
+        config: Optional[Dict] = None
+        ):
+    """
+    PDFからVector DBまでの処理を、段階ごとに並列数を指定したパイプラインとして実行する
+
+    各段階はサイズ上限付きのキューでつながっており、異なるドキュメントの描画・抽出・チャンク分割・埋め込みが並行して進む
+    各段階の出力はwork_dirにチェックポイントとして保存し、再実行時は完了済みの段階を省略する
+    ・render  : work_dir/render/<ドキュメント名>/pages.json (ページ画像と同じディレクトリ)
+    ・extract : work_dir/extract/<ドキュメント名>.json (ページ単位の途中経過は .checkpoint.json)
+                Markdownは work_dir/markdowns/<会社名>.md に出力する
+    ・chunk   : work_dir/chunks/<会社名>.json (後処理後のMarkdownは work_dir/markdowns/postprocess)
+    ・embed   : 埋め込みキャッシュ (work_dir/cache/embeddings.sqlite)
+    ・index   : index_dirのマニフェスト (追加・変更されたファイルのみ処理する)
+    config["metrics"]がTrueの場合、ページ単位の処理時間とAPIのトークン数を work_dir/metrics/trace.jsonl に記録し、
+    終了時にPrometheus形式のスナップショットを work_dir/metrics/metrics.prom に出力する
+
+    Args:
+        pdf_paths (list): PDFファイルのパス
+        work_dir (str): 中間生成物とチェックポイントの出力先
+        client (AsyncOpenAI | AsyncAzureOpenAI): Markdown生成に用いる非同期クライアント
+        model (str): Markdown生成に用いるモデル名
+        embeddings: LangChainのEmbeddings (chunkより後の段階を実行する場合は必須)
+        index_dir (str): Vector DBの保存先 (Noneの場合は work_dir/index)
+        config (dict): パイプラインの設定 (DEFAULT_PIPELINE_CONFIGを参照)
+
+    Returns:
+        FAISS: Vector DB (index段階を実行しない場合はNone)
+        dict: 段階ごとの処理件数と処理時間、失敗したドキュメント、ローカルで変換したページの割合、
+              トレースの集計 (config["metrics"]がTrueの場合)
+    """
+    config = normalize_pipeline_config(config)
+    last_stage = STAGES.index(config["until"])
+    if last_stage >= STAGES.index("embed") and embeddings is None:
+        raise ValueError("embeddings is required to run the embed and index stages")
+
+    markdown_dir = os.path.join(work_dir, "markdowns")
+    postprocess_dir = os.path.join(markdown_dir, "postprocess")
+    extract_dir = os.path.join(work_dir, "extract")
+    chunk_dir = os.path.join(work_dir, "chunks")
+    index_dir = index_dir or os.path.join(work_dir, "index")
+    render_kwargs = {
+        key: config[key]
+        for key in ("dpi", "split", "image_format", "quality", "max_long_side", "max_short_side")
+    }
+
+    page_cache = PageCache(os.path.join(work_dir, "cache", "pages.sqlite"))
+    embedding_cache = EmbeddingCache(os.path.join(work_dir, "cache", "embeddings.sqlite"))
+    limiter = AsyncRateLimiter(
+        requests_per_minute=config["requests_per_minute"], tokens_per_minute=config["tokens_per_minute"]
+        )
+    semaphore = asyncio.Semaphore(config["extract_concurrency"])
+    stats = PipelineStats()
+    metrics_dir = os.path.join(work_dir, "metrics")
+    started_at = time.time()
+    if config["metrics"]:
+        # プロセスプールの起動前に設定し、ワーカーの計測値も同じトレースに記録する
+        configure_metrics(os.path.join(metrics_dir, "trace.jsonl"))
+    loop = asyncio.get_running_loop()
+    render_pool = ProcessPoolExecutor(max_workers=config["render_workers"])
+    chunk_pool = ProcessPoolExecutor(max_workers=config["chunk_workers"])
+
+    async def render(doc):
+        render_dir = os.path.join(work_dir, "render", doc["name"])
+        pages_path = os.path.join(render_dir, "pages.json")
+        doc["render_dir"] = render_dir
+        skipped = os.path.exists(pages_path)
+        if skipped and os.path.exists(os.path.join(extract_dir, f"{doc['name']}.json")):
+            # 抽出まで完了済みのドキュメントはページ情報を読み込まない
+            return doc, skipped
+        if skipped:
+            doc["pages"] = await asyncio.to_thread(_read_json, pages_path)
+        else:
+            doc["pages"] = await loop.run_in_executor(
+                render_pool, _render_document, doc["pdf"], render_dir, render_kwargs
+                )
+        return doc, skipped
+
+    async def extract(doc):
+        record_path = os.path.join(extract_dir, f"{doc['name']}.json")
+        if os.path.exists(record_path):
+            doc["markdown"] = _read_json(record_path)["markdown"]
+            return doc, True
+
+        pages_blocks = [page["blocks"] for page in doc["pages"]]
+        image_paths = [os.path.join(doc["render_dir"], page["image"]) for page in doc["pages"]]
+        local_pages = None
+        if config["local_render"]:
+            classifications = [classify_page(blocks) for blocks in pages_blocks]
+            stats.classifications.extend(classifications)
+            local_pages = [classification["local"] for classification in classifications]
+
+        extracted_texts = await aextract_pages(
+            client, image_paths, pages_blocks, model,
+            limiter=limiter,
+            semaphore=semaphore,
+            cache=page_cache,
+            checkpoint_path=os.path.join(extract_dir, f"{doc['name']}.checkpoint.json"),
+            local_pages=local_pages,
+            document=os.path.basename(doc["pdf"])
+            )
+        lines = _pages_to_markdown(extracted_texts)
+        company_name = extract_company_name(lines)
+        doc["markdown"] = os.path.join(markdown_dir, f"{company_name}.md")
+        os.makedirs(markdown_dir, exist_ok=True)
+        with open(doc["markdown"], "w", encoding="utf-8") as f:
+            f.write("".join(lines))
+        _write_json(record_path, {"pdf": doc["pdf"], "markdown": doc["markdown"]})
+        # 後続の段階ではページ情報を使わないため、キューに滞留している間のメモリを解放する
+        del doc["pages"]
+        return doc, False
+
+    async def chunk(doc):
+        result = await loop.run_in_executor(
+            chunk_pool, _chunk_document, doc["markdown"], postprocess_dir, chunk_dir, config
+            )
+        doc["postprocessed"] = result["path"]
+        doc["chunks"] = [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in result["chunks"]]
+        return doc, result["skipped"]
+
+    async def embed(doc):
+        texts = [chunk.page_content for chunk in doc["chunks"]]
+        if config["dedup"] is not None:
+            # ファイル内の重複はindex段階でも必ず除去されるため埋め込まない (ファイル間の重複はindex段階で除去する)
+            removed, _ = deduplicate_chunks(
+                doc["chunks"], list(range(len(texts))), [doc["name"]] * len(texts), {**config["dedup"], "scope": "file"}
+                )
+            texts = [text for i, text in enumerate(texts) if i not in removed]
+        misses = embedding_cache.misses
+        await asyncio.to_thread(
+            embed_texts, embeddings, texts, cache=embedding_cache, max_workers=config["embed_workers"]
+            )
+        # index段階では保存済みのチャンクを読み込み直すため、キューに滞留している間のメモリを解放する
+        del doc["chunks"]
+        # すべてキャッシュ済みだった場合は省略扱いとする
+        return doc, embedding_cache.misses == misses
+
+    handlers = {"render": render, "extract": extract, "chunk": chunk, "embed": embed}
+    workers = {
+        "render": config["render_workers"],
+        "extract": config["extract_documents"],
+        "chunk": config["chunk_workers"],
+        "embed": 1,
+    }
+    streaming_stages = [stage for stage in STAGES[:last_stage + 1] if stage in handlers]
+    queues = [asyncio.Queue(maxsize=config["queue_size"]) for _ in streaming_stages]
+    # 最後の段階の出力はindex段階のために集める
+    completed = asyncio.Queue()
+
+    async def feed():
+        for pdf_path in pdf_paths:
+            await queues[0].put({"name": document_name(pdf_path), "pdf": pdf_path})
+        await queues[0].put(_DONE)
+
+    try:
+        await asyncio.gather(
+            feed(),
+            *(
+                _run_stage(
+                    stage, handlers[stage], workers[stage], queues[i],
+                    queues[i + 1] if i + 1 < len(queues) else completed, stats
+                    )
+                for i, stage in enumerate(streaming_stages)
+            ),
+        )
+    finally:
+        render_pool.shutdown()
+        chunk_pool.shutdown()
+
+    vector_store = None
+    if config["until"] == "index":
+        names = []
+        while not completed.empty():
+            doc = completed.get_nowait()
+            if doc is not _DONE:
+                names.append(os.path.basename(doc["postprocessed"]))
+
+        start = time.perf_counter()
+        md_paths = sorted(glob(os.path.join(postprocess_dir, "*.md")))
+        try:
+            vector_store = await asyncio.to_thread(
+                process_files_in_batches,
+                embeddings=embeddings,
+                md_paths=md_paths,
+                chunk_size=config["chunk_size"],
+                chunk_overlap=config["chunk_overlap"],
+                index_dir=index_dir,
+                max_workers=config["embed_workers"],
+                embedding_cache=embedding_cache,
+                pretokenize=config["pretokenize"],
+                index_spec=config["index_spec"],
+                chunks=SavedChunks(chunk_dir, names),
+                dedup=config["dedup"],
+                chunk_workers=config["chunk_workers"]
+                )
+            stats.record("index", index_dir, "done", time.perf_counter() - start)
+        except Exception as e:
+            stats.record("index", index_dir, "failed", time.perf_counter() - start, e)
+
+    page_cache.close()
+    embedding_cache.close()
+    summary = stats.summary()
+    if config["metrics"]:
+        metrics = get_metrics()
+        metrics.write_prometheus(os.path.join(metrics_dir, "metrics.prom"))
+        summary["metrics"] = summarize_trace(metrics.trace_path, since=started_at)
+        configure_metrics(None)
+    return vector_store, summary
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="PDFからMarkdown生成、チャンク分割、埋め込み、Vector DB構築までを実行する (再実行時は完了済みの処理を省略する)"
+        )
+    parser.add_argument("--pdf-dir", required=True, help="PDFファイルのディレクトリ")
+    parser.add_argument("--work-dir", required=True, help="中間生成物とチェックポイントの出力先")
+    parser.add_argument("--index-dir", default=None, help="Vector DBの保存先 (省略時は work-dir/index)")
+    parser.add_argument("--until", choices=STAGES, default=DEFAULT_PIPELINE_CONFIG["until"], help="この段階まで実行する")
+    parser.add_argument(
+        "--render-workers", type=int, default=DEFAULT_PIPELINE_CONFIG["render_workers"], help="描画するプロセス数"
+        )
+    parser.add_argument(
+        "--extract-documents", type=int, default=DEFAULT_PIPELINE_CONFIG["extract_documents"], help="同時に抽出するドキュメント数"
+        )
+    parser.add_argument(
+        "--extract-concurrency", type=int, default=DEFAULT_PIPELINE_CONFIG["extract_concurrency"], help="ページ単位のAPI同時実行数"
+        )
+    parser.add_argument(
+        "--chunk-workers", type=int, default=DEFAULT_PIPELINE_CONFIG["chunk_workers"], help="後処理・チャンク分割するプロセス数"
+        )
+    parser.add_argument(
+        "--embed-workers", type=int, default=DEFAULT_PIPELINE_CONFIG["embed_workers"], help="埋め込みの同時リクエスト数"
+        )
+    parser.add_argument(
+        "--queue-size", type=int, default=DEFAULT_PIPELINE_CONFIG["queue_size"], help="段階間のキューに滞留できるドキュメント数"
+        )
+    parser.add_argument("--requests-per-minute", type=int, default=DEFAULT_PIPELINE_CONFIG["requests_per_minute"])
+    parser.add_argument("--tokens-per-minute", type=int, default=DEFAULT_PIPELINE_CONFIG["tokens_per_minute"])
+    parser.add_argument("--no-local-render", action="store_true", help="すべてのページをLLMで変換する")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_PIPELINE_CONFIG["chunk_size"])
+    parser.add_argument("--chunk-overlap", type=int, default=DEFAULT_PIPELINE_CONFIG["chunk_overlap"])
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=None, help="近似重複とみなすチャンクの類似度 (省略時は重複を除去しない)"
+        )
+    parser.add_argument("--dedup-scope", choices=DEDUP_SCOPES, default=DEFAULT_DEDUP_CONFIG["scope"])
+    parser.add_argument("--index-type", choices=("flat", "hnsw", "ivfpq"), default="flat")
+    parser.add_argument("--no-metrics", action="store_true", help="計測値のトレースを出力しない")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from dotenv import load_dotenv
+    from openai import AsyncAzureOpenAI
+    from langchain_openai import AzureOpenAIEmbeddings
+
+    args = build_parser().parse_args(argv)
+    load_dotenv()
+
+    config = {
+        "render_workers": args.render_workers,
+        "extract_documents": args.extract_documents,
+        "extract_concurrency": args.extract_concurrency,
+        "chunk_workers": args.chunk_workers,
+        "embed_workers": args.embed_workers,
+        "queue_size": args.queue_size,
+        "requests_per_minute": args.requests_per_minute,
+        "tokens_per_minute": args.tokens_per_minute,
+        "local_render": not args.no_local_render,
+        "chunk_size": args.chunk_size,
+        "chunk_overlap": args.chunk_overlap,
+        "dedup": None,
+        "index_spec": {"type": args.index_type},
+        "until": args.until,
+        "metrics": not args.no_metrics,
+    }
+    if args.dedup_threshold is not None:
+        config["dedup"] = {"threshold": args.dedup_threshold, "scope": args.dedup_scope}
+    client = AsyncAzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_OPENAI_API_ENDPOINT"),
+        api_version=os.getenv("API_VERSION"),
+        max_retries=0,
+        )
+    embeddings = None
+    if STAGES.index(args.until) >= STAGES.index("embed"):
+        embeddings = AzureOpenAIEmbeddings(model=os.getenv("EMBEDDING"))
+
+    pdf_paths = sorted(glob(os.path.join(args.pdf_dir, "*.pdf")))
+    _, summary = asyncio.run(run_pipeline(
+        pdf_paths, args.work_dir, client, os.getenv("MODEL"),
+        embeddings=embeddings, index_dir=args.index_dir, config=config
+        ))
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 1 if summary["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class AsyncRateLimiter:
+    """
+    リクエスト数/分とトークン数/分を同時に制限するトークンバケット
+
+    複数のコルーチン (複数ドキュメントの処理) で共有することで、
+    全体のAPI呼び出しをAPIのクォータ内に収める
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None
+            ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = requests_per_minute or 0.0
+        self._available_tokens = tokens_per_minute or 0.0
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute:
+            self._available_requests = min(
+                self.requests_per_minute,
+                self._available_requests + elapsed * self.requests_per_minute / 60
+                )
+        if self.tokens_per_minute:
+            self._available_tokens = min(
+                self.tokens_per_minute,
+                self._available_tokens + elapsed * self.tokens_per_minute / 60
+                )
+
+    def _wait_time(self, tokens: float) -> float:
+        wait = 0.0
+        if self.requests_per_minute and self._available_requests < 1:
+            wait = max(wait, (1 - self._available_requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._available_tokens < tokens:
+            wait = max(wait, (tokens - self._available_tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: float = 0) -> None:
+        """
+        1リクエスト分と指定トークン数分の枠が空くまで待機して消費する
+        待機中はロックを保持するため、呼び出し順に枠が割り当てられる
+        """
+        if self.tokens_per_minute:
+            # バケット容量を超える要求は永久に満たされないため容量で打ち切る
+            tokens = min(tokens, self.tokens_per_minute)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests_per_minute:
+                self._available_requests -= 1
+            if self.tokens_per_minute:
+                self._available_tokens -= tokens
+
+    def adjust(self, tokens: float) -> None:
+        """
+        見積もりと実際の使用トークン数の差分をバケットに反映する (正の値で追加消費)
+        """
+        if self.tokens_per_minute:
+            self._available_tokens -= tokens
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    レスポンスヘッダ (retry-after-ms / retry-after) から待機秒数を取得
+    """
+    if headers is None:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+        attempt: int,
+        retry_after: Optional[float] = None,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+        ) -> float:
+    """
+    指数バックオフ (ジッター付き) の待機秒数を計算
+    サーバーからRetry-Afterが指定されている場合はそれ以上待機する
+    """
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
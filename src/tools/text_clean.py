@@ -0,0 +1,132 @@
+import re
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from .aho_corasick import AhoCorasick
+
+
+# チャンクのクリーニングで適用する置換 (適用順)
+# 各置換は、対象の記法に必須の文字列をテキストが含まない場合は省略する
+_CLEAN_RULES = (
+    # コードブロックの除去（複数行に渡る部分）
+    ("```", re.compile(r'```[\s\S]*?```'), ''),
+    # インラインコードの除去（バッククォートを除いて中身だけ残す）
+    ("`", re.compile(r'`([^`]*)`'), r'\1'),
+    # リンクの処理：[リンクテキスト](URL) → リンクテキストのみ
+    ("](", re.compile(r'\[([^\]]+)\]\([^\)]+\)'), r'\1'),
+    # 太字・斜体の記法の除去（**や__で囲まれた部分をそのまま残す）
+    (("**", "__"), re.compile(r'(\*\*|__)(.*?)\1'), r'\2'),
+    (("*", "_"), re.compile(r'(\*|_)(.*?)\1'), r'\2'),
+    # ヘッダー記法の除去：行頭の#を削除
+    ("#", re.compile(r'^\s*#{1,6}\s*', flags=re.MULTILINE), ''),
+    # ページ番号の除去：例として "P.58" や "p.  58" のようなパターン
+    (("P", "p"), re.compile(r'\b[Pp]\.?\s*\d+\b'), ''),
+    # 3つ以上連続する改行は2つに整理
+    ("\n\n\n", re.compile(r'\n{3,}'), '\n\n'),
+    # 複数の空白を1つの空白に整理
+    ("  ", re.compile(r' {2,}'), ' '),
+)
+
+# 後処理 (行単位のフィルタ) で用いる正規表現
+_PAGE_REFERENCE_PATTERN = re.compile(r'P\.\d+')
+_LINK_PATTERN = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+_SPACES_PATTERN = re.compile(r' {2,}')
+
+# キーワードの判定にAho-Corasick法のオートマトンを用いるキーワード数の下限
+# (行数50000件での計測で、これより少ない場合は正規表現の選択の方が速い)
+_AUTOMATON_MIN_KEYWORDS = 128
+
+
+def clean_text(text: str) -> str:
+    """
+    Markdown由来の記法や余分な改行・空白を除去または整理する
+
+    ・コードブロック（```）は除去
+    ・インラインコード（`...`）は記号を除いてテキストのみ残す
+    ・リンクはリンクテキストのみを残す
+    ・**や*、__や_による強調は除去
+    ・ヘッダー（#）は除去
+    ・ページ番号（"P.58"など）は除去
+    ・3回以上連続する改行は2回の改行に整理
+    ・連続する空白を1つに整理
+    ・前後の余分な空白を除去
+
+    正規表現はモジュールの読み込み時にコンパイルし、該当する記法を含まないテキストには置換を適用しない
+    """
+    for required, pattern, replacement in _CLEAN_RULES:
+        if isinstance(required, str):
+            if required not in text:
+                continue
+        elif not any(part in text for part in required):
+            continue
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+def clean_line(line: str) -> str:
+    """
+    後処理用の1行のクリーニング (連続する空白の整理、リンクのテキスト化、前後の空白の除去)
+    """
+    if "  " in line:
+        line = _SPACES_PATTERN.sub(" ", line)
+    if "[" in line:
+        line = _LINK_PATTERN.sub(r"\1", line)
+    return line.strip()
+
+@lru_cache(maxsize=64)
+def compile_keywords(keywords: Tuple[str, ...]) -> Optional[Callable[[str], bool]]:
+    """
+    キーワードのいずれかを含むかを1回の走査で判定する関数を生成する (キーワードがない場合はNone)
+
+    キーワードが多い場合はtools.aho_corasickのオートマトンを用いる。少ない場合は正規表現の選択 (C実装) の方が速いため、
+    キーワード数が_AUTOMATON_MIN_KEYWORDS未満であれば正規表現とする
+    """
+    if not keywords:
+        return None
+    keywords = tuple(sorted(set(keywords), key=len, reverse=True))
+    if len(keywords) >= _AUTOMATON_MIN_KEYWORDS:
+        return AhoCorasick(keywords).contains_any
+    # 長いキーワードを先に並べる (包含関係にあるキーワードの判定結果は変わらない)
+    pattern = re.compile("|".join(re.escape(keyword) for keyword in keywords))
+    return lambda text: pattern.search(text) is not None
+
+def filter_markdown_lines(
+        lines: Iterable[str],
+        line_target_words: Iterable[str],
+        header_keywords: Iterable[str]
+        ) -> Iterator[str]:
+    """
+    Markdownの行を逐次フィルタし、残す行をクリーニングして返す
+
+    ・"P.数字" の表記を含む行は除外
+    ・line_target_wordsのいずれかを含む行は除外
+    ・header_keywordsのいずれかを含むヘッダー行から、次のヘッダー行の直前までを除外
+
+    Args:
+        lines: 改行文字を除いた行
+        line_target_words: 行単位で削除対象とするワード
+        header_keywords: ヘッダー行に対して削除対象とするキーワード
+
+    Returns:
+        Iterator[str]: クリーニング後の残す行
+    """
+    contains_word = compile_keywords(tuple(line_target_words))
+    contains_header_keyword = compile_keywords(tuple(header_keywords))
+
+    skip_section = False  # ヘッダーにより削除対象セクション内かどうかのフラグ
+    for line in lines:
+        if _PAGE_REFERENCE_PATTERN.search(line):
+            continue
+        line = clean_line(line)
+
+        if line.startswith("#"):
+            if contains_header_keyword is not None and contains_header_keyword(line):
+                # このヘッダーから次のヘッダーまでを除外 (ヘッダー行自体も出力しない)
+                skip_section = True
+                continue
+            skip_section = False
+        elif skip_section:
+            continue
+
+        if contains_word is not None and contains_word(line):
+            continue
+        yield line
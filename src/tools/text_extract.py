@@ -1,21 +1,43 @@
-import base64
+import hashlib
+import time
 from typing import List
 
+from .cache import page_cache_key
+from .image_encode import EncodedImage, estimate_image_tokens, load_image
+from .metrics import record_llm_request
 
-def analyze_image_with_blocks(client, image_path, blocks, model):
+
+EXTRACT_PROMPT_TEMPLATE = """
+    以下はPDFドキュメントの画像と、そのページから抽出されたテキストブロック情報です。
+    この情報を使用して、元のPDFの構造を保ちながら、正確なテキスト抽出を行い、Markdown形式で出力してください。
+    Markdown形式で出力時に```markdown```といった記載は不要です。
+
+    特に以下の点に注意してください：
+    - 表、箇条書き、見出しなどのドキュメントの構造を正確に再現する
+    - テキストブロック情報（特に座標情報）を活用して、各要素の配置を正しく理解し、テキストの順序を正確に決定する
+    - 画像に含まれるテキストが、テキストブロック情報にない場合、確信度合いによってはそれも出力対象とする
+    - 抽出したテキスト情報以外の余計な要素は出力しない
+    - 重複した情報は出力しない
+    - ページ数は出力しない（例：P.1など）
+    - 出力すべきテキストがない場合、何も出力しない
+
+    テキストブロック情報:
+    {blocks_content}
     """
-    画像とテキストブロック情報を用いて、GPT-4o-miniによるテキスト抽出を実施
+
+# プロンプト変更時にキャッシュを無効化するためのバージョン
+PROMPT_VERSION = hashlib.sha256(EXTRACT_PROMPT_TEMPLATE.encode("utf-8")).hexdigest()[:12]
+
+def blocks_to_text(blocks):
+    """
+    テキストブロック情報をプロンプトに埋め込むためのテキストに変換
 
     Args:
-        image_path (str): 画像のパス
         blocks (list): テキストブロック情報
 
     Returns:
-        str: GPT-4o-miniによる解析結果
+        str: テキストブロック情報を連結したテキスト
     """
-    with open(image_path, "rb") as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-
     blocks_content = ""
     for block in blocks:
         if block['type'] == 0:
@@ -27,47 +49,77 @@ def analyze_image_with_blocks(client, image_path, blocks, model):
             for row in block['data']:
                 blocks_content += str(row) + "\n"
             blocks_content += "\n"
+    return blocks_content
 
-    template_prompt = f"""
-    以下はPDFドキュメントの画像と、そのページから抽出されたテキストブロック情報です。
-    この情報を使用して、元のPDFの構造を保ちながら、正確なテキスト抽出を行い、Markdown形式で出力してください。
-    Markdown形式で出力時に```markdown```といった記載は不要です。
+def build_extract_messages(base64_image, blocks_content, mime_type="image/png", detail=None):
+    """
+    テキスト抽出のためのChat Completions APIのメッセージを作成
 
-    特に以下の点に注意してください：
-    - 表、箇条書き、見出しなどのドキュメントの構造を正確に再現する
-    - テキストブロック情報（特に座標情報）を活用して、各要素の配置を正しく理解し、テキストの順序を正確に決定する
-    - 画像に含まれるテキストが、テキストブロック情報にない場合、確信度合いによってはそれも出力対象とする
-    - 抽出したテキスト情報以外の余計な要素は出力しない
-    - 重複した情報は出力しない
-    - ページ数は出力しない（例：P.1など）
-    - 出力すべきテキストがない場合、何も出力しない
+    Args:
+        base64_image (str): base64形式の画像
+        blocks_content (str): テキストブロック情報
+        mime_type (str): 画像のMIMEタイプ
+        detail (str): 画像の解像度の指定 ("low", "high", "auto"。Noneの場合は指定しない)
+    """
+    template_prompt = EXTRACT_PROMPT_TEMPLATE.format(blocks_content=blocks_content)
+    image_url = {"url": f"data:{mime_type};base64,{base64_image}"}
+    if detail is not None:
+        image_url["detail"] = detail
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": template_prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": image_url
+                },
+            ],
+        }
+    ]
+
+def analyze_image_with_blocks(client, image_path, blocks, model, cache=None, detail=None):
+    """
+    画像とテキストブロック情報を用いて、GPT-4o-miniによるテキスト抽出を実施
 
-    テキストブロック情報:
-    {blocks_content}
+    Args:
+        image_path (str | EncodedImage): 画像のパス、またはメモリ上でエンコードした画像
+        blocks (list): テキストブロック情報
+        cache (PageCache): 解析結果のキャッシュ (Noneの場合はキャッシュしない)
+        detail (str): 画像の解像度の指定 ("low", "high", "auto")
+
+    Returns:
+        str: GPT-4o-miniによる解析結果
     """
+    base64_image, mime_type = load_image(image_path)
+    blocks_content = blocks_to_text(blocks)
 
+    if cache is not None:
+        key = page_cache_key(base64_image, blocks_content, EXTRACT_PROMPT_TEMPLATE, model, detail, max_tokens=4096, temperature=0.0)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
     response = client.chat.completions.create(
         model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": template_prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{base64_image}"}
-                    },
-                ],
-            }
-        ],
+        messages=build_extract_messages(base64_image, blocks_content, mime_type, detail),
         max_tokens=4096,
         temperature=0.0
     )
+    image_tokens = 0
+    if isinstance(image_path, EncodedImage):
+        image_tokens = estimate_image_tokens(image_path.width, image_path.height, detail)
+    record_llm_request("extract", model, "ok", time.perf_counter() - start, response.usage, image_tokens)
+    content = response.choices[0].message.content
+
+    if cache is not None and content is not None:
+        cache.set(key, content, model=model, prompt_version=PROMPT_VERSION)
 
-    return response.choices[0].message.content
+    return content
 
 def extract_company_name(lines: List):
     """
@@ -0,0 +1,64 @@
+import threading
+from functools import lru_cache
+from typing import List, Tuple
+
+from sudachipy import tokenizer
+from sudachipy import dictionary
+
+
+# Sudachi/MeCabのトークナイザはスレッドセーフではないため、スレッドごとにインスタンスを保持する
+_local = threading.local()
+
+
+@lru_cache(maxsize=None)
+def get_sudachi_dictionary(dict_type: str = "full"):
+    """
+    Sudachiの辞書を読み込む (読み込みコストが高いためプロセス内で1度だけ読み込む)
+    """
+    return dictionary.Dictionary(dict=dict_type)
+
+def get_sudachi_tokenizer(dict_type: str = "full"):
+    """
+    現在のスレッド用のSudachiトークナイザを取得 (初回呼び出し時に生成)
+    """
+    tokenizers = getattr(_local, "sudachi", None)
+    if tokenizers is None:
+        tokenizers = _local.sudachi = {}
+    if dict_type not in tokenizers:
+        tokenizers[dict_type] = get_sudachi_dictionary(dict_type).create()
+    return tokenizers[dict_type]
+
+def get_mecab_tagger():
+    """
+    現在のスレッド用のMeCabのTaggerを取得 (初回呼び出し時に生成)
+    """
+    tagger = getattr(_local, "mecab", None)
+    if tagger is None:
+        import MeCab
+        tagger = _local.mecab = MeCab.Tagger("-Owakati")
+    return tagger
+
+def mecab_tokenizer(text: str) -> List[str]:
+    return get_mecab_tagger().parse(text).split()
+
+def tokenize(text: str) -> List[str]:
+    """
+    SudachiのAモードで分かち書きし、重複を除いた表層形のリストを返す
+    """
+    tokenizer_obj = get_sudachi_tokenizer()
+    mode = tokenizer.Tokenizer.SplitMode.A
+    tokens = tokenizer_obj.tokenize(text, mode)
+    words = [token.surface() for token in tokens]
+    words = list(set(words))
+    return words
+
+@lru_cache(maxsize=4096)
+def _tokenize_cached(text: str) -> Tuple[str, ...]:
+    return tuple(tokenize(text))
+
+def preprocess_func(text: str) -> List[str]:
+    """
+    BM25の検索クエリ用の前処理
+    同一クエリの分かち書き結果はLRUキャッシュから返す
+    """
+    return list(_tokenize_cached(text))